@@ -1,5 +1,8 @@
 import os
+import re
+import json
 import yara
+import hashlib
 import shutil
 import tempfile
 import subprocess
@@ -7,6 +10,32 @@ import subprocess
 # This directory
 RULES_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Sidecar saved next to the compiled rules (read by the analyzer on cold start)
+RULES_METADATA_SUFFIX = '.meta.json'
+
+# Rules are partitioned by the file format they target, so the analyzer can run only the partition
+# matching an object's magic bytes (plus the generic rules). A rule is assigned to a format only if
+# its condition is anchored on it: one of the terms AND-ed together at the top level is a check of
+# the magic bytes at offset 0, or a simple test of the format's module (which is undefined, hence
+# false, for other formats). Every other rule is "generic" and runs on every object.
+# These class names must match FILE_CLASS_MAGIC in the analyzer.
+FILE_CLASS_ANCHORS = {
+    'pe': [r'uint16\(0\)\s*==\s*0x5a4d', r'uint16be\(0\)\s*==\s*0x4d5a'],
+    'elf': [r'uint32\(0\)\s*==\s*0x464c457f', r'uint32be\(0\)\s*==\s*0x7f454c46'],
+    'macho': [r'uint32\(0\)\s*==\s*(0xfeedfac[ef]|0xcefaedfe|0xcffaedfe)',
+              r'uint32be\(0\)\s*==\s*(0xfeedfac[ef]|0xcefaedfe|0xcffaedfe)'],
+    'office': [r'uint32\(0\)\s*==\s*0xe011cfd0', r'uint32be\(0\)\s*==\s*0xd0cf11e0'],
+    'pdf': [r'uint32\(0\)\s*==\s*0x46445025', r'uint32be\(0\)\s*==\s*0x25504446'],
+}
+# A module test: a field or a call, optionally compared with a constant.
+_MODULE_TERM = (r'{}\.[\w.]+(\[[^\[\]]*\])*(\([^()]*\))?'
+                r'(\s*(==|!=|<=|>=|<|>)\s*[\w."]+)?')
+FILE_CLASS_MODULES = {'pe': 'pe', 'elf': 'elf', 'macho': 'macho'}
+GENERIC_CLASS = 'generic'
+
+# External variables shared by every compiled rule set (set per file by the analyzer)
+YARA_EXTERNALS = {'extension': '', 'filename' : '', 'filepath': '', 'filetype': ''}
+
 # Remote URLs (To be updated)
 REMOTE_RULE_SOURCES = {
     'https://github.com/YARA-Rules/rules.git' : ['cve_rules'],
@@ -22,6 +51,207 @@ def _find_yara_files():
                   if filename.lower().endswith(('.yar', '.yara'))]
     return yara_files
 
+def _strip_comments(source):
+    # Blank out comments (keeping offsets), leaving string literals untouched.
+    result, i = [], 0
+    while i < len(source):
+        if source[i] == '"':
+            end = i + 1
+            while end < len(source) and source[end] != '"':
+                end += 2 if source[end] == '\\' else 1
+            result.append(source[i:end + 1])
+            i = end + 1
+        elif source.startswith('//', i):
+            end = source.find('\n', i)
+            end = len(source) if end < 0 else end
+            result.append(' ' * (end - i))
+            i = end
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            end = len(source) if end < 0 else end + 2
+            result.append(re.sub(r'[^\n]', ' ', source[i:end]))
+            i = end
+        else:
+            result.append(source[i])
+            i += 1
+    return ''.join(result)
+
+def _split_rules(source):
+    # Split a rule file into its imports and rules: ([imports], [(name, modifiers, text,
+    # condition)]), or None if it cannot be split safely (includes, global rules, unbalanced
+    # braces) and must stay in one piece.
+    source = _strip_comments(source)
+    if re.search(r'^\s*include\s+"', source, re.MULTILINE):
+        return None
+    imports = re.findall(r'^[ \t]*(import\s+"\w+")', source, re.MULTILINE)
+
+    rules, position = [], 0
+    header = re.compile(r'((?:(?:private|global)\s+)*)rule\s+([A-Za-z_]\w*)[^{]*\{')
+    while True:
+        match = header.search(source, position)
+        if match is None:
+            break
+        if 'global' in match.group(1):
+            return None
+        depth, i = 1, match.end()
+        while depth and i < len(source):
+            if source[i] == '"':
+                i += 1
+                while i < len(source) and source[i] != '"':
+                    i += 2 if source[i] == '\\' else 1
+            elif source[i] == '{':
+                depth += 1
+            elif source[i] == '}':
+                depth -= 1
+            i += 1
+        if depth:
+            return None
+        text = source[match.start():i]
+        condition = re.split(r'\bcondition\s*:', text, maxsplit=1)
+        if len(condition) != 2:
+            return None
+        rules.append((match.group(2), match.group(1).split(), text, condition[1][:-1]))
+        position = i
+    return imports, rules
+
+def _split_top_level(expression, keyword):
+    # Split an expression on a boolean keyword outside of parentheses and string literals.
+    parts, depth, start, i = [], 0, 0, 0
+    while i < len(expression):
+        char = expression[i]
+        if char == '"':
+            i += 1
+            while i < len(expression) and expression[i] != '"':
+                i += 2 if expression[i] == '\\' else 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and re.match(r'\b{}\b'.format(keyword), expression[i:]) and (
+                i == 0 or not (expression[i - 1].isalnum() or expression[i - 1] in '_.$')):
+            parts.append(expression[start:i])
+            start = i + len(keyword)
+        i += 1
+    parts.append(expression[start:])
+    return [part.strip() for part in parts]
+
+def _strip_parentheses(expression):
+    # Remove parentheses wrapping the whole expression.
+    expression = expression.strip()
+    while expression.startswith('(') and expression.endswith(')'):
+        depth = 0
+        for i, char in enumerate(expression):
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            if depth == 0 and i < len(expression) - 1:
+                return expression  # The first parenthesis closes before the end.
+        expression = expression[1:-1].strip()
+    return expression
+
+def _anchored_class(condition):
+    # The file class a condition requires (see FILE_CLASS_ANCHORS), or None.
+    condition = _strip_parentheses(' '.join(condition.lower().split()))
+    alternatives = _split_top_level(condition, 'or')
+    if len(alternatives) > 1:
+        # Anchored only if every alternative is anchored on the same class.
+        classes = set(_anchored_class(alternative) for alternative in alternatives)
+        return classes.pop() if len(classes) == 1 else None
+
+    terms = _split_top_level(condition, 'and')
+    if len(terms) > 1:
+        classes = set(_anchored_class(term) for term in terms) - {None}
+        return classes.pop() if len(classes) == 1 else None
+
+    for file_class, anchors in FILE_CLASS_ANCHORS.items():
+        if any(re.fullmatch(anchor, condition) for anchor in anchors):
+            return file_class
+        module = FILE_CLASS_MODULES.get(file_class)
+        if module and re.fullmatch(_MODULE_TERM.format(module), condition):
+            return file_class
+    return None
+
+def _partition_rules(filepath):
+    # Map the rules of a file to their file class: ({class: [rule texts]}, [imports]), or
+    # None if the file must stay whole in the generic partition.
+    with open(filepath, errors='ignore') as rule_file:
+        split = _split_rules(rule_file.read())
+    if split is None:
+        return None
+    imports, rules = split
+
+    # The split must yield exactly the rules YARA finds in the file.
+    names = [name for name, _, _, _ in rules]
+    compiled = yara.compile(filepath=filepath, externals=YARA_EXTERNALS)
+    if sorted(names) != sorted(rule.identifier for rule in compiled):
+        return None
+    # Rule sets by wildcard (e.g. "any of (Rule*)") may refer to any rule of the file.
+    if any(re.search(r'(?<![$#@!\w])[A-Za-z_]\w*\*', condition)
+           for _, _, _, condition in rules):
+        return None
+
+    # A rule name, but not a string identifier ($name, #name, ...) or a module field (pe.name).
+    reference = r'(?<![$#@!.\w]){}\b'
+    grouped = {}
+    for name, _, text, condition in rules:
+        # Rules which refer to each other stay together, in the generic partition.
+        referenced = any(re.search(reference.format(name), other)
+                         for other_name, _, _, other in rules if other_name != name)
+        refers = any(re.search(reference.format(other_name), condition)
+                     for other_name, _, _, _ in rules if other_name != name)
+        file_class = None if referenced or refers else _anchored_class(condition)
+        grouped.setdefault(file_class or GENERIC_CLASS, []).append(text)
+    return grouped, imports
+
+def _compile_partitions(yara_filepaths, target_path):
+    # Compile one rule set per file class next to target_path (e.g. binary_yara_rules.pe.bin)
+    # and return {class: {'File': basename, 'NumRules': count}} for the metadata sidecar.
+    # Rules keep the namespace (relative path) they have in the full rule set.
+    grouped = {}  # {class: {namespace: filepath}}
+    partition_dir = tempfile.mkdtemp()
+    try:
+        for index, (relative_path, filepath) in enumerate(sorted(yara_filepaths.items())):
+            split = _partition_rules(filepath)
+            if split is None:
+                grouped.setdefault(GENERIC_CLASS, {})[relative_path] = filepath
+                continue
+            rules_by_class, imports = split
+            for file_class, texts in rules_by_class.items():
+                part_path = os.path.join(partition_dir, '{}.{}.yar'.format(index, file_class))
+                with open(part_path, 'w') as part_file:
+                    part_file.write('\n'.join(imports + texts) + '\n')
+                grouped.setdefault(file_class, {})[relative_path] = part_path
+
+        base, extension = os.path.splitext(target_path)
+        partitions = {}
+        for file_class in list(FILE_CLASS_ANCHORS) + [GENERIC_CLASS]:
+            if file_class not in grouped:
+                partitions[file_class] = {'File': None, 'NumRules': 0}
+                continue
+            rules = yara.compile(filepaths=grouped[file_class], externals=YARA_EXTERNALS)
+            partition_path = '{}.{}{}'.format(base, file_class, extension)
+            rules.save(partition_path)
+            partitions[file_class] = {
+                'File': os.path.basename(partition_path),
+                'NumRules': sum(1 for _ in rules)
+            }
+            print('Compiled {} rule(s) for {} files'.format(partitions[file_class]['NumRules'],
+                                                           file_class))
+    finally:
+        shutil.rmtree(partition_dir)
+    return partitions
+
+def _save_rules_metadata(rules, target_path, partitions):
+    # Save the rule count, a fingerprint (SHA256) of the compiled rules file and the rule
+    # partitions so the analyzer does not have to recompute them.
+    sha = hashlib.sha256()
+    with open(target_path, 'rb') as rules_file:
+        for chunk in iter(lambda: rules_file.read(2 ** 20), b''):
+            sha.update(chunk)
+
+    with open(target_path + RULES_METADATA_SUFFIX, 'w') as metadata_file:
+        json.dump({'NumRules': sum(1 for _ in rules), 'Fingerprint': sha.hexdigest(),
+                   'Partitions': partitions},
+                  metadata_file)
+
 def compile_rules(target_path):
     
     #Remove existing github rules
@@ -71,6 +301,8 @@ def compile_rules(target_path):
 
     rules = yara.compile(
         filepaths = yara_filepaths,
-        externals = {'extension': '', 'filename' : '', 'filepath': '', 'filetype': ''}
+        externals = YARA_EXTERNALS
     )
     rules.save(target_path)
+    _save_rules_metadata(rules, target_path, _compile_partitions(yara_filepaths, target_path))
+
@@ -1,20 +1,145 @@
 """Collection of boto3 calls to AWS resources for the analyzer function."""
+import os
 import json
+import time
 import logging
+import collections
+import concurrent.futures
 
-import boto3
+if __package__:
+    from lambda_functions.shared import aws_clients, key_messages
+else:
+    import aws_clients
+    import key_messages
 
 LOGGER = logging.getLogger()
 SNS_PUBLISH_SUBJECT_MAX_SIZE = 99
+SNS_MAX_BATCH_SIZE = 10  # Entries per SNS PublishBatch request.
+SNS_MAX_BATCH_BYTES = 250 * 2 ** 10  # Payload limit of a whole PublishBatch request (256 KB).
+SNS_DIGEST_MAX_BYTES = 200 * 2 ** 10  # Summaries per digest message, leaving room for the rest.
+SQS_MAX_BATCH_SIZE = 10  # Entries per SQS batch request.
+DYNAMO_MAX_BATCH_WRITE = 25  # Items per Dynamo BatchWriteItem request.
+DYNAMO_QUERY_CONCURRENCY = 8
+DOWNLOAD_CHUNK_SIZE = 2 * 2 ** 20  # Stream S3 bodies 2 MB at a time.
 
+# Objects at least this large are fetched as concurrent byte-range GETs instead of one stream.
+RANGED_GET_THRESHOLD   = int(os.environ.get('RANGED_GET_THRESHOLD_BYTES', 64 * 2 ** 20))
+RANGED_GET_PART_SIZE   = int(os.environ.get('RANGED_GET_PART_SIZE_BYTES', 8 * 2 ** 20))
+RANGED_GET_CONCURRENCY = int(os.environ.get('RANGED_GET_CONCURRENCY', 8))
+
+# Every prefetch thread may run RANGED_GET_CONCURRENCY GETs at once on the shared S3 client.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get(
+    'S3_MAX_POOL_CONNECTIONS',
+    max(int(os.environ.get('PREFETCH_DEPTH', 4)), int(os.environ.get('SCAN_WORKERS', 1))) *
+    RANGED_GET_CONCURRENCY + 1))
+
+
+def _s3_client():
+    # Return the container-wide S3 client, with a pool large enough for the prefetch threads.
+    return aws_clients.client('s3', max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+
+
+def download_from_s3(bucket_name, object_key, download_path, digests=(), in_memory_limit=0):
+    """Stream an object from S3 into local /tmp storage and return the metadata.
+
+    The body is pulled in fixed-size chunks so large objects are never held in memory at once.
+    Each chunk is written to disk and fed to every digest, so hashes come from the same pass.
+    Objects no larger than in_memory_limit are instead kept in memory and never touch /tmp.
+
+    Args:
+        bucket_name: [string] Name of the S3 bucket.
+        object_key: [string] Key of the S3 object to download.
+        download_path: [string] Local filepath where the object is written.
+        digests: [list<hashlib hash>] (optional) Hash objects updated with every chunk.
+        in_memory_limit: [int] (optional) Largest object size (bytes) to keep in memory.
+            Defaults to 0 (always download to disk).
+
+    Returns:
+        3-tuple: ([dict] User-defined S3 object metadata,
+                  [bytes] Object contents if kept in memory, otherwise None,
+                  [string] ETag (without quotes) of the object version that was downloaded)
+    """
+    response = _s3_client().get_object(Bucket=bucket_name, Key=object_key)
+
+    if response['ContentLength'] <= in_memory_limit:
+        data = response['Body'].read()
+        for digest in digests:
+            digest.update(data)
+        return response['Metadata'], data, response['ETag'].strip('"')
 
-def download_from_s3(bucket_name, object_key, download_path):
-    # Download an object from S3 into local /tmp storage and return the metadata.
-    response = boto3.client('s3').get_object(Bucket=bucket_name, Key=object_key)
     with open(download_path, 'wb') as file:
-        file.write(response['Body'].read())
+        if response['ContentLength'] >= RANGED_GET_THRESHOLD and RANGED_GET_CONCURRENCY > 1:
+            _download_ranges(bucket_name, object_key, response, file, digests)
+        else:
+            for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                _write_chunk(file, chunk, digests)
+
+    return response['Metadata'], None, response['ETag'].strip('"')
+
+
+def _write_chunk(file, chunk, digests):
+    # Append a chunk of the object to the local file and feed it to every digest.
+    file.write(chunk)
+    for digest in digests:
+        digest.update(chunk)
+
+
+def _get_range(client, bucket_name, object_key, etag, first_byte, last_byte):
+    # Fetch one byte range of an object, failing if the object changed since the first GET.
+    return client.get_object(
+        Bucket=bucket_name, Key=object_key, IfMatch=etag,
+        Range='bytes={}-{}'.format(first_byte, last_byte)
+    )['Body'].read()
 
-    return response['Metadata']
+
+def _download_ranges(bucket_name, object_key, response, file, digests):
+    """Download a large object as concurrent byte-range GETs.
+
+    The already-open GET stream supplies the first part; the remaining parts are fetched by a
+    thread pool. Parts are written (and hashed) strictly in order as they complete, so at most
+    RANGED_GET_CONCURRENCY parts are held in memory and hashes still come from a single pass.
+    """
+    size = response['ContentLength']
+    part_size = RANGED_GET_PART_SIZE
+    LOGGER.debug('Downloading %d bytes in %d-byte ranges', size, part_size)
+
+    _write_chunk(file, response['Body'].read(part_size), digests)
+    response['Body'].close()
+
+    client = _s3_client()
+    ranges = [(start, min(start + part_size, size) - 1)
+              for start in range(part_size, size, part_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=RANGED_GET_CONCURRENCY) as executor:
+        parts = collections.deque()
+        for first_byte, last_byte in ranges:
+            if len(parts) >= RANGED_GET_CONCURRENCY:
+                _write_chunk(file, parts.popleft().result(), digests)
+            parts.append(executor.submit(
+                _get_range, client, bucket_name, object_key, response['ETag'],
+                first_byte, last_byte))
+        while parts:
+            _write_chunk(file, parts.popleft().result(), digests)
+
+
+def download_s3_range(bucket_name, object_key, first_byte, last_byte):
+    """Download a byte range of an S3 object (e.g. its header) into memory.
+
+    Returns:
+        [bytes] The requested range (shorter if the object is smaller).
+    """
+    return _s3_client().get_object(
+        Bucket=bucket_name, Key=object_key, Range='bytes={}-{}'.format(first_byte, last_byte)
+    )['Body'].read()
+
+
+def head_s3_object(bucket_name, object_key):
+    """Fetch the ETag, size and metadata of an S3 object without downloading it.
+
+    Returns:
+        3-tuple: ([string] ETag without quotes, [int] size in bytes, [dict] user-defined metadata)
+    """
+    response = _s3_client().head_object(Bucket=bucket_name, Key=object_key)
+    return response['ETag'].strip('"'), response['ContentLength'], response['Metadata']
 
 
 def _elide_string_middle(text, max_length):
@@ -26,81 +151,202 @@ def _elide_string_middle(text, max_length):
     return '{} ... {}'.format(text[:half_len], text[-half_len:])
 
 
-def publish_alert_to_sns(binary, topic_arn):
-    # Publish a JSON SNS alert: a binary has matched one or more YARA rules.
+def _alert_subject(binary):
+    # Subject line of the SNS alert for a single binary.
     subject = 'BinaryAlert: {} matches a YARA rule'.format(
         binary.observed_path or binary.reported_md5 or binary.computed_md5)
-    boto3.client('sns').publish(
-        TopicArn=topic_arn,
-        Subject=_elide_string_middle(subject, SNS_PUBLISH_SUBJECT_MAX_SIZE),
-        Message=(json.dumps(binary.summary(), indent=4, sort_keys=True))
-    )
-    LOGGER.info(json.dumps(binary.summary(), indent=4, sort_keys=True))
+    return _elide_string_middle(subject, SNS_PUBLISH_SUBJECT_MAX_SIZE)
 
 
-def delete_sqs_messages(queue_url, receipts):
-    """Mark a batch of SQS receipts as completed (removing them from the queue).
+class SNSAlertAggregator(object):
+    """Buffers the alerts of an invocation and publishes them with SNS PublishBatch.
 
-    Args:
-        queue_url: [string] The URL of the SQS queue containing the messages.
-        receipts: [list<string>] List of SQS receipt handles.
+    Each alert is serialized once, when it is added. With a digest window, a binary whose matched
+    rules have all been alerted in full within the last digest_window seconds is not sent on its
+    own: it is rolled into a single digest message per rule set, listing a compact summary of
+    every such binary. The window state (rule -> time of the last full alert) is passed in so it
+    can outlive the aggregator, e.g. for the lifetime of a warm container.
     """
-    LOGGER.info('Deleting %d SQS receipt(s) from %s', len(receipts), queue_url)
-    boto3.client('sqs').delete_message_batch(
-        QueueUrl=queue_url,
-        Entries=[
-            {'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(receipts)]
-    )
-
+    def __init__(self, topic_arn, digest_window=0, last_full_alerts=None):
+        """Initialize the aggregator.
 
-def _compute_statistics(values):
-    """Compute summary statistics for a collection of values.
+        Args:
+            topic_arn: [string] ARN of the SNS topic to publish to.
+            digest_window: [int] (optional) Seconds during which repeated hits of the same rules
+                are rolled into digests. 0 publishes every alert in full.
+            last_full_alerts: [dict] (optional) Rule ID -> epoch time of its last full alert.
+        """
+        self._topic_arn = topic_arn
+        self._digest_window = digest_window
+        self._last_full_alerts = {} if last_full_alerts is None else last_full_alerts
+        self._alerts = []  # (subject, message) of full alerts.
+        self._digests = collections.OrderedDict()  # Rule ID tuple -> [compact summaries].
+
+    def __len__(self):
+        return len(self._alerts) + sum(len(entries) for entries in self._digests.values())
+
+    def _recently_alerted(self, rules, now):
+        return all(now - self._last_full_alerts.get(rule, -float('inf')) < self._digest_window
+                   for rule in rules)
+
+    def add(self, binary):
+        """Queue an alert for a binary which matched one or more YARA rules."""
+        rules = tuple(sorted(set(binary.matched_rule_ids)))
+        now = time.time()
+        if self._digest_window and self._recently_alerted(rules, now):
+            self._digests.setdefault(rules, []).append(json.dumps({
+                'S3Location': binary.s3_identifier,
+                'ComputedSHA256': binary.computed_sha,
+                'ComputedMD5': binary.computed_md5,
+                'SamplePath': binary.observed_path
+            }, sort_keys=True, separators=(',', ':')))
+            return
+
+        message = json.dumps(binary.summary(), indent=4, sort_keys=True)
+        LOGGER.info(message)
+        self._alerts.append((_alert_subject(binary), message))
+        for rule in rules:
+            self._last_full_alerts[rule] = now
+
+    def _digest_messages(self):
+        # Yield (subject, message) for each digest, split to respect the SNS message size.
+        for rules, entries in self._digests.items():
+            chunks, chunk, chunk_bytes = [], [], 0
+            for entry in entries:
+                if chunk and chunk_bytes + len(entry) > SNS_DIGEST_MAX_BYTES:
+                    chunks.append(chunk)
+                    chunk, chunk_bytes = [], 0
+                chunk.append(entry)
+                chunk_bytes += len(entry) + 1
+            chunks.append(chunk)
+
+            for chunk in chunks:
+                subject = 'BinaryAlert: {} more binaries match {}'.format(
+                    len(chunk), ', '.join(rules))
+                message = '{{"MatchedRules":{},"Binaries":[{}]}}'.format(
+                    json.dumps(list(rules)), ','.join(chunk))
+                yield _elide_string_middle(subject, SNS_PUBLISH_SUBJECT_MAX_SIZE), message
+
+    def _publish_batch(self, client, entries):
+        # Publish up to 10 (subject, message) entries, retrying server-side failures once.
+        for attempt in range(2):
+            response = client.publish_batch(
+                TopicArn=self._topic_arn,
+                PublishBatchRequestEntries=[
+                    {'Id': str(index), 'Subject': subject, 'Message': message}
+                    for index, (subject, message) in enumerate(entries)
+                ]
+            )
+            failed = response.get('Failed', [])
+            if not failed:
+                return
+            retryable = [entries[int(f['Id'])] for f in failed if not f.get('SenderFault')]
+            if attempt or len(retryable) < len(failed):
+                LOGGER.error('Unable to publish %d SNS alert(s): %s', len(failed), failed)
+            if not retryable:
+                return
+            entries = retryable
+
+    def flush(self):
+        """Publish every buffered alert and digest, then empty the buffer."""
+        entries = self._alerts + list(self._digest_messages())
+        self._alerts, self._digests = [], collections.OrderedDict()
+        if not entries:
+            return
+
+        LOGGER.info('Publishing %d SNS alert message(s)', len(entries))
+        client = aws_clients.client('sns')
+        # The request size limit applies to the whole batch, not only to each message.
+        batch, batch_bytes = [], 0
+        for subject, message in entries:
+            entry_bytes = len(subject) + len(message.encode('utf-8'))
+            if batch and (len(batch) == SNS_MAX_BATCH_SIZE or
+                          batch_bytes + entry_bytes > SNS_MAX_BATCH_BYTES):
+                self._publish_batch(client, batch)
+                batch, batch_bytes = [], 0
+            batch.append((subject, message))
+            batch_bytes += entry_bytes
+        self._publish_batch(client, batch)
+
+
+def delete_sqs_messages(queue_url, receipts, max_attempts=3):
+    """Mark SQS receipts as completed (removing them from the queue).
+
+    Receipts are deleted in batches of at most 10 (the SQS limit). Entries which fail because of
+    a server-side error are retried with a short backoff; sender faults (e.g. expired receipts)
+    are not retryable.
 
     Args:
-        values: [list] of numeric values in the sample set.
+        queue_url: [string] The URL of the SQS queue containing the messages.
+        receipts: [list<string>] List of SQS receipt handles.
+        max_attempts: [int] (optional) How many times to try each receipt.
 
     Returns:
-        [dict] designed to be published as CloudWatch metric statistics.
+        [list<string>] Receipts which could not be deleted.
     """
-    return {
-        'SampleCount': len(values),
-        'Sum': sum(values),
-        'Minimum': min(values),
-        'Maximum': max(values)
-    }
-
-
-def put_metric_data(num_yara_rules, binaries):
-    """Publish custom metric data to CloudWatch.
+    LOGGER.info('Deleting %d SQS receipt(s) from %s', len(receipts), queue_url)
+    client = aws_clients.client('sqs')
+    pending, undeletable = list(receipts), []
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(0.1 * 2 ** attempt)
+
+        retry = []
+        for start in range(0, len(pending), SQS_MAX_BATCH_SIZE):
+            batch = pending[start:start + SQS_MAX_BATCH_SIZE]
+            response = client.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {'Id': str(index), 'ReceiptHandle': receipt}
+                    for index, receipt in enumerate(batch)]
+            )
+            for failure in response.get('Failed', []):
+                LOGGER.warning('Unable to delete SQS receipt: %s', failure['Message'])
+                receipt = batch[int(failure['Id'])]
+                (undeletable if failure.get('SenderFault') else retry).append(receipt)
+
+        pending = retry
+        if not pending:
+            break
+
+    failed = undeletable + pending
+    if failed:
+        LOGGER.error('%d SQS receipt(s) could not be deleted and will be redelivered', len(failed))
+    return failed
+
+
+def enqueue_s3_objects(queue_url, object_groups):
+    """Send groups of S3 objects back to the SQS queue, one message per group.
+
+    The message body uses the compact key_messages format, which the dispatcher decodes as usual.
+    The sizes and ETags of the objects are kept, so they are not lost when the work is handed off.
 
     Args:
-        num_yara_rules: [string] Number of YARA rules in the analyzer.
-        binaries: [list of BinaryInfo()] List of analyzed BinaryInfo()s.
+        queue_url: [string] The URL of the SQS queue.
+        object_groups: [list<list<dict>>] S3 objects to enqueue, each a dict with a 'key' and the
+            'size' and 'eTag' (or None); each inner list becomes a message.
+
+    Returns:
+        [set<int>] Indices of the groups which could not be enqueued.
     """
-    LOGGER.debug('Sending metric data')
-    metric_data = [
-        {
-            'MetricName': 'AnalyzedBinaries',
-            'Value': len(binaries),
-            'Unit': 'Count'
-        },
-        {
-            'MetricName': 'MatchedBinaries',
-            'Value': sum(1 for b in binaries if b.yara_matches),
-            'Unit': 'Count'
-        },
-        {
-            'MetricName': 'YaraRules',
-            'Value': num_yara_rules,
-            'Unit': 'Count'
-        },
-        {
-            'MetricName': 'S3DownloadLatency',
-            'StatisticValues': _compute_statistics([b.download_time_ms for b in binaries]),
-            'Unit': 'Milliseconds'
-        }
-    ]
-    boto3.client('cloudwatch').put_metric_data(Namespace='BinaryAlert', MetricData=metric_data)
+    client = aws_clients.client('sqs')
+    failed = set()
+    for start in range(0, len(object_groups), SQS_MAX_BATCH_SIZE):
+        response = client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {
+                    'Id': str(index),
+                    'MessageBody': key_messages.encode(objects, key_messages.COMPACT)
+                }
+                for index, objects in enumerate(
+                    object_groups[start:start + SQS_MAX_BATCH_SIZE], start)
+            ]
+        )
+        for failure in response.get('Failed', []):
+            LOGGER.error('Unable to enqueue message %s: %s', failure['Id'], failure['Message'])
+            failed.add(int(failure['Id']))
+    return failed
 
 
 class DynamoMatchTable(object):
@@ -127,7 +373,7 @@ class DynamoMatchTable(object):
             table_name: [string] The name of the Dynamo table containing match information.
         """
         self._table_name = table_name
-        self._client = boto3.client('dynamodb')
+        self._client = aws_clients.client('dynamodb')
 
     def _most_recent_item(self, sha):
         """Query the table for the most recent entry with the given SHA.
@@ -163,10 +409,19 @@ class DynamoMatchTable(object):
         else:
             return None
 
-    def _create_new_entry(self, binary, lambda_version):
-        """Create a new Dynamo entry with YARA match information."""
-        LOGGER.info('Creating new entry (SHA256: %s, LambdaVersion: %d)',
-                    binary.computed_sha, lambda_version)
+    def _add_s3_key(self, binary, lambda_version):
+        """Add S3 key to an existing entry. If the S3 key already exists, this is a no-op."""
+        LOGGER.info('Adding %s to existing entry (SHA256: %s, LambdaVersion: %d)',
+                    binary.s3_identifier, binary.computed_sha, lambda_version)
+        self._client.update_item(
+            TableName=self._table_name,
+            Key={'SHA256': {'S': binary.computed_sha}, 'LambdaVersion': {'N': str(lambda_version)}},
+            UpdateExpression='ADD S3Objects :s3_string_set',
+            ExpressionAttributeValues={':s3_string_set': {'SS': [binary.s3_identifier]}}
+        )
+
+    def _new_item(self, binary, lambda_version):
+        """Build a new Dynamo item with YARA match information."""
         item = {
             'SHA256': {'S': binary.computed_sha},
             'LambdaVersion': {'N': str(lambda_version)},
@@ -178,51 +433,145 @@ class DynamoMatchTable(object):
             item['MD5_Reported'] = {'S': binary.reported_md5}
         if binary.observed_path:
             item['SamplePath'] = {'S': binary.observed_path}
+        return item
+
+    def _batch_put(self, items, max_attempts=5):
+        """Write items with BatchWriteItem (25 per request), retrying unprocessed items."""
+        for start in range(0, len(items), DYNAMO_MAX_BATCH_WRITE):
+            request = {self._table_name: [
+                {'PutRequest': {'Item': item}}
+                for item in items[start:start + DYNAMO_MAX_BATCH_WRITE]]}
+            for attempt in range(max_attempts):
+                if attempt:
+                    time.sleep(0.1 * 2 ** attempt)
+                request = self._client.batch_write_item(
+                    RequestItems=request).get('UnprocessedItems')
+                if not request:
+                    break
+            else:
+                raise RuntimeError('{} item(s) were never written to {}'.format(
+                    len(request[self._table_name]), self._table_name))
+
+    def save_matches_batch(self, binaries, lambda_version):
+        """Save the YARA match results of several binaries with as few round trips as possible.
+
+        The most recent entries for all SHAs are queried concurrently and new entries are written
+        with BatchWriteItem. The entries end up the same as saving the binaries one after another
+        (including repeated SHAs within the batch). As before, every match is alerted on unless a
+        newer Lambda version has already matched the binary.
 
-        self._client.put_item(TableName=self._table_name, Item=item)
-
-    def _add_s3_key(self, binary, lambda_version):
-        """Add S3 key to an existing entry. If the S3 key already exists, this is a no-op."""
-        LOGGER.info('Adding %s to existing entry (SHA256: %s, LambdaVersion: %d)',
-                    binary.s3_identifier, binary.computed_sha, lambda_version)
-        self._client.update_item(
-            TableName=self._table_name,
-            Key={'SHA256': {'S': binary.computed_sha}, 'LambdaVersion': {'N': str(lambda_version)}},
-            UpdateExpression='ADD S3Objects :s3_string_set',
-            ExpressionAttributeValues={':s3_string_set': {'SS': [binary.s3_identifier]}}
-        )
+        Args:
+            binaries: [list<BinaryInfo>] Binaries which matched at least one YARA rule.
+            lambda_version: [int] Version of the analyzer Lambda.
 
-    def save_matches(self, binary, lambda_version):
-        # Save YARA match results to the Dynamo table.
+        Returns:
+            [list<bool>] Whether each binary needs an alert, in the same order.
+        """
+        shas = sorted({binary.computed_sha for binary in binaries})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DYNAMO_QUERY_CONCURRENCY) as pool:
+            state = dict(zip(shas, pool.map(self._most_recent_item, shas)))
+
+        new_items = {}  # SHA256 => item to create at this Lambda version.
+        needs_alert = []
+        for binary in binaries:
+            sha, s3_identifier = binary.computed_sha, binary.s3_identifier
+            item_tuple = state[sha]
+            if item_tuple is None:
+                # This binary has never been matched before.
+                new_items[sha] = self._new_item(binary, lambda_version)
+                state[sha] = (lambda_version, set(binary.matched_rule_ids), {s3_identifier})
+                needs_alert.append(True)
+                continue
 
-        needs_alert = True
-        # Grab the most recent match results for the given SHA.
-        item_tuple = self._most_recent_item(binary.computed_sha)
-        LOGGER.info(item_tuple)
-        if item_tuple is not None:
             # An entry already exists for this SHA.
             item_lambda_version, item_matched_rules, item_s3_objects = item_tuple
+            new_s3_object = s3_identifier not in item_s3_objects
 
-            # Update the DB appropriately.
+            # Update the DB (and the state later binaries in this batch will see) appropriately.
             if lambda_version != item_lambda_version:
                 # This binary has never been matched by this Lambda version.
-                self._create_new_entry(binary, lambda_version)
-            elif binary.s3_identifier not in item_s3_objects:
+                new_items[sha] = self._new_item(binary, lambda_version)
+                if lambda_version > item_lambda_version:
+                    state[sha] = (lambda_version, set(binary.matched_rule_ids),
+                                  item_s3_objects | {s3_identifier})
+            elif new_s3_object:
                 # A new S3 object is identical to a previously-matched binary.
-                self._add_s3_key(binary, lambda_version)
+                if sha in new_items:
+                    new_items[sha]['S3Objects']['SS'].append(s3_identifier)
+                else:
+                    self._add_s3_key(binary, lambda_version)
+                state[sha] = (item_lambda_version, item_matched_rules,
+                              item_s3_objects | {s3_identifier})
 
             # Decide whether we need to alert.
             if lambda_version < item_lambda_version:
                 LOGGER.warning('Current Lambda version %d is < version %d from previous analysis',
                                lambda_version, item_lambda_version)
-                needs_alert = False
-            elif (bool(set(binary.matched_rule_ids) - item_matched_rules) or
-                  binary.s3_identifier not in item_s3_objects):
-                # Either a new YARA rule matched or a new S3 object was found.
-                needs_alert = True
-        else:
-            # This binary has never been matched before.
-            self._create_new_entry(binary, lambda_version)
-            needs_alert = True
+            needs_alert.append(lambda_version >= item_lambda_version)
+
+        if new_items:
+            LOGGER.info('Creating %d new entries (LambdaVersion: %d)',
+                        len(new_items), lambda_version)
+            self._batch_put(list(new_items.values()))
+        return needs_alert
+
+    def _upsert_entry(self, binary, lambda_version):
+        """Create the entry for this Lambda version, or add the S3 key to it, in one UpdateItem.
+
+        Returns:
+            [dict] The entry as it was before the update (empty if it was just created).
+        """
+        updates = ['MD5_Computed = :md5', 'MatchedRules = :rules']
+        values = {
+            ':md5': {'S': binary.computed_md5},
+            ':rules': {'SS': binary.matched_rule_ids},
+            ':s3_string_set': {'SS': [binary.s3_identifier]}
+        }
+        if binary.reported_md5:
+            updates.append('MD5_Reported = :reported_md5')
+            values[':reported_md5'] = {'S': binary.reported_md5}
+        if binary.observed_path:
+            updates.append('SamplePath = :sample_path')
+            values[':sample_path'] = {'S': binary.observed_path}
 
-        return needs_alert
\ No newline at end of file
+        return self._client.update_item(
+            TableName=self._table_name,
+            Key={'SHA256': {'S': binary.computed_sha}, 'LambdaVersion': {'N': str(lambda_version)}},
+            UpdateExpression='SET {} ADD S3Objects :s3_string_set'.format(', '.join(updates)),
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_OLD'
+        ).get('Attributes', {})
+
+    def _newer_version(self, sha, lambda_version):
+        """Return the newest Lambda version above lambda_version which matched the SHA, or None."""
+        items = self._client.query(
+            TableName=self._table_name,
+            Limit=1,
+            ScanIndexForward=False,  # Sort by LambdaVersion descending (e.g. newest first).
+            ProjectionExpression='LambdaVersion',
+            KeyConditionExpression='SHA256 = :sha AND LambdaVersion > :version',
+            ExpressionAttributeValues={':sha': {'S': sha}, ':version': {'N': str(lambda_version)}}
+        ).get('Items')
+        return int(items[0]['LambdaVersion']['N']) if items else None
+
+    def upsert_matches(self, binary, lambda_version):
+        """Save YARA match results with one UpdateItem, plus a query only for new entries.
+
+        Concurrent analyzers racing on the same SHA can no longer overwrite each other's entry.
+        The UpdateItem returns the previous entry for this Lambda version: if there was one, this
+        version already matched the binary and the match is alerted on without another round
+        trip. Otherwise, as in save_matches_batch(), the match is alerted on unless a newer
+        Lambda version has already matched the binary (checked with an eventually consistent
+        query).
+
+        Returns:
+            [bool] Whether an alert should be published.
+        """
+        if self._upsert_entry(binary, lambda_version):
+            return True
+        newer_version = self._newer_version(binary.computed_sha, lambda_version)
+        if newer_version is not None:
+            LOGGER.warning('Current Lambda version %d is < version %d from previous analysis',
+                           lambda_version, newer_version)
+            return False
+        return True
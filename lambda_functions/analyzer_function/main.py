@@ -1,13 +1,26 @@
 import os
+import copy
 import time
 import yara
 import uuid
+import json
 import hashlib
 import logging
+import queue
+import collections
+import multiprocessing
+import concurrent.futures
 if __package__:
     import lambda_functions.analyzer_function.aws_lib as aws_lib
+    import lambda_functions.analyzer_function.verdict_cache as verdict_cache
+    import lambda_functions.analyzer_function.secret_scanner as secret_scanner
+    from lambda_functions.shared import scan_fingerprint, telemetry
 else :
     import aws_lib
+    import verdict_cache
+    import secret_scanner
+    import scan_fingerprint
+    import telemetry
 
 from botocore.exceptions import ClientError as BotoError
 
@@ -18,9 +31,57 @@ LOGGER.setLevel(logging.INFO)
 THIS_DIRECTORY          = os.path.dirname(os.path.realpath(__file__))
 COMPILED_RULES_FILENAME = 'binary_yara_rules.bin'
 COMPILED_RULES_FILEPATH = os.path.join(THIS_DIRECTORY, COMPILED_RULES_FILENAME)
+# Sidecar written next to the compiled rules by core/rules/compile_rules.py
+RULES_METADATA_SUFFIX   = '.meta.json'
 
 MB = 2 ** 20  # ~ 1 million bytes
 
+# Objects up to this size are scanned from memory instead of being written to /tmp.
+IN_MEMORY_SCAN_LIMIT = int(os.environ.get('IN_MEMORY_SCAN_LIMIT_BYTES', 8 * MB))
+
+# Number of upcoming objects downloaded in the background while the current one is scanned,
+# and the cap on bytes held (in memory or /tmp) by downloaded objects still waiting for a scan.
+PREFETCH_DEPTH     = int(os.environ.get('PREFETCH_DEPTH', 4))
+PREFETCH_MAX_BYTES = int(os.environ.get('PREFETCH_MAX_BYTES', 256 * MB))
+
+# Stop analyzing when less than this much time is left, so unfinished keys can be re-enqueued.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', 20000))
+
+# How matches are saved to Dynamo: 'batch' (bulk query + BatchWriteItem) or 'upsert' (one
+# conditional UpdateItem per match, deciding on alerts from the returned old image).
+MATCH_SAVE_MODE = os.environ.get('MATCH_SAVE_MODE', 'batch')
+
+# Repeated hits of rules which were alerted in full within this many seconds are rolled into one
+# digest message per rule set (0 sends every alert in full).
+ALERT_DIGEST_WINDOW_SECONDS = int(os.environ.get('ALERT_DIGEST_WINDOW_SECONDS', 0))
+
+# Scanners the combined analyzer runs next to YARA, over the same downloaded bytes, by name:
+# (analyzer class, env var of its Dynamo matches table, env var of its SNS alerts topic).
+EXTRA_SCANNERS = {
+    'secrets': (secret_scanner.SecretsAnalyzer,
+                'SECRETS_MATCHES_DYNAMO_TABLE_NAME', 'SECRETS_ALERTS_SNS_TOPIC_ARN'),
+}
+COMBINED_SCANNERS = [name.strip() for name in
+                     os.environ.get('COMBINED_SCANNERS', 'secrets').split(',') if name.strip()]
+
+# Number of YARA scanning processes: 1 scans in-process, 0 starts one per available vCPU.
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', 1)) or len(os.sched_getaffinity(0))
+
+# Magic bytes of the file formats which have their own rule partition (see compile_rules.py).
+# Objects of any other format are matched against the full rule set.
+FILE_CLASS_MAGIC = [
+    ('pe', (b'MZ',)),
+    ('elf', (b'\x7fELF',)),
+    ('macho', (b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf', b'\xce\xfa\xed\xfe', b'\xcf\xfa\xed\xfe')),
+    ('office', (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',)),
+    ('pdf', (b'%PDF',)),
+]
+GENERIC_CLASS     = 'generic'
+FILE_HEADER_BYTES = 4096  # How much of each object is sniffed for its file format.
+
+# Picklable stand-in for yara.Match, used to return matches from the scanning processes.
+YaraMatch = collections.namedtuple('YaraMatch', ['rule', 'namespace', 'tags', 'meta', 'strings'])
+
 def _read_in_chunks(file_object, chunk_size=2*MB):
     #Read a file in fixed-size chunks (to minimize memory usage for large files).
     while True:
@@ -31,6 +92,19 @@ def _read_in_chunks(file_object, chunk_size=2*MB):
             return  # End of file.
 
 
+class _TimedDigests(object):
+    # Feeds chunks to several hashlib digests and measures the time spent hashing
+    def __init__(self, *digests):
+        self._digests = digests
+        self.elapsed_ms = 0
+
+    def update(self, chunk):
+        start_time = time.time()
+        for digest in self._digests:
+            digest.update(chunk)
+        self.elapsed_ms += (time.time() - start_time) * 1000
+
+
 def compute_hashes(file_path):
     # Compute SHA and MD5 hashes for the specified file object.
     # The MD5 is only included to be compatible with other security tools.
@@ -43,17 +117,63 @@ def compute_hashes(file_path):
             md5.update(chunk)
     return sha.hexdigest(), md5.hexdigest()
 
+def _load_rules_metadata(rules_file):
+    # Read the rule count and fingerprint saved at compile time (empty dict if there is none).
+    try:
+        with open(rules_file + RULES_METADATA_SUFFIX) as metadata_file:
+            return json.load(metadata_file)
+    except (IOError, ValueError):
+        LOGGER.warning('No usable rules metadata next to %s', rules_file)
+        return {}
+
+def sniff_file_class(header):
+    # Identify the file format from the first bytes of an object (None if not recognized)
+    for file_class, magic in FILE_CLASS_MAGIC:
+        if header.startswith(magic):
+            return file_class
+    return None
+
+def _classes_without_rules(metadata):
+    # File classes for which no rule (not even a generic one) applies: these need no download.
+    partitions = metadata.get('Partitions')
+    if not partitions or partitions.get(GENERIC_CLASS, {}).get('NumRules'):
+        return frozenset()
+    return frozenset(file_class for file_class, partition in partitions.items()
+                     if file_class != GENERIC_CLASS and not partition['NumRules'])
+
 class YaraAnalyzer(object):
     # Encapsulates YARA analysis and matching functions
 
     def __init__(self, rules_file):
-        # Init with prebuilt binary rules
+        # Init with prebuilt binary rules and the metadata compiled alongside them
+        self._rules_file = rules_file
         self._rules = yara.load(rules_file)
 
+        metadata = _load_rules_metadata(rules_file)
+        self._num_rules = metadata.get('NumRules')
+        self._fingerprint = metadata.get('Fingerprint')
+
+        # Per-file-class rule partitions: {class: compiled rules, or None if it has no rules}
+        self._partitions = {
+            file_class: partition['File'] and yara.load(
+                os.path.join(os.path.dirname(rules_file), partition['File']))
+            for file_class, partition in metadata.get('Partitions', {}).items()
+        }
+        self.classes_without_rules = _classes_without_rules(metadata)
+
     @property
     def num_rules(self):
-        # Num of yara rules loaded (inlined cuz it's fast)
-        return sum(1 for _ in self._rules)
+        # Num of yara rules loaded (counted at most once if the sidecar is missing)
+        if self._num_rules is None:
+            self._num_rules = sum(1 for _ in self._rules)
+        return self._num_rules
+
+    @property
+    def fingerprint(self):
+        # SHA256 of the compiled rules file, identifying the exact rule set in use
+        if self._fingerprint is None:
+            self._fingerprint = compute_hashes(self._rules_file)[0]
+        return self._fingerprint
 
     @staticmethod
     def _yara_variables(original_target_path):
@@ -67,48 +187,217 @@ class YaraAnalyzer(object):
             'filetype': file_suffix.upper()  # Used in only one rule (checking for "GIF").
         }
 
-    def analyze(self, target_file, original_target_path=''):
-        return self._rules.match(target_file, externals=self._yara_variables(original_target_path))
+    def _rule_sets(self, target_file, data):
+        # The partition for the object's file format plus the generic rules, or all of the rules
+        # if there are no partitions or the format is not recognized
+        if not self._partitions:
+            return [self._rules]
+
+        if data is not None:
+            header = data[:FILE_HEADER_BYTES]
+        else:
+            with open(target_file, 'rb') as file_object:
+                header = file_object.read(FILE_HEADER_BYTES)
+
+        file_class = sniff_file_class(header)
+        if file_class not in self._partitions:
+            return [self._rules]
+        return [rules for rules in (self._partitions[file_class],
+                                    self._partitions.get(GENERIC_CLASS)) if rules is not None]
+
+    def analyze(self, target_file=None, original_target_path='', data=None):
+        # Match either a file on disk or an in-memory buffer (if data is given)
+        externals = self._yara_variables(original_target_path)
+        matches = []
+        for rules in self._rule_sets(target_file, data):
+            if data is not None:
+                matches.extend(rules.match(data=data, externals=externals))
+            else:
+                matches.extend(rules.match(target_file, externals=externals))
+        return matches
+
+def _scan_worker(rules_file, connection):
+    # Scanning process: load the rules once, report the rule count, then answer analyze()
+    # requests until told to stop.
+    analyzer = YaraAnalyzer(rules_file)
+    connection.send(analyzer.num_rules)
+    while True:
+        request = connection.recv()
+        if request is None:
+            return
+        try:
+            matches = analyzer.analyze(**request)
+            connection.send((None, [
+                YaraMatch(match.rule, match.namespace, match.tags, match.meta, match.strings)
+                for match in matches]))
+        except Exception as error:  # Re-raised by the parent.
+            connection.send((repr(error), None))
+
+class YaraProcessPool(object):
+    """Runs YARA analysis in a pool of worker processes, one scan per process at a time.
+
+    Each worker loads the compiled rules once. analyze() has the same signature as
+    YaraAnalyzer.analyze() and blocks until a worker is free, so callers get parallelism by
+    scanning from several threads (see S3Prefetcher). Lambda has no /dev/shm, so this uses plain
+    Processes and Pipes instead of multiprocessing.Pool or a ProcessPoolExecutor.
+    """
+
+    def __init__(self, rules_file, num_workers):
+        # Same attributes as YaraAnalyzer, from the metadata: the rules are only loaded by workers
+        metadata = _load_rules_metadata(rules_file)
+        self.classes_without_rules = _classes_without_rules(metadata)
+        self.fingerprint = metadata.get('Fingerprint') or compute_hashes(rules_file)[0]
+
+        self._rules_file = rules_file
+        self._processes = {}  # Parent end of the pipe of each worker => its process.
+        self._idle = queue.Queue()  # Parent ends of the pipes of idle workers.
+        connections = [self._start_worker() for _ in range(num_workers)]
+        # Workers load the rules concurrently; each then reports its rule count.
+        self.num_rules = [connection.recv() for connection in connections][0]
+        for connection in connections:
+            self._idle.put(connection)
+
+    def _start_worker(self):
+        # Start a scanning process and return the parent end of its pipe
+        parent_end, child_end = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_scan_worker, args=(self._rules_file, child_end), daemon=True)
+        process.start()
+        child_end.close()  # Only the worker uses it: its death is then seen as EOF here.
+        self._processes[parent_end] = process
+        return parent_end
+
+    def _replace_worker(self, connection):
+        # Stop a worker whose pipe is broken (e.g. it crashed mid-scan) and start another one
+        process = self._processes.pop(connection)
+        process.terminate()
+        process.join()
+        connection.close()
+        new_connection = self._start_worker()
+        new_connection.recv()  # Wait until it has loaded the rules.
+        self._idle.put(new_connection)
+
+    def analyze(self, target_file=None, original_target_path='', data=None):
+        # Scan in the next free worker process and return its list of YaraMatch
+        connection = self._idle.get()
+        try:
+            connection.send({'target_file': target_file,
+                             'original_target_path': original_target_path, 'data': data})
+            error, matches = connection.recv()
+        except (EOFError, OSError) as broken:  # OSError includes BrokenPipeError.
+            LOGGER.error('YARA worker process died (%r), starting a new one', broken)
+            self._replace_worker(connection)
+            raise RuntimeError('YARA scan failed: the worker process died')
+        self._idle.put(connection)
+        if error:
+            raise RuntimeError('YARA scan failed in worker process: {}'.format(error))
+        return matches
+
+    def close(self):
+        # Stop the worker processes
+        for connection, process in self._processes.items():
+            connection.send(None)
+            process.join()
+        self._processes = {}
 
 class BinaryInfo(object):
     # Organizes the analysis of a single binary blob in S3.
 
-    def __init__(self, bucket_name, object_key, yara_analyzer):
+    def __init__(self, bucket_name, object_key, yara_analyzer,
+                 in_memory_limit=IN_MEMORY_SCAN_LIMIT, verdict_cache=None, size=None, etag=None,
+                 scanners=()):
         self.bucket_name = bucket_name
         self.object_key = object_key
         self.s3_identifier = 'S3:{}:{}'.format(bucket_name, object_key)
 
         self.download_path = '/tmp/s3canner_{}'.format(str(uuid.uuid4()))
         self.yara_analyzer = yara_analyzer
+        self.in_memory_limit = in_memory_limit
+        self.data = None  # Object contents, if small enough to be scanned from memory.
+        self.verdict_cache = verdict_cache  # Clean verdicts from earlier scans (None to disable).
+        self.scanners = scanners  # (name, analyzer) run after YARA over the same bytes.
 
         # Computed after file download and analysis.
-        self.download_time_ms = 0
+        self.downloaded = False
+        self.cache_hit = None  # 'ETag' or 'SHA256' if a cached clean verdict was reused.
+        self.skipped_file_class = None  # File class with no applicable rules (not downloaded).
+        # Known up front when the S3 listing (via the dispatcher payload) provided them.
+        self.etag = etag  # Replaced by the ETag of the GET once downloaded.
+        self.size_bytes = size or 0
+        self.download_time_ms = 0  # Includes hash_time_ms: hashes are computed while downloading.
+        self.hash_time_ms = self.scan_time_ms = 0  # scan_time_ms is the YARA scan only.
+        self.scanner_time_ms = {}  # Scanner name => scan time, for each of the extra scanners.
         self.reported_md5 = self.observed_path = ''
         self.computed_sha = self.computed_md5 = None
-        self.yara_matches = []  # List of yara.Match objects.
+        self.scanned = False
+        self.yara_matches = []  # List of yara.Match (or YaraMatch) objects.
+        self.findings = {}  # Scanner name => its matches, for each of the extra scanners.
 
     @property
     def matched_rule_ids(self):
         # A list of 'yara_file:rule_name' for each YARA match
         return ['{}:{}'.format(match.namespace, match.rule) for match in self.yara_matches]
 
+    @property
+    def has_findings(self):
+        # True if YARA or any of the extra scanners matched
+        return bool(self.yara_matches) or any(self.findings.values())
+
+    def for_scanner(self, name):
+        # A copy of this binary with the matches of an extra scanner in place of the YARA ones,
+        # to be saved and alerted on (see save_matches_and_alert_batch) like YARA matches
+        view = copy.copy(self)
+        view.yara_matches = self.findings.get(name, [])
+        return view
+
     def __str__(self):
         # Use the S3 identifier as the string representation of the binary
         return self.s3_identifier
 
     def __enter__(self):
-        # Download the binary from S3 and run YARA analysis
-        self._download_from_s3()
-        self.computed_sha, self.computed_md5 = compute_hashes(self.download_path)
+        # Download the binary from S3 and run YARA analysis (unless they ran during prefetch)
+        if not self.downloaded:
+            self.download()
+        if not self.scanned:
+            self.scan()
+        return self
+
+    def scan(self):
+        # Run YARA analysis on the downloaded binary, unless it is known to be clean
+        if (self.cache_hit is None and self.verdict_cache is not None and
+                self.verdict_cache.is_clean(
+                    verdict_cache.sha_key(self.computed_sha, self.observed_path))):
+            self.cache_hit = 'SHA256'
+        if self.cache_hit:
+            LOGGER.info('%s was already scanned clean (by %s), skipping YARA analysis',
+                        self, self.cache_hit)
+            self.scanned = True
+            return self
 
         LOGGER.debug('Running YARA analysis')
+        start_time = time.time()
         self.yara_matches = self.yara_analyzer.analyze(
-            self.download_path, original_target_path=self.observed_path)
+            self.download_path, original_target_path=self.observed_path, data=self.data)
+        self.scan_time_ms = (time.time() - start_time) * 1000
+
+        for name, analyzer in self.scanners:
+            start_time = time.time()
+            self.findings[name] = analyzer.analyze(
+                self.download_path, original_target_path=self.observed_path, data=self.data)
+            self.scanner_time_ms[name] = (time.time() - start_time) * 1000
 
+        if self.verdict_cache is not None and not self.has_findings:
+            self.verdict_cache.mark_clean(self._verdict_keys())
+
+        self.scanned = True
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        # Remove the downloaded binary from local disk
+        self.cleanup()
+
+    def cleanup(self):
+        # Release the in-memory copy and remove the downloaded binary from local disk
+        self.data = None
         # In Lambda, "os.remove" does not actually remove the file as expected.
         # Thus, we first truncate the file to set its size to 0 before removing it.
         if os.path.isfile(self.download_path):
@@ -116,30 +405,92 @@ class BinaryInfo(object):
                 file.truncate()
             os.remove(self.download_path)
 
+    @property
+    def download_skipped(self):
+        # True if the object never had to be downloaded
+        return self.cache_hit == 'ETag' or self.skipped_file_class is not None
+
+    def _verdict_keys(self):
+        # Keys under which a clean verdict for this binary is cached
+        # The ETag is the one returned with the downloaded contents, not the listed one.
+        keys = [verdict_cache.sha_key(self.computed_sha, self.observed_path)]
+        if self.etag:
+            keys.append(verdict_cache.etag_key(
+                self.bucket_name, self.object_key, self.etag, self.size_bytes))
+        return keys
+
+    def _check_etag_cache(self):
+        # Return True if this exact object version was already scanned clean.
+        # The ETag and size come from the listing if available, otherwise from a HEAD request.
+        s3_metadata = {}
+        if not self.etag:
+            self.etag, self.size_bytes, s3_metadata = aws_lib.head_s3_object(
+                self.bucket_name, self.object_key)
+        if not self.verdict_cache.is_clean(verdict_cache.etag_key(
+                self.bucket_name, self.object_key, self.etag, self.size_bytes)):
+            return False
+
+        self.cache_hit = 'ETag'
+        self.reported_md5 = s3_metadata.get('reported_md5', '')
+        self.observed_path = s3_metadata.get('observed_path', '')
+        return True
+
+    def _check_file_class(self):
+        # Fetch only the header and return True if no YARA rules apply to the object's format
+        skippable = self.yara_analyzer.classes_without_rules
+        if not skippable or self.scanners:  # The extra scanners apply to every format.
+            return False
+        try:
+            header = aws_lib.download_s3_range(
+                self.bucket_name, self.object_key, 0, FILE_HEADER_BYTES - 1)
+        except BotoError:  # E.g. an empty object has no valid byte range.
+            return False
+
+        file_class = sniff_file_class(header)
+        if file_class not in skippable:
+            return False
+        self.skipped_file_class = file_class
+        return True
+
+    def download(self):
+        # Download and hash the binary without scanning it (safe to run in a prefetch thread)
+        if self.verdict_cache is not None and self._check_etag_cache():
+            # Unchanged since it was last scanned clean: no need to download it at all.
+            self.downloaded = True
+            return self
+        if self._check_file_class():
+            LOGGER.info('No YARA rules apply to %s files, skipping %s',
+                        self.skipped_file_class, self)
+            self.downloaded = self.scanned = True
+            return self
+
+        self._download_from_s3()
+        self.size_bytes = (len(self.data) if self.data is not None
+                           else os.path.getsize(self.download_path))
+        self.downloaded = True
+        return self
+
     def _download_from_s3(self):
-        # Download binary from S3 and measure elapsed time
-        LOGGER.debug('Downloading to %s', self.download_path)
+        # Download binary from S3, computing its hashes in the same pass, and measure elapsed time
+        LOGGER.debug('Downloading to %s (in memory if <= %d bytes)',
+                     self.download_path, self.in_memory_limit)
+
+        # The MD5 is only included to be compatible with other security tools.
+        sha = hashlib.sha256()
+        md5 = hashlib.md5()
+        digests = _TimedDigests(sha, md5)
 
         start_time = time.time()
-        s3_metadata = aws_lib.download_from_s3(
-            self.bucket_name, self.object_key, self.download_path)
+        s3_metadata, self.data, self.etag = aws_lib.download_from_s3(
+            self.bucket_name, self.object_key, self.download_path, digests=(digests,),
+            in_memory_limit=self.in_memory_limit)
         self.download_time_ms = (time.time() - start_time) * 1000
+        self.hash_time_ms = digests.elapsed_ms
+        self.computed_sha, self.computed_md5 = sha.hexdigest(), md5.hexdigest()
 
         self.reported_md5 = s3_metadata.get('reported_md5', '')
         self.observed_path = s3_metadata.get('observed_path', '')
 
-    def save_matches_and_alert(self, lambda_version, dynamo_table_name, sns_topic_arn):
-        # Save match results to Dynamo and publish an alert to SNS if appropriate.
-        table = aws_lib.DynamoMatchTable(dynamo_table_name)
-        needs_alert = table.save_matches(self, lambda_version)
-
-        LOGGER.info(needs_alert)
-        LOGGER.info('We should publish the sns alert now')
-        # Send alert if appropriate.
-        if needs_alert:
-            LOGGER.info('Publishing an SNS alert')
-            aws_lib.publish_alert_to_sns(self, sns_topic_arn)
-
     def summary(self):
         # Generate a summary dictionary of binary attributes
         return {
@@ -164,13 +515,313 @@ class BinaryInfo(object):
         }
 
 
-def analyze_lambda_handler(event_data, lambda_context):
+def save_matches_and_alert_batch(binaries, lambda_version, dynamo_table_name, sns_topic_arn,
+                                 metrics=None):
+    # Save the match results of several binaries to Dynamo in bulk, then publish the SNS alerts
+    # with batched, coalesced publishing.
+    metrics = metrics or telemetry.MetricsLogger()
+    table = aws_lib.DynamoMatchTable(dynamo_table_name)
+    with metrics.timer('DynamoSaveLatency'):
+        if MATCH_SAVE_MODE == 'upsert':
+            alerts = [table.upsert_matches(binary, lambda_version) for binary in binaries]
+        else:
+            alerts = table.save_matches_batch(binaries, lambda_version)
+
+    aggregator = aws_lib.SNSAlertAggregator(
+        sns_topic_arn, ALERT_DIGEST_WINDOW_SECONDS, _LAST_FULL_ALERTS)
+    for binary, needs_alert in zip(binaries, alerts):
+        if needs_alert:
+            LOGGER.info('Queueing an SNS alert for %s', binary)
+            aggregator.add(binary)
+    metrics.put_metric('AlertsPublished', len(aggregator))
+    with metrics.timer('SNSPublishLatency'):
+        aggregator.flush()
+
+
+def record_metrics(metrics, num_yara_rules, binaries):
+    """Record the invocation's analysis metrics, including per-object stage timings.
+
+    Args:
+        metrics: [telemetry.MetricsLogger] Where the values are recorded.
+        num_yara_rules: [int] Number of YARA rules in the analyzer.
+        binaries: [list of BinaryInfo()] List of analyzed BinaryInfo()s.
+    """
+    metrics.put_metric('AnalyzedBinaries', len(binaries))
+    metrics.put_metric('MatchedBinaries', sum(1 for b in binaries if b.yara_matches))
+    for name in sorted(set(name for b in binaries for name in b.findings)):
+        metrics.put_metric('{}MatchedBinaries'.format(name.capitalize()),
+                           sum(1 for b in binaries if b.findings.get(name)))
+    metrics.put_metric('CachedVerdicts', sum(1 for b in binaries if b.cache_hit))
+    metrics.put_metric('YaraRules', num_yara_rules)
+
+    for binary in binaries:
+        if binary.computed_sha is not None:  # Downloaded (and hashed) by this invocation.
+            metrics.put_metric('S3DownloadLatency', binary.download_time_ms, 'Milliseconds')
+            metrics.put_metric('HashLatency', binary.hash_time_ms, 'Milliseconds')
+            metrics.put_metric('DownloadedBytes', binary.size_bytes, 'Bytes')
+            if binary.download_time_ms > 0:
+                metrics.put_metric('S3DownloadThroughput',
+                                   binary.size_bytes / (binary.download_time_ms / 1000),
+                                   'Bytes/Second')
+        if binary.scan_time_ms:
+            metrics.put_metric('YaraScanLatency', binary.scan_time_ms, 'Milliseconds')
+            if binary.size_bytes:
+                metrics.put_metric('YaraScanThroughput',
+                                   binary.size_bytes / (binary.scan_time_ms / 1000),
+                                   'Bytes/Second')
+        for name, time_ms in sorted(binary.scanner_time_ms.items()):
+            metrics.put_metric('{}ScanLatency'.format(name.capitalize()), time_ms, 'Milliseconds')
+
+
+# Rule ID -> time of its last full SNS alert, kept for the lifetime of the container.
+_LAST_FULL_ALERTS = {}
+
+
+# The analyzer is loaded once per container and reused by warm invocations.
+_ANALYZER = None
+
+
+def _get_analyzer():
+    # Return the container-wide YaraAnalyzer, loading the compiled rules on first use
+    global _ANALYZER
+    if _ANALYZER is None:
+        _ANALYZER = YaraAnalyzer(COMPILED_RULES_FILEPATH)
+        LOGGER.info('Loaded %d YARA rules (fingerprint %s)',
+                    _ANALYZER.num_rules, _ANALYZER.fingerprint)
+    return _ANALYZER
+
+
+# Extra scanners (see EXTRA_SCANNERS) are also created once per container.
+_EXTRA_SCANNERS = {}
+
+
+def _get_extra_scanners(names):
+    # Return the (name, analyzer) pairs of the given extra scanners, creating them on first use
+    for name in names:
+        if name not in _EXTRA_SCANNERS:
+            _EXTRA_SCANNERS[name] = EXTRA_SCANNERS[name][0]()
+            LOGGER.info('Loaded the %s scanner', name)
+    return [(name, _EXTRA_SCANNERS[name]) for name in names]
+
+
+# Like the analyzer, the scanning processes are started once per container.
+_SCAN_POOL = None
+
+
+def _get_scan_pool():
+    # Return the container-wide YaraProcessPool, starting the workers on first use
+    global _SCAN_POOL
+    if _SCAN_POOL is None:
+        LOGGER.info('Starting %d YARA scanning processes', SCAN_WORKERS)
+        _SCAN_POOL = YaraProcessPool(COMPILED_RULES_FILEPATH, SCAN_WORKERS)
+    return _SCAN_POOL
+
+
+class S3Prefetcher(object):
+    """Downloads upcoming binaries in background threads while the current one is being scanned.
+
+    At most `depth` downloads are in flight or waiting at once, and no new download is started
+    while the binaries not yet handed out hold (or are about to hold) `max_bytes` or more.
+    Binaries are yielded in their original order, already downloaded and hashed (and scanned,
+    if `scan` is set).
+    Anything left unconsumed (e.g. after an exception) is cleaned up when the context exits:
+    downloads which have not started are cancelled, and those still running are abandoned (not
+    waited for, so an early exit stays within the deadline) and cleaned up once they finish.
+    """
+
+    def __init__(self, binaries, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_BYTES, scan=False):
+        self._binaries = binaries
+        self._depth = max(1, depth)
+        self._max_bytes = max_bytes
+        self._scan = scan  # Also run YARA in the background (with a YaraProcessPool analyzer).
+        self._executor = None
+        self._pending = collections.deque()  # (BinaryInfo, Future) in download order.
+
+    def __enter__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._depth)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        # Drop any downloads which were never handed out.
+        while self._pending:
+            binary, future = self._pending.popleft()
+            if future.cancel():
+                binary.cleanup()
+            else:
+                # Still running: remove the file or buffer once the download is done.
+                future.add_done_callback(lambda _, binary=binary: binary.cleanup())
+        self._executor.shutdown(wait=False)
+
+    def _prepare(self, binary):
+        # Runs in a background thread.
+        binary.download()
+        if self._scan:
+            binary.scan()
+
+    def _buffered_bytes(self):
+        # Bytes held by downloads which have not been handed out yet. Sizes are known up front
+        # when they came with the payload, otherwise once the download has finished.
+        return sum(binary.size_bytes for binary, future in self._pending
+                   if not binary.download_skipped and not (future.done() and future.exception()))
+
+    def _is_full(self):
+        return (len(self._pending) >= self._depth or
+                self._buffered_bytes() >= self._max_bytes)
+
+    def _next_downloaded(self):
+        # Wait for the oldest download to finish; download errors are raised here.
+        binary, future = self._pending.popleft()
+        try:
+            future.result()
+        except Exception:
+            binary.cleanup()
+            raise
+        return binary
+
+    def __iter__(self):
+        for binary in self._binaries:
+            while self._pending and self._is_full():
+                yield self._next_downloaded()
+            self._pending.append((binary, self._executor.submit(self._prepare, binary)))
+
+        while self._pending:
+            yield self._next_downloaded()
+
+
+def _sqs_message_groups(event_data):
+    """Pair SQS receipts with the S3 keys their messages carried.
+
+    Returns:
+        [list] of 2-tuples ([list] receipts, [list] S3 keys). Each receipt is its own group when
+        the dispatcher sent 'SQSKeyCounts'; older payloads come back as a single group.
+    """
+    receipts, keys = event_data['SQSReceipts'], event_data['S3Objects']
+    if 'SQSKeyCounts' not in event_data:
+        return [(receipts, keys)]
+
+    groups, start = [], 0
+    for receipt, count in zip(receipts, event_data['SQSKeyCounts']):
+        groups.append(([receipt], keys[start:start + count]))
+        start += count
+    return groups
+
+
+class SQSMessageTracker(object):
+    """Tracks which S3 keys each SQS message carried and deletes every message once it is done.
+
+    A receipt is deleted as soon as all of its keys have been analyzed, so a failure later in the
+    batch only causes redelivery of the messages which were actually left unfinished.
+    """
+
+    def __init__(self, queue_url, event_data):
+        self._queue_url = queue_url
+        self._groups = _sqs_message_groups(event_data)
+        # The size and ETag of each key, to re-enqueue it as it came in.
+        num_keys = len(event_data['S3Objects'])
+        self._objects = {
+            key: {'key': key, 'size': size, 'eTag': etag}
+            for key, size, etag in zip(event_data['S3Objects'],
+                                       event_data.get('S3ObjectSizes') or [None] * num_keys,
+                                       event_data.get('S3ObjectETags') or [None] * num_keys)}
+        self._remaining = [set(keys) for _, keys in self._groups]  # Keys still to be analyzed.
+        self._deleted = [False] * len(self._groups)
+
+    def _delete(self, indices):
+        receipts = [receipt for index in indices for receipt in self._groups[index][0]]
+        try:
+            if receipts:
+                aws_lib.delete_sqs_messages(self._queue_url, receipts)
+        except BotoError:
+            # Not fatal: the messages are tried again by finish() or redelivered later.
+            LOGGER.exception('Error deleting SQS receipts')
+            return
+        for index in indices:
+            self._deleted[index] = True
+
+    def key_done(self, key):
+        """Record an analyzed key and delete any messages which are now complete."""
+        completed = []
+        for index, remaining in enumerate(self._remaining):
+            if key in remaining:
+                remaining.discard(key)
+                if not remaining and not self._deleted[index]:
+                    completed.append(index)
+        if completed:
+            self._delete(completed)
+
+    def finish(self):
+        """Delete the remaining complete messages and re-enqueue keys which were not analyzed.
+
+        Messages with unfinished keys are only deleted once those keys were re-enqueued as new
+        messages; otherwise they are left to be redelivered after the visibility timeout.
+        """
+        completed, unfinished = [], []
+        for index, remaining in enumerate(self._remaining):
+            if self._deleted[index]:
+                continue
+            (unfinished if remaining else completed).append(index)
+
+        if unfinished:
+            # Keep the original key order within each message.
+            object_groups = [[self._objects[key] for key in self._groups[index][1]
+                              if key in self._remaining[index]] for index in unfinished]
+            LOGGER.warning('Re-enqueueing %d unfinished key(s)', sum(map(len, object_groups)))
+            try:
+                failed = aws_lib.enqueue_s3_objects(self._queue_url, object_groups)
+            except BotoError:
+                LOGGER.exception('Unable to re-enqueue unfinished keys')
+                failed = set(range(len(unfinished)))
+            completed.extend(index for position, index in enumerate(unfinished)
+                             if position not in failed)
+
+        if completed:
+            self._delete(completed)
+
+
+def _save_matched_binaries(matched_binaries, scanners, lambda_version, metrics, sqs_messages):
+    # Save the matches of each scanner to its own Dynamo table and SNS topic; the keys of the
+    # matched binaries are only done once they are saved.
+    yara_matched = [binary for binary in matched_binaries if binary.yara_matches]
+    if yara_matched:
+        save_matches_and_alert_batch(
+            yara_matched, lambda_version, os.environ['YARA_MATCHES_DYNAMO_TABLE_NAME'],
+            os.environ['YARA_ALERTS_SNS_TOPIC_ARN'], metrics)
+    for name, _ in scanners:
+        found = [binary.for_scanner(name)
+                 for binary in matched_binaries if binary.findings.get(name)]
+        if found:
+            _, table_env, topic_env = EXTRA_SCANNERS[name]
+            save_matches_and_alert_batch(
+                found, lambda_version, os.environ[table_env], os.environ[topic_env], metrics)
+    for binary in matched_binaries:
+        sqs_messages.key_done(binary.object_key)
+
+
+def analyze_lambda_handler(event_data, lambda_context, scanner_names=()):
     result = {}
     binaries = []  # List of the BinaryInfo data.
-
-    # Build the analyzer calss out of the rules binary
-    ANALYZER = YaraAnalyzer(COMPILED_RULES_FILEPATH)
+    matched_binaries = []  # Saved to Dynamo together once scanning is done.
+    metrics = telemetry.MetricsLogger()
+    sqs_messages = SQSMessageTracker(
+        event_data.get('SQSQueueUrl') or os.environ['SQS_QUEUE_URL'], event_data)
+
+    # With several scanning processes, objects are downloaded and scanned in the background and
+    # only the Dynamo/SNS work happens in order here. Otherwise, upcoming objects are downloaded
+    # in the background while YARA scans the current one.
+    # Either way, the rules are only loaded on a cold start (in the workers, if there are some).
+    parallel_scan = SCAN_WORKERS > 1
+    ANALYZER = _get_scan_pool() if parallel_scan else _get_analyzer()
     NUM_YARA_RULES = ANALYZER.num_rules
+    scanners = _get_extra_scanners(scanner_names)
+
+    # Clean verdicts from earlier scans with the same rules let us skip unchanged objects.
+    # With extra scanners, a verdict is only clean for the same combination of scanners.
+    cache = None
+    if os.environ.get('VERDICT_CACHE_DYNAMO_TABLE_NAME'):
+        fingerprint = scan_fingerprint.combine(
+            ANALYZER.fingerprint, [(name, analyzer.fingerprint) for name, analyzer in scanners])
+        cache = verdict_cache.DynamoVerdictCache(
+            os.environ['VERDICT_CACHE_DYNAMO_TABLE_NAME'], fingerprint)
 
     # The Lambda version must be an integer.
     try:
@@ -179,28 +830,59 @@ def analyze_lambda_handler(event_data, lambda_context):
         lambda_version = -1
 
     LOGGER.info('Processing %d record(s)', len(event_data['S3Objects']))
-    for s3_key in event_data['S3Objects']:
-        LOGGER.info('Analyzing %s', s3_key)
-
-        with BinaryInfo(os.environ['S3_BUCKET_NAME'], s3_key, ANALYZER) as binary:
-            result[binary.s3_identifier] = binary.summary()
-            binaries.append(binary)
-
-            if binary.yara_matches:
-                LOGGER.warning('%s matched YARA rules: %s', binary, binary.matched_rule_ids)
-                binary.save_matches_and_alert(
-                    lambda_version, os.environ['YARA_MATCHES_DYNAMO_TABLE_NAME'],
-                    os.environ['YARA_ALERTS_SNS_TOPIC_ARN'])
-            else:
-                LOGGER.info('%s did not match any YARA rules', binary)
-
-    # Delete all of the SQS receipts (mark them as completed).
-    aws_lib.delete_sqs_messages(os.environ['SQS_QUEUE_URL'], event_data['SQSReceipts'])
-
-    # Publish metrics.
+    num_keys = len(event_data['S3Objects'])
+    sizes = event_data.get('S3ObjectSizes') or [None] * num_keys
+    etags = event_data.get('S3ObjectETags') or [None] * num_keys
+    to_analyze = [BinaryInfo(os.environ['S3_BUCKET_NAME'], s3_key, ANALYZER, verdict_cache=cache,
+                             size=size, etag=etag, scanners=scanners)
+                  for s3_key, size, etag in zip(event_data['S3Objects'], sizes, etags)]
+
+    # The matches are saved together after the loop, even if it fails part way (e.g. an object
+    # vanished), so the matches already found are never lost.
     try:
-        aws_lib.put_metric_data(NUM_YARA_RULES, binaries)
-    except BotoError:
-        LOGGER.exception('Error saving metric data')
+        with S3Prefetcher(to_analyze, depth=max(PREFETCH_DEPTH, SCAN_WORKERS),
+                          scan=parallel_scan) as prefetcher:
+            for binary in prefetcher:
+                # Like the batcher, stop while there is still time to hand off the remaining work.
+                if lambda_context.get_remaining_time_in_millis() < DEADLINE_MARGIN_MS:
+                    LOGGER.warning('Running out of time, stopping before %s', binary.object_key)
+                    binary.cleanup()  # Already downloaded by the prefetcher.
+                    break
+
+                LOGGER.info('Analyzing %s', binary.object_key)
+
+                with binary:
+                    result[binary.s3_identifier] = binary.summary()
+                    binaries.append(binary)
+
+                    if binary.yara_matches:
+                        LOGGER.warning('%s matched YARA rules: %s',
+                                       binary, binary.matched_rule_ids)
+                    for name, matches in binary.findings.items():
+                        if matches:
+                            LOGGER.warning('%s has %s findings: %s', binary, name,
+                                           [match.rule for match in matches])
+                    if binary.has_findings:
+                        matched_binaries.append(binary)
+                        continue
+                    LOGGER.info('%s did not match any YARA rules', binary)
+
+                # Delete the SQS message(s) as soon as all of their keys are done.
+                sqs_messages.key_done(binary.object_key)
+    finally:
+        _save_matched_binaries(matched_binaries, scanners, lambda_version, metrics, sqs_messages)
+
+    # Delete the SQS receipts of finished messages and hand off whatever is left.
+    sqs_messages.finish()
+
+    # Publish metrics (as log lines, no CloudWatch API call needed).
+    record_metrics(metrics, NUM_YARA_RULES, binaries)
+    metrics.flush()
 
     return result
+
+
+def combined_analyze_lambda_handler(event_data, lambda_context):
+    # Entry point running YARA and the COMBINED_SCANNERS (e.g. secrets) over each object, which
+    # is downloaded only once. Each scanner still saves to its own Dynamo table and SNS topic.
+    return analyze_lambda_handler(event_data, lambda_context, scanner_names=COMBINED_SCANNERS)
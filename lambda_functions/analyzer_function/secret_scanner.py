@@ -0,0 +1,77 @@
+"""Detects credentials and private keys in object contents, next to the YARA analysis.
+
+SecretsAnalyzer has the same analyze() signature as YaraAnalyzer, and returns its findings in the
+shape of YARA matches (rule, namespace, tags, meta, strings), so BinaryInfo and the Dynamo/SNS
+code handle them like any other match. The matched bytes themselves are never kept: strings only
+carry the offset and identifier of each finding, so secrets do not end up in Dynamo or alerts.
+"""
+import re
+import json
+import hashlib
+import collections
+
+NAMESPACE = 'secrets'
+MB = 2 ** 20
+
+# Files are scanned in chunks which overlap by more than the longest secret.
+CHUNK_SIZE = 2 * MB
+CHUNK_OVERLAP = 4096
+
+# Finding in the shape of yara.Match (see YaraMatch in main.py).
+SecretMatch = collections.namedtuple(
+    'SecretMatch', ['rule', 'namespace', 'tags', 'meta', 'strings'])
+
+# Rule name => pattern, for secrets with a recognizable format.
+DETECTORS = collections.OrderedDict([
+    ('aws_access_key_id', rb'\b(?:AKIA|ASIA)[0-9A-Z]{16}\b'),
+    ('private_key', rb'-----BEGIN (?:RSA |EC |DSA |OPENSSH |PGP |ENCRYPTED )?PRIVATE KEY'
+                    rb'(?: BLOCK)?-----'),
+    ('github_token', rb'\bgh[pousr]_[A-Za-z0-9]{36}\b'),
+    ('slack_token', rb'\bxox[abposr]-[A-Za-z0-9-]{10,250}'),
+    ('google_api_key', rb'\bAIza[0-9A-Za-z_-]{35}\b'),
+    ('stripe_secret_key', rb'\b[rs]k_live_[0-9A-Za-z]{24,99}\b'),
+])
+
+
+class SecretsAnalyzer(object):
+    # Matches the DETECTORS over a file on disk or an in-memory buffer
+
+    def __init__(self, detectors=DETECTORS):
+        self._detectors = [(name, re.compile(pattern)) for name, pattern in detectors.items()]
+        self.fingerprint = hashlib.sha256(json.dumps(
+            [(name, pattern.decode('latin-1')) for name, pattern in detectors.items()]
+        ).encode('utf-8')).hexdigest()
+
+    @property
+    def num_rules(self):
+        return len(self._detectors)
+
+    @staticmethod
+    def _chunks(target_file, data):
+        # (offset, bytes) pieces of the object, overlapping so no secret is cut in two
+        if data is not None:
+            yield 0, data
+            return
+        with open(target_file, 'rb') as file_object:
+            offset, tail = 0, b''
+            while True:
+                chunk = file_object.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield offset - len(tail), tail + chunk
+                offset += len(chunk)
+                tail = chunk[-CHUNK_OVERLAP:]
+
+    def analyze(self, target_file=None, original_target_path='', data=None):
+        # Same signature as YaraAnalyzer.analyze(): returns one SecretMatch per detected kind
+        offsets = collections.defaultdict(set)  # Rule name => offsets of its findings.
+        for start, chunk in self._chunks(target_file, data):
+            for name, pattern in self._detectors:
+                for match in pattern.finditer(chunk):
+                    offsets[name].add(start + match.start())
+
+        return [
+            SecretMatch(name, NAMESPACE, [], {'Findings': len(offsets[name])},
+                        [(offset, '$' + name, b'') for offset in sorted(offsets[name])])
+            for name, _ in self._detectors if name in offsets
+        ]
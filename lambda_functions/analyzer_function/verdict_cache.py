@@ -0,0 +1,119 @@
+"""Caches clean YARA verdicts so unchanged objects are not downloaded or scanned again."""
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+if __package__:
+    from lambda_functions.shared import aws_clients
+else:
+    import aws_clients
+
+LOGGER = logging.getLogger()
+DEFAULT_TTL_DAYS = 30
+
+
+def etag_key(bucket_name, object_key, etag, size):
+    """Cache key for one S3 object version, available before downloading (HEAD or listing).
+
+    The key is scoped to the object itself: an ETag is not a content hash (e.g. for multipart
+    uploads), so the same ETag on another object says nothing about that object.
+    """
+    return 'ETag:{}/{}:{}:{}'.format(bucket_name, object_key, etag.strip('"'), size)
+
+
+def sha_key(sha, observed_path=''):
+    """Cache key for the binary contents, available after downloading.
+
+    YARA rules may test the external variables derived from the observed path (filename,
+    extension, ...), so the same contents only share a verdict under the same path.
+    """
+    return 'SHA256:{}:{}'.format(
+        sha, hashlib.sha256(observed_path.encode('utf-8')).hexdigest())
+
+
+class DynamoVerdictCache(object):
+    """Remembers which objects were scanned clean with a given set of YARA rules.
+
+    Only clean verdicts are cached: matched binaries always go through the full scan so their
+    Dynamo records and alerts stay exact. Entries are scoped to the rules fingerprint, so a new
+    rule set starts with an empty cache, and expire via Dynamo TTL.
+
+    The table uses a single hash key:
+        CacheKey: [string] '<rules fingerprint>:<etag_key() or sha_key()>'
+
+    Additionally, items have the following attributes:
+        ExpiresAt: [int] Epoch seconds after which Dynamo may delete the item (TTL attribute).
+    """
+    def __init__(self, table_name, rules_fingerprint, ttl_days=DEFAULT_TTL_DAYS):
+        self._table_name = table_name
+        self._fingerprint = rules_fingerprint
+        self._ttl_seconds = ttl_days * 24 * 3600
+        self._client = aws_clients.client('dynamodb')
+
+    def _cache_key(self, key):
+        return '{}:{}'.format(self._fingerprint, key)
+
+    def is_clean(self, key):
+        """Returns True if the key was scanned clean with the current rules."""
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key={'CacheKey': {'S': self._cache_key(key)}},
+            ProjectionExpression='ExpiresAt'
+        ).get('Item')
+        return bool(item) and int(item['ExpiresAt']['N']) > time.time()
+
+    def mark_clean(self, keys, max_attempts=3):
+        """Record a clean verdict under each of the given keys, with a single BatchWriteItem.
+
+        A verdict that could not be written is only a missed cache hit later, so unprocessed
+        items are retried briefly and then dropped with a warning.
+        """
+        expires_at = str(int(time.time()) + self._ttl_seconds)
+        request = {self._table_name: [
+            {'PutRequest': {'Item': {
+                'CacheKey': {'S': self._cache_key(key)},
+                'ExpiresAt': {'N': expires_at}
+            }}} for key in keys]}
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            request = self._client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+            if not request:
+                return
+        LOGGER.warning('%d clean verdict(s) were not cached', len(request[self._table_name]))
+
+
+class SQLiteVerdictCache(object):
+    """Local stand-in for DynamoVerdictCache, backed by a SQLite file (or ':memory:')."""
+
+    def __init__(self, db_path, rules_fingerprint, ttl_days=DEFAULT_TTL_DAYS):
+        self._fingerprint = rules_fingerprint
+        self._ttl_seconds = ttl_days * 24 * 3600
+        # Lookups happen from the prefetch threads, so the connection is shared behind a lock.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts '
+                '(cache_key TEXT PRIMARY KEY, expires_at INTEGER NOT NULL)')
+
+    def _cache_key(self, key):
+        return '{}:{}'.format(self._fingerprint, key)
+
+    def is_clean(self, key):
+        """Returns True if the key was scanned clean with the current rules."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT expires_at FROM verdicts WHERE cache_key = ?',
+                (self._cache_key(key),)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def mark_clean(self, keys):
+        """Record a clean verdict under each of the given keys."""
+        expires_at = int(time.time()) + self._ttl_seconds
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO verdicts (cache_key, expires_at) VALUES (?, ?)',
+                [(self._cache_key(key), expires_at) for key in keys])
@@ -1,167 +1,775 @@
+import io
 import os
+import csv
+import gzip
 import json
-import boto3
+import time
 import logging
-
-from typing import List
-
+import datetime
+import itertools
+import contextlib
+import collections
+import urllib.parse
+import concurrent.futures
+
+from typing import Iterator, List, Optional
+
+if __package__:
+    from lambda_functions.shared import aws_clients, key_messages, scan_fingerprint, telemetry
+else:
+    import aws_clients
+    import key_messages
+    import scan_fingerprint
+    import telemetry
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
 # Clients
-LAMBDA_CLIENT   = boto3.client('lambda')
-S3_CLIENT       = boto3.client('s3')
-SQS_CLIENT      = boto3.client('sqs')
+LAMBDA_CLIENT   = aws_clients.client('lambda')
+S3_CLIENT       = aws_clients.client('s3')
+SQS_CLIENT      = aws_clients.client('sqs')
+
+THIS_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+# Metadata of the compiled YARA rules, added to the batcher package by the build.
+RULES_METADATA_FILE = os.path.join(THIS_DIRECTORY, 'binary_yara_rules.bin.meta.json')
+# Scanners the analyzer runs next to YARA (its COMBINED_SCANNERS): they scope the checkpoints too.
+COMBINED_SCANNERS = [name.strip() for name in
+                     os.environ.get('COMBINED_SCANNERS', 'secrets').split(',') if name.strip()]
+# Incremental scans start this long before the previous scan did, so objects written while it
+# ran (or with skewed timestamps, e.g. multipart uploads) are not missed.
+INCREMENTAL_OVERLAP_SECONDS = int(os.environ.get('INCREMENTAL_OVERLAP_SECONDS', 3600))
+
+# Format of the SQS message bodies (see key_messages): 'legacy', 'compact' or 'compact+gzip'.
+SQS_MESSAGE_FORMAT = os.environ.get('SQS_MESSAGE_FORMAT', key_messages.LEGACY)
+# Compressed messages are packed by projecting their size, so keep a margin below the limit.
+COMPRESSED_FILL_RATIO = 0.95
+
+# Number of send_message_batch calls in flight while the enumerator keeps listing.
+SQS_SEND_CONCURRENCY = int(os.environ.get('SQS_SEND_CONCURRENCY', 4))
+SQS_SEND_MAX_ATTEMPTS = 3  # Attempts for each entry which fails server-side.
+
+# Enqueue pacing (see EnqueueGovernor): the most SQS messages per second a batcher may send
+# (0 disables pacing), and the queue depth at which it pauses (0 derives it from the drain rate).
+ENQUEUE_MAX_RATE = float(os.environ.get('ENQUEUE_MAX_RATE', 0))
+QUEUE_MAX_BACKLOG = int(os.environ.get('QUEUE_MAX_BACKLOG', 0))
+
+INVENTORY_PAGE_SIZE = 1000  # Inventory rows returned per page (like a list_objects_v2 page).
+
+
+def _epoch_seconds(value) -> Optional[float]:
+    # Convert a LastModified datetime or ISO 8601 string (S3 Inventory CSV) to epoch seconds.
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+            tzinfo=datetime.timezone.utc)
+    elif value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def _scan_fingerprint() -> Optional[str]:
+    # Fingerprint of the YARA rules and COMBINED_SCANNERS packaged with the batcher, the same one
+    # the analyzer keys its verdict cache on (None if unavailable).
+    try:
+        with open(RULES_METADATA_FILE) as metadata_file:
+            metadata = json.load(metadata_file)
+    except (IOError, ValueError):
+        return None
+    scanners = metadata.get('ScannerFingerprints', {})
+    if not metadata.get('Fingerprint') or any(name not in scanners for name in COMBINED_SCANNERS):
+        return None
+    return scan_fingerprint.combine(
+        metadata['Fingerprint'], [(name, scanners[name]) for name in COMBINED_SCANNERS])
 
 
 # Encapsulates a single SQS message (which will contain multiple S3 keys)
 class SQSMessage(object):
 
-    def __init__(self, msg_id):
+    def __init__(self, msg_id, message_format: str = key_messages.LEGACY):
         self._id = msg_id
-        self._keys = []
+        self._format = message_format
+        self._objects = []  # S3 object records: {'key': ..., 'size': ..., 'eTag': ...}
+        self.num_bytes = 0  # Total size of the S3 objects in the message.
+        self._body = None  # Encoded message body, cached until the next key is added.
+        self._raw_bytes = key_messages.BODY_OVERHEAD_BYTES  # Upper bound of the raw body size.
+        self._payload_bytes = 0  # Upper bound of the size of the objects in analyzer payloads.
+        # Compressed size / raw size, as measured when the raw body was _measured_bytes long.
+        self._ratio, self._measured_bytes = 1.0, 0
 
     @property
     def num_keys(self) -> int:
         """Returns [int] the number of keys stored in the SQS message so far."""
-        return len(self._keys)
-
-    def add_key(self, key: str) -> None:
-        """Add another S3 key (string) to the message."""
-        self._keys.append(key)
+        return len(self._objects)
+
+    def add_key(self, key: str, size: int = 0, etag: Optional[str] = None) -> None:
+        """Add another S3 key (string), with its size and ETag if known, to the message."""
+        obj = self._object(key, size, etag)
+        self._objects.append(obj)
+        self.num_bytes += size
+        self._raw_bytes += key_messages.object_bytes(obj, self._format)
+        self._payload_bytes += key_messages.payload_bytes(obj)
+        self._body = None
+
+    @staticmethod
+    def _object(key: str, size: int = 0, etag: Optional[str] = None) -> dict:
+        obj = {'key': key, 'size': size}
+        if etag:
+            obj['eTag'] = etag.strip('"')
+        return obj
+
+    def body(self) -> str:
+        """Returns [str] the encoded message body."""
+        if self._body is None:
+            self._body = key_messages.encode(self._objects, self._format)
+        return self._body
+
+    def fits(self, key: str, size: int, etag: Optional[str], max_bytes: int) -> bool:
+        """Whether the key can be added without the message body exceeding max_bytes.
+
+        The message must also still fit in a single analyzer payload once the dispatcher has
+        decoded it (see key_messages.MESSAGE_PAYLOAD_MAX_BYTES), whatever its encoded size.
+        """
+        obj = self._object(key, size, etag)
+        if (self._payload_bytes + key_messages.payload_bytes(obj) >
+                key_messages.MESSAGE_PAYLOAD_MAX_BYTES):
+            return False
+        raw_bytes = self._raw_bytes + key_messages.object_bytes(obj, self._format)
+        if raw_bytes <= max_bytes:
+            return True
+        if self._format != key_messages.COMPACT_GZIP:
+            return False
+
+        # Compressed bodies are much smaller than the raw bound: project their size from the
+        # compression ratio, and measure it again once the projection is out of date.
+        if raw_bytes * self._ratio > max_bytes * COMPRESSED_FILL_RATIO:
+            if self._measured_bytes < 0.9 * self._raw_bytes:
+                self._ratio = len(self.body()) / self._raw_bytes
+                self._measured_bytes = self._raw_bytes
+            return raw_bytes * self._ratio <= max_bytes * COMPRESSED_FILL_RATIO
+        return True
 
     def sqs_entry(self) -> dict:
-        # The message body matches the structure of an S3 added event. This gives all
-        # messages in the SQS the same format and enables the dispatcher to parse them consistently.
-        return {
-            'Id': str(self._id),
-            'MessageBody': json.dumps({
-                'Records': [{'s3': {'object': {'key': key}}} for key in self._keys]
-            })
-        }
+        # The body lists the S3 objects (key, size and eTag) in the configured format, which
+        # the dispatcher decodes along with the S3 added events of the bucket notifications.
+        return {'Id': str(self._id), 'MessageBody': self.body()}
 
     def reset(self) -> None:
         # Remove the stored list of S3 keys
-        self._keys = []
+        self._objects = []
+        self.num_bytes = 0
+        self._body = None
+        self._raw_bytes = key_messages.BODY_OVERHEAD_BYTES
+        self._payload_bytes = 0
+        self._ratio, self._measured_bytes = 1.0, 0
 
 
 # Collect groups of S3 keys and batch them into as few SQS requests as possible
 class SQSBatcher(object):
 
-    def __init__(self, queue_url: str, objects_per_message: int, messages_per_batch: int = 10):
+    def __init__(self, queue_url: str, objects_per_message: int, messages_per_batch: int = 10,
+                 bytes_per_message: int = 0, max_in_flight: int = SQS_SEND_CONCURRENCY,
+                 message_format: str = SQS_MESSAGE_FORMAT,
+                 governor: Optional['EnqueueGovernor'] = None, deadline: float = float('inf')):
         # Note that the downstream analyzer Lambdas will each process at most
         #(objects_per_message * messages_per_batch) binaries. The analyzer runtime limit is the
         # ultimate constraint on the size of each batch.
+        # A message is also considered full once its objects add up to bytes_per_message
+        # (if nonzero), so a few large objects do not end up in the same analyzer invocation.
+        # Messages, and the batch request as a whole, are also kept within the SQS size limit.
+        # With a governor, each batch waits for its messages to be allowed (until the deadline).
         self._queue_url = queue_url
         self._objects_per_message = objects_per_message
+        self._bytes_per_message = bytes_per_message
         self._messages_per_batch = messages_per_batch
 
-        self._messages = [SQSMessage(i) for i in range(messages_per_batch)]
+        self._messages = [SQSMessage(i, message_format) for i in range(messages_per_batch)]
         self._msg_index = 0  # The index of the SQS message where keys are currently being added.
+        self._batch_bytes = 0  # Size of the message bodies before _msg_index.
 
         # The first and last keys added to this batch.
         self._first_key = None
         self._last_key = None
 
-    # Group keys into messages and make a single batch request.
-    def _send_batch(self) -> None:
-        LOGGER.info('Sending SQS batch of %d keys: %s ... %s',
-                    sum(msg.num_keys for msg in self._messages), self._first_key, self._last_key)
-        response = SQS_CLIENT.send_message_batch(
-            QueueUrl=self._queue_url,
-            Entries=[msg.sqs_entry() for msg in self._messages if msg.num_keys > 0]
-        )
+        # Full batches are sent in the background, with at most max_in_flight requests at once.
+        self._max_in_flight = max(max_in_flight, 1)
+        self._executor = None
+        self._in_flight = collections.deque()  # Futures of the batches being sent.
+        self.failures = 0  # Number of messages which could not be enqueued.
+
+        self._governor = governor
+        self._deadline = deadline  # Epoch seconds after which the governor is not waited for.
+        self.saturated = False  # True once the governor could not allow a batch in time.
+
+    def _send_entries(self, entries: List[dict]) -> int:
+        # Send a batch of message entries, retrying the ones which fail server-side.
+        # Returns the number of entries which could not be enqueued.
+        failures = []  # Sender faults of every attempt, then the last server-side failures.
+        for attempt in range(SQS_SEND_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            response = SQS_CLIENT.send_message_batch(QueueUrl=self._queue_url, Entries=entries)
+            failed = response.get('Failed', [])
+            failures.extend(failure for failure in failed if failure.get('SenderFault'))
+            retryable = {failure['Id'] for failure in failed if not failure.get('SenderFault')}
+            entries = [entry for entry in entries if entry['Id'] in retryable]
+            if not entries:
+                break
+        else:
+            failures.extend(failure for failure in failed if not failure.get('SenderFault'))
 
-        failures = response.get('Failed', [])
         if failures:
             for failure in failures:
-                LOGGER.error('Unable to enqueue S3 key %s: %s',
-                             self._messages[int(failure['Id'])], failure['Message'])
-            boto3.client('cloudwatch').put_metric_data(Namespace='BinaryAlert', MetricData=[{
-                'MetricName': 'BatchEnqueueFailures',
-                'Value': len(failures),
-                'Unit': 'Count'
-            }])
+                LOGGER.error('Unable to enqueue SQS message %s: %s',
+                             failure['Id'], failure['Message'])
+            telemetry.MetricsLogger().put_metric('BatchEnqueueFailures', len(failures)).flush()
+        return len(failures)
+
+    # Group keys into messages and hand them to the background sender as a single batch request.
+    def _send_batch(self) -> None:
+        LOGGER.info('Sending SQS batch of %d keys: %s ... %s',
+                    sum(msg.num_keys for msg in self._messages), self._first_key, self._last_key)
+        entries = [msg.sqs_entry() for msg in self._messages if msg.num_keys > 0]
+
+        # The keys of this batch were already listed, so it is sent even if the queue is
+        # saturated: the caller stops listing instead (see saturated).
+        if self._governor is not None and not self._governor.acquire(len(entries), self._deadline):
+            self._governor.consume(len(entries))
+            self.saturated = True
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_in_flight)
+        # Keep listing while earlier batches are sent, but never queue up more than the limit.
+        while len(self._in_flight) >= self._max_in_flight:
+            self.failures += self._in_flight.popleft().result()
+        self._in_flight.append(self._executor.submit(self._send_entries, entries))
 
         for msg in self._messages:
             msg.reset()
         self._first_key = None
+        self._batch_bytes = 0
+
+    def _is_full(self, msg: SQSMessage) -> bool:
+        # A message is full when it reaches either the key count or the byte budget.
+        return (msg.num_keys >= self._objects_per_message or
+                (self._bytes_per_message > 0 and msg.num_bytes >= self._bytes_per_message))
 
-    def add_key(self, key) -> None:
+    def add_key(self, key, size: int = 0, etag: Optional[str] = None) -> None:
         # Add a new S3 key [string] to the message batch and send to SQS if necessary.
         if not self._first_key:
             self._first_key = key
         self._last_key = key
 
         msg = self._messages[self._msg_index]
-        msg.add_key(key)
+        # Start a new message rather than push a nonempty one over its byte budget
+        # or over the SQS size limit.
+        if msg.num_keys > 0 and (
+                (self._bytes_per_message > 0 and
+                 msg.num_bytes + size > self._bytes_per_message) or
+                not msg.fits(key, size, etag, self._max_message_bytes())):
+            self._next_message()
+            msg = self._messages[self._msg_index]
+        # The size limit also applies to the whole batch request: send it early if it is full.
+        if (msg.num_keys == 0 and self._msg_index > 0 and
+                not msg.fits(key, size, etag, self._max_message_bytes())):
+            self._send_batch()
+            self._msg_index = 0
+            msg = self._messages[self._msg_index]
+        msg.add_key(key, size, etag)
 
         # If the current message is full, move to the next one.
-        if msg.num_keys == self._objects_per_message:
-            self._msg_index += 1
-
-            # If all of the messages are full, fire off to SQS.
-            if self._msg_index == self._messages_per_batch:
-                self._send_batch()
-                self._msg_index = 0
+        if self._is_full(msg):
+            self._next_message()
+
+    def _max_message_bytes(self) -> int:
+        # Room left for the current message within the SQS size limits.
+        return min(key_messages.SQS_MAX_BYTES,
+                   key_messages.SQS_MAX_BYTES - self._batch_bytes)
+
+    def _next_message(self) -> None:
+        # Move on to the next message, sending the batch to SQS once all messages are used.
+        message_bytes = len(self._messages[self._msg_index].body())
+        self._batch_bytes += message_bytes
+        self._msg_index += 1
+
+        # If all of the messages are full (or the next one would have little room), fire off to SQS.
+        if (self._msg_index == self._messages_per_batch or
+                key_messages.SQS_MAX_BYTES - self._batch_bytes < message_bytes):
+            self._send_batch()
+            self._msg_index = 0
 
     def flash(self) -> None:
-        """After all messages have been added, send the remaining as a last batch to SQS."""
+        """After all messages have been added, send the remaining as a last batch to SQS.
+
+        Waits until every batch has been sent, so the keys are in SQS when this returns.
+        """
         if self._first_key:
             LOGGER.info('flash: sending last batch of keys')
             self._send_batch()
 
+        while self._in_flight:
+            self.failures += self._in_flight.popleft().result()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
 
-# Enumerates all of the S3 objects in a given bucket.
+# Enumerates all of the S3 objects in a given bucket (or in one partition of it).
 class S3BucketEnumerator(object):
-    def __init__(self, bucket_name, continuation_token=None):
+    def __init__(self, bucket_name, continuation_token=None, partition: Optional[dict] = None,
+                 start_after: Optional[str] = None):
         self.bucket_name: str = bucket_name
         self.continuation_token: str = continuation_token
+        # Optional 'Prefix', 'Delimiter', 'StartAfter' (exclusive) and 'EndAt' (inclusive).
+        self.partition: dict = partition or {}
+        # Last key enqueued, when the listing stopped part way through a page (see resume_from).
+        self.start_after: Optional[str] = start_after
+        self.snapshot_time = None  # The listing is live rather than a snapshot.
         self.finished = False  # Have we finished enumerating all of the S3 bucket?
-
-    def next_page(self) -> List[str]:
-        # Get the next page of S3 objects.
-        if self.continuation_token:
-            response = S3_CLIENT.list_objects_v2(
-                Bucket=self.bucket_name, ContinuationToken=self.continuation_token)
+        self._page_start = (continuation_token, start_after)  # Where the last page was listed.
+        self._page_keys = []
+
+    def resume_payload(self) -> dict:
+        # Event for the next batcher to pick up where this enumerator stopped.
+        payload = {'S3ContinuationToken': self.continuation_token}
+        if self.start_after:
+            payload['S3StartAfter'] = self.start_after
+        if self.partition:
+            payload['S3Partition'] = self.partition
+        return payload
+
+    def resume_from(self, index: int) -> None:
+        # The objects of the last page from index on were not enqueued: list them again.
+        if index:
+            self.continuation_token, self.start_after = None, self._page_keys[index - 1]
         else:
-            response = S3_CLIENT.list_objects_v2(Bucket=self.bucket_name)
+            self.continuation_token, self.start_after = self._page_start
+        self.finished = False
+
+    def next_page(self) -> List[dict]:
+        # Get the next page of S3 objects: [{'Key', 'Size', 'ETag', 'LastModified'}, ...]
+        kwargs = {'Bucket': self.bucket_name}
+        for name in ('Prefix', 'Delimiter', 'StartAfter'):
+            if self.partition.get(name):
+                kwargs[name] = self.partition[name]
+        if self.start_after:
+            kwargs['StartAfter'] = self.start_after  # Always past the partition's StartAfter.
+        if self.continuation_token:
+            kwargs['ContinuationToken'] = self.continuation_token
+        self._page_start = (self.continuation_token, self.start_after)
+        response = S3_CLIENT.list_objects_v2(**kwargs)
 
         self.continuation_token = response.get('NextContinuationToken')
         if not response['IsTruncated']:
             self.finished = True
 
-        return [obj['Key'] for obj in response['Contents']]
+        objects = [{'Key': obj['Key'], 'Size': obj['Size'], 'ETag': obj['ETag'],
+                    'LastModified': _epoch_seconds(obj.get('LastModified'))}
+                   for obj in response.get('Contents', [])]
+        # Keys are listed in order, so the partition ends at the first key past its last one.
+        end_at = self.partition.get('EndAt')
+        if end_at is not None and objects and objects[-1]['Key'] > end_at:
+            objects = [obj for obj in objects if obj['Key'] <= end_at]
+            self.finished = True
+        self._page_keys = [obj['Key'] for obj in objects]
+        return objects
+
+
+# Enumerates the S3 objects listed in an S3 Inventory report instead of listing the bucket.
+class S3InventoryEnumerator(object):
+    """Reads an S3 Inventory manifest and its CSV.gz data files, page by page.
+
+    Only CSV reports are supported (configure the inventory with the CSV output format). Data
+    files are streamed and never held in memory whole: they are decompressed and parsed as they
+    are read. The position (data file index and row offset within it) lets the next batcher resume
+    where this one stopped. Only current versions which are not delete markers are returned.
+
+    Manifests and data files are read from S3 ('s3://bucket/key') or, e.g. for testing, from
+    local paths; local data file keys are relative to data_root (default: the manifest folder).
+    """
+    def __init__(self, manifest_location: str, file_index: int = 0, row_offset: int = 0,
+                 data_root: Optional[str] = None):
+        self.manifest_location = manifest_location
+        self.file_index = file_index
+        self.row_offset = row_offset  # Rows of the current data file which were already read.
+        self._data_root = data_root or os.path.dirname(manifest_location)
+
+        with contextlib.closing(self._open(manifest_location)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['fileFormat'] != 'CSV':
+            # Parquet (and ORC) reports would need pyarrow, which the batcher does not ship.
+            raise ValueError('Unsupported S3 Inventory format (only CSV is supported): {}'.format(
+                manifest['fileFormat']))
+        self._schema = [field.strip() for field in manifest.get('fileSchema', '').split(',')]
+        self._destination_bucket = manifest['destinationBucket'].split(':::')[-1]
+        self._files = [data_file['key'] for data_file in manifest['files']]
+        # Objects modified after the report was created are not in it.
+        self.snapshot_time = (int(manifest['creationTimestamp']) / 1000
+                              if manifest.get('creationTimestamp') else None)
+
+        self._rows = None  # Iterator over the rows of the current data file.
+        self._page_positions = []  # (file index, row offset) of each object of the last page.
+        self.finished = self.file_index >= len(self._files)
+
+    def resume_payload(self) -> dict:
+        # Event for the next batcher to pick up where this enumerator stopped.
+        return {
+            'S3InventoryManifest': self.manifest_location,
+            'S3InventoryPosition': {'File': self.file_index, 'Row': self.row_offset}
+        }
+
+    def resume_from(self, index: int) -> None:
+        # The objects of the last page from index on were not enqueued: read them again.
+        self.file_index, self.row_offset = self._page_positions[index]
+        if self._rows is not None:
+            self._rows.close()
+        self._rows = None
+        self.finished = False
+
+    @staticmethod
+    def _open(location: str):
+        # Open a binary stream for an S3 location or a local path.
+        if location.startswith('s3://'):
+            bucket, key = location[len('s3://'):].split('/', 1)
+            return S3_CLIENT.get_object(Bucket=bucket, Key=key)['Body']
+        return open(location, 'rb')
+
+    def _data_file_location(self, key: str) -> str:
+        if self.manifest_location.startswith('s3://'):
+            return 's3://{}/{}'.format(self._destination_bucket, key)
+        return os.path.join(self._data_root, key)
+
+    def _iter_rows(self, location: str) -> Iterator[dict]:
+        # Yield each row of a CSV.gz data file as a dict keyed by the CSV field names.
+        with contextlib.closing(self._open(location)) as stream:
+            with gzip.GzipFile(fileobj=stream) as data:
+                for row in csv.reader(io.TextIOWrapper(data, encoding='utf-8')):
+                    yield dict(zip(self._schema, row))
+
+    def _object(self, row: dict) -> Optional[dict]:
+        # Convert an inventory row to {'Key', 'Size', 'ETag', 'LastModified'} (None to skip it).
+        if (str(row.get('IsLatest', 'true')).lower() != 'true' or
+                str(row.get('IsDeleteMarker', 'false')).lower() == 'true'):
+            return None
+        key = urllib.parse.unquote_plus(row['Key'])  # CSV inventory keys are URL-encoded.
+        return {'Key': key, 'Size': int(row.get('Size') or 0), 'ETag': row.get('ETag') or None,
+                'LastModified': _epoch_seconds(row.get('LastModifiedDate'))}
+
+    def next_page(self) -> List[dict]:
+        # Get the next page of S3 objects: [{'Key', 'Size', 'ETag', 'LastModified'}, ...]
+        objects, self._page_positions = [], []
+        while len(objects) < INVENTORY_PAGE_SIZE and not self.finished:
+            if self._rows is None:
+                self._rows = self._iter_rows(
+                    self._data_file_location(self._files[self.file_index]))
+                # Compressed data can't be seeked: skip the rows read by earlier batchers.
+                collections.deque(itertools.islice(self._rows, self.row_offset), maxlen=0)
+
+            row = next(self._rows, None)
+            if row is None:  # Done with this data file.
+                self._rows = None
+                self.file_index += 1
+                self.row_offset = 0
+                self.finished = self.file_index >= len(self._files)
+                continue
+
+            self.row_offset += 1
+            obj = self._object(row)
+            if obj is not None:
+                objects.append(obj)
+                self._page_positions.append((self.file_index, self.row_offset - 1))
+        return objects
+
+
+class EnqueueGovernor(object):
+    """Paces enqueueing to what the analyzers drain, so messages are not left to expire in SQS.
+
+    A token bucket limits how many SQS messages are sent per second. Every poll_seconds, the queue
+    depth (visible plus in-flight messages) is read and the drain rate estimated from how the
+    depth changed compared to what was sent meanwhile. Then:
+        - depth below half the backlog limit: the rate doubles (up to max_rate);
+        - depth above half the limit: the rate follows the drain rate;
+        - depth at the limit: the rate drops to 0 (paused) until the analyzers catch up.
+    Unless max_backlog is given, the limit is what the analyzers drain in half of the queue's
+    retention period (but at least MIN_BACKLOG messages).
+    """
+    MIN_BACKLOG = 1000  # Messages.
+    MIN_RATE = 1.0  # Messages per second, when not paused.
+
+    def __init__(self, queue_url: str, max_rate: float, max_backlog: int = 0,
+                 poll_seconds: float = 10, state: Optional[dict] = None):
+        self._queue_url = queue_url
+        self._max_rate = max_rate
+        self._max_backlog = max_backlog
+        self._poll_seconds = poll_seconds
+        # The rate and drain rate are carried over from the previous batcher of the chain.
+        state = state or {}
+        self.rate = state.get('Rate', self.MIN_RATE)
+        self.drain_rate = state.get('DrainRate', 0.0)
+
+        self._retention_seconds = None
+        self._tokens = 0.0
+        self._last_refill = time.time()
+        self._last_poll = None
+        self._last_backlog = None
+        self._sent_since_poll = 0
+
+    def state(self) -> dict:
+        # Carried in the event of the next batcher.
+        return {'Rate': self.rate, 'DrainRate': self.drain_rate}
+
+    def _backlog_limit(self) -> float:
+        if self._max_backlog:
+            return self._max_backlog
+        return max(self.MIN_BACKLOG, self.drain_rate * self._retention_seconds / 2)
+
+    def _poll(self, now: float) -> None:
+        # Read the queue depth and adapt the rate.
+        attributes = SQS_CLIENT.get_queue_attributes(
+            QueueUrl=self._queue_url,
+            AttributeNames=['ApproximateNumberOfMessages',
+                            'ApproximateNumberOfMessagesNotVisible',
+                            'MessageRetentionPeriod']
+        )['Attributes']
+        self._retention_seconds = int(attributes['MessageRetentionPeriod'])
+        backlog = (int(attributes['ApproximateNumberOfMessages']) +
+                   int(attributes['ApproximateNumberOfMessagesNotVisible']))
+
+        if self._last_backlog is not None and now > self._last_poll:
+            drained = self._sent_since_poll - (backlog - self._last_backlog)
+            self.drain_rate = (self.drain_rate + max(drained, 0) / (now - self._last_poll)) / 2
+
+        limit = self._backlog_limit()
+        if backlog >= limit:
+            self.rate = 0.0
+        elif backlog >= limit / 2:
+            self.rate = min(max(self.drain_rate, self.MIN_RATE), self._max_rate)
+        else:
+            self.rate = min(max(self.rate, self.MIN_RATE) * 2, self._max_rate)
+        LOGGER.info('Queue backlog %d of %d messages, drain rate %.1f/s: enqueueing %.1f/s',
+                    backlog, limit, self.drain_rate, self.rate)
+
+        self._last_poll, self._last_backlog, self._sent_since_poll = now, backlog, 0
+
+    def consume(self, num_messages: int) -> None:
+        # Account for messages being sent (also when they are sent without waiting for tokens).
+        self._tokens -= num_messages
+        self._sent_since_poll += num_messages
+
+    def acquire(self, num_messages: int, deadline: float) -> bool:
+        """Wait until num_messages may be sent; returns False if that is not before the deadline.
+
+        Args:
+            num_messages: [int] Number of SQS messages about to be sent.
+            deadline: [float] Epoch seconds by which the caller must stop waiting.
+        """
+        while True:
+            now = time.time()
+            if self._last_poll is None or now - self._last_poll >= self._poll_seconds:
+                self._poll(now)
+            # The bucket holds up to a poll interval of tokens, and always enough for the request.
+            burst = max(self.rate * self._poll_seconds, num_messages)
+            self._tokens = min(self._tokens + (now - self._last_refill) * self.rate, burst)
+            self._last_refill = now
+
+            if self.rate > 0 and self._tokens >= num_messages:
+                self.consume(num_messages)
+                return True
+
+            wait = self._poll_seconds
+            if self.rate > 0:
+                wait = min(wait, (num_messages - self._tokens) / self.rate)
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class ScanCheckpoints(object):
+    """Remembers up to when a bucket (or partition) was fully enqueued, per scan fingerprint.
+
+    The scan fingerprint covers the YARA rules and the scanners combined with them (see
+    scan_fingerprint.py), so changing the secrets detectors also triggers a full rescan.
+
+    The table uses a single hash key:
+        CheckpointId: [string] The bucket name, plus the partition for partitioned enumeration.
+
+    Additionally, items have the following attributes:
+        RulesFingerprint: [string] Scan fingerprint in effect for the completed scan.
+        ScannedBefore: [number] Epoch seconds; every object last modified before then (and still
+            present) was enqueued by the completed scan.
+    """
+    def __init__(self, table_name: str):
+        self._table_name = table_name
+        self._client = aws_clients.client('dynamodb')
+
+    @staticmethod
+    def checkpoint_id(bucket_name: str, partition: Optional[dict] = None) -> str:
+        if not partition:
+            return bucket_name
+        return '{}:{}'.format(bucket_name, json.dumps(partition, sort_keys=True))
+
+    def modified_since(self, checkpoint_id: str, fingerprint: str) -> Optional[float]:
+        """Returns ScannedBefore of the last completed scan with these rules (or None)."""
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key={'CheckpointId': {'S': checkpoint_id}},
+            ConsistentRead=True
+        ).get('Item')
+        if item and item['RulesFingerprint']['S'] == fingerprint:
+            return float(item['ScannedBefore']['N'])
+        return None
+
+    def save(self, checkpoint_id: str, fingerprint: str, scanned_before: float) -> None:
+        """Record a completed scan."""
+        self._client.put_item(
+            TableName=self._table_name,
+            Item={
+                'CheckpointId': {'S': checkpoint_id},
+                'RulesFingerprint': {'S': fingerprint},
+                'ScannedBefore': {'N': str(scanned_before)}
+            }
+        )
+
+
+def plan_partitions(bucket_name: str, delimiter: str = '',
+                    boundaries: List[str] = ()) -> List[dict]:
+    """Split the bucket into partitions which can be enumerated independently.
+
+    With boundary keys, partition i holds the keys after boundaries[i-1] up to boundaries[i].
+    Otherwise, the top-level prefixes are discovered with the delimiter; each prefix becomes a
+    partition, plus one for the objects directly at the top level.
+    """
+    if boundaries:
+        bounds = [None] + sorted(boundaries) + [None]
+        partitions = []
+        for start_after, end_at in zip(bounds, bounds[1:]):
+            partition = {}
+            if start_after is not None:
+                partition['StartAfter'] = start_after
+            if end_at is not None:
+                partition['EndAt'] = end_at
+            partitions.append(partition)
+        return partitions
+
+    partitions = [{'Delimiter': delimiter}]  # Objects which are not under any prefix.
+    for page in S3_CLIENT.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket_name, Delimiter=delimiter):
+        partitions.extend({'Prefix': prefix['Prefix']}
+                          for prefix in page.get('CommonPrefixes', []))
+    return partitions
+
+
+def _invoke_batcher(payload: dict) -> None:
+    # Asynchronously invoke another batcher with the given event.
+    LAMBDA_CLIENT.invoke(
+        FunctionName=os.environ['BATCH_LAMBDA_NAME'],
+        InvocationType='Event',  # Asynchronous invocation.
+        Payload=json.dumps(payload),
+        Qualifier=os.environ['BATCH_LAMBDA_QUALIFIER']
+    )
 
 
 def batch_lambda_handler(event, lambda_context) -> int:
     LOGGER.info('Invoked with event %s', json.dumps(event))
     LOGGER.info('The SQS Queue Url is : %s', os.environ['SQS_QUEUE_URL'])
 
-    s3_enumerator = S3BucketEnumerator(
-        os.environ['S3_BUCKET_NAME'], event.get('S3ContinuationToken'))
-    sqs_batcher = SQSBatcher(os.environ['SQS_QUEUE_URL'], int(os.environ['OBJECTS_PER_MESSAGE']))
+    # Partitioned mode: the first batcher only plans the partitions and fans out, one batcher
+    # per partition, each of which then chains on its own continuation token.
+    partition = event.get('S3Partition')
+    delimiter = os.environ.get('PARTITION_DELIMITER', '')
+    boundaries = [key for key in os.environ.get('PARTITION_BOUNDARIES', '').split(',') if key]
+
+    if event.get('S3InventoryManifest'):
+        # Read the keys from an S3 Inventory report (e.g. s3://bucket/.../manifest.json).
+        position = event.get('S3InventoryPosition', {})
+        s3_enumerator = S3InventoryEnumerator(
+            event['S3InventoryManifest'], position.get('File', 0), position.get('Row', 0))
+    elif (partition is None and not event.get('S3ContinuationToken') and
+          not event.get('S3StartAfter') and (delimiter or boundaries)):
+        partitions = plan_partitions(os.environ['S3_BUCKET_NAME'], delimiter, boundaries)
+        LOGGER.info('Fanning out to %d partitioned batchers', len(partitions))
+        for partition in partitions:
+            payload = {'S3Partition': partition}
+            if event.get('FullRescan'):
+                payload['FullRescan'] = True
+            _invoke_batcher(payload)
+        return 0
+    else:
+        s3_enumerator = S3BucketEnumerator(
+            os.environ['S3_BUCKET_NAME'], event.get('S3ContinuationToken'), partition,
+            event.get('S3StartAfter'))
+
+    # Incremental mode: skip the objects which were not modified since the last completed scan
+    # with the same rules and scanners. The first batcher of a chain reads the checkpoint; the
+    # others get it in their event, and the last one records the new checkpoint, unless any
+    # batcher of the chain failed to enqueue some keys (those must be enqueued again by the next
+    # sweep).
+    checkpoints, checkpoint = None, event.get('S3Checkpoint')
+    fingerprint = _scan_fingerprint()
+    if os.environ.get('CHECKPOINT_DYNAMO_TABLE_NAME') and fingerprint:
+        checkpoints = ScanCheckpoints(os.environ['CHECKPOINT_DYNAMO_TABLE_NAME'])
+        if checkpoint is None:
+            checkpoint_id = ScanCheckpoints.checkpoint_id(os.environ['S3_BUCKET_NAME'], partition)
+            checkpoint = {
+                'Id': checkpoint_id,
+                'Fingerprint': fingerprint,
+                'ModifiedSince': (None if event.get('FullRescan') else
+                                  checkpoints.modified_since(checkpoint_id, fingerprint)),
+                'ScanStarted': (s3_enumerator.snapshot_time or time.time()) -
+                               INCREMENTAL_OVERLAP_SECONDS
+            }
+            LOGGER.info('Enqueueing objects modified since %s', checkpoint['ModifiedSince'])
+    modified_since = checkpoint['ModifiedSince'] if checkpoint else None
+
+    # Pace enqueueing to the analyzers: every batch of messages waits for the governor, and
+    # no more keys are added (the next batcher resumes with them) once the queue is saturated.
+    governor = None
+    if ENQUEUE_MAX_RATE > 0:
+        governor = EnqueueGovernor(os.environ['SQS_QUEUE_URL'], ENQUEUE_MAX_RATE,
+                                   QUEUE_MAX_BACKLOG, state=event.get('EnqueueGovernor'))
+    sqs_batcher = SQSBatcher(
+        os.environ['SQS_QUEUE_URL'], int(os.environ['OBJECTS_PER_MESSAGE']),
+        bytes_per_message=int(os.environ.get('BYTES_PER_MESSAGE', 0)), governor=governor,
+        deadline=time.time() + (lambda_context.get_remaining_time_in_millis() - 10000) / 1000)
 
     # As long as there are at least 10 seconds remaining, enumerate S3 objects into SQS.
-    num_keys = 0
-    while lambda_context.get_remaining_time_in_millis() > 10000 and not s3_enumerator.finished:
-        keys = s3_enumerator.next_page()
-        num_keys += len(keys)
-        for key in keys:
-            sqs_batcher.add_key(key)
-    LOGGER.info('Enumerated %d keys into %d batches', num_keys, sqs_batcher._msg_index)
+    num_keys = num_unchanged = 0
+    while (lambda_context.get_remaining_time_in_millis() > 10000 and
+           not s3_enumerator.finished and not sqs_batcher.saturated):
+        objects = s3_enumerator.next_page()
+        for index, obj in enumerate(objects):
+            if sqs_batcher.saturated:
+                s3_enumerator.resume_from(index)
+                break
+            if (modified_since is not None and obj['LastModified'] is not None and
+                    obj['LastModified'] < modified_since):
+                num_unchanged += 1
+                continue
+            num_keys += 1
+            sqs_batcher.add_key(obj['Key'], obj['Size'], obj['ETag'])
+    if sqs_batcher.saturated:
+        LOGGER.info('The queue is saturated, handing off to the next batcher')
+    LOGGER.info('Enumerated %d keys into %d batches (%d unchanged keys skipped)',
+                num_keys, sqs_batcher._msg_index, num_unchanged)
     # Send the last batch of keys.
     sqs_batcher.flash()
+    if sqs_batcher.failures and checkpoint is not None:
+        checkpoint['SendFailed'] = True
 
     # If the enumerator has not yet finished but we're low on time, invoke this function again.
     if not s3_enumerator.finished:
         LOGGER.info('Invoking another batcher')
-        LAMBDA_CLIENT.invoke(
-            FunctionName=os.environ['BATCH_LAMBDA_NAME'],
-            InvocationType='Event',  # Asynchronous invocation.
-            Payload=json.dumps({'S3ContinuationToken': s3_enumerator.continuation_token}),
-            Qualifier=os.environ['BATCH_LAMBDA_QUALIFIER']
-        )
+        payload = s3_enumerator.resume_payload()
+        if checkpoint is not None:
+            payload['S3Checkpoint'] = checkpoint
+        if governor is not None:
+            payload['EnqueueGovernor'] = governor.state()
+        _invoke_batcher(payload)
+    elif checkpoint is not None and checkpoint.get('SendFailed'):
+        LOGGER.error('Some keys could not be enqueued, not saving the scan checkpoint')
+    elif checkpoints is not None:
+        checkpoints.save(checkpoint['Id'], checkpoint['Fingerprint'], checkpoint['ScanStarted'])
 
     return num_keys
\ No newline at end of file
@@ -1,30 +1,43 @@
 import os
 import json
-import boto3
 import logging
+import concurrent.futures
 
 from typing import Optional, List
 
+if __package__:
+    from lambda_functions.shared import aws_clients, key_messages
+else:
+    import aws_clients
+    import key_messages
+
 # Configure logger.
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-# Setup boto3 clients.
-LAMBDA_CLIENT = boto3.client('lambda')
-SQS_CLIENT = boto3.client('sqs')
-
 # Constants
 WAIT_TIME_SECONDS               = 10
 BATCH_SIZE                      = 10    # SQS maximum allowable
-SQS_QUEUE_URL                   = os.getenv('SQS_QUEUE_URL')
+SQS_QUEUE_URL                   = os.getenv('SQS_QUEUE_URL')       # Real-time lane (uploads).
+BULK_SQS_QUEUE_URL              = os.getenv('BULK_SQS_QUEUE_URL')  # Bulk lane (batcher rescans).
+REALTIME_MAX_RECEIVES           = int(os.getenv('REALTIME_MAX_RECEIVES', 5))
 MAX_DISPATCHES                  = int(os.getenv('MAX_DISPATCHES'))
 ANALYZE_LAMBDA_NAME             = os.getenv('ANALYZE_LAMBDA_NAME')
 ANALYZE_LAMBDA_QUALIFER         = os.getenv('ANALYZE_LAMBDA_QUALIFIER')
 SECRETS_ANALYZE_LAMBDA_NAME     = os.getenv('SECRETS_ANALYZE_LAMBDA_NAME')
 SECRETS_ANALYZE_LAMBDA_QUALIFER = os.getenv('SECRETS_ANALYZE_LAMBDA_QUALIFIER')
+MAX_KEYS_PER_DISPATCH           = int(os.getenv('MAX_KEYS_PER_DISPATCH', 0))   # 0: no limit
+MAX_BYTES_PER_DISPATCH          = int(os.getenv('MAX_BYTES_PER_DISPATCH', 0))  # 0: no limit
+MAX_PAYLOAD_BYTES               = key_messages.PAYLOAD_MAX_BYTES  # Invocations carry <= 256 KB.
+ANALYZE_TIMEOUT_SECONDS         = int(os.getenv('ANALYZE_TIMEOUT_SECONDS', 300))
 WAIT_TIME_SECONDS       = 10    # Maximum amount of time to hold a 
                                 # receive_message connection open.
 
+# Setup boto3 clients (one connection per concurrent invocation, each waiting for the analyzer).
+LAMBDA_CLIENT = aws_clients.client('lambda', max_pool_connections=MAX_DISPATCHES,
+                                   read_timeout=ANALYZE_TIMEOUT_SECONDS + 10)
+SQS_CLIENT = aws_clients.client('sqs')
+
 # Delete a batch of SQS messages
 def delete_sqs_messages(queue_url: str, receipt_handles: List[str]) -> None:
     SQS_CLIENT.delete_message_batch(
@@ -33,70 +46,81 @@ def delete_sqs_messages(queue_url: str, receipt_handles: List[str]) -> None:
     )
 
 
-# Invoke an analysis Lambda asynchronously
-def invoke_analysis_lambda(payload: dict) -> None:
-    LAMBDA_CLIENT.invoke(
-        FunctionName    = ANALYZE_LAMBDA_NAME,
-        InvocationType  = 'Event',
+# Invoke an analysis Lambda and wait for it, so its messages stay on the queue until it is done
+def _invoke_and_wait(function_name: str, qualifier: str, payload: dict) -> None:
+    response = LAMBDA_CLIENT.invoke(
+        FunctionName    = function_name,
+        InvocationType  = 'RequestResponse',
         Payload         = json.dumps(payload),
-        Qualifier       = ANALYZE_LAMBDA_QUALIFER
+        Qualifier       = qualifier
     )
+    if response.get('FunctionError'):
+        raise RuntimeError('{} failed: {}'.format(function_name, response['Payload'].read()))
+
+# Invoke an analysis Lambda
+def invoke_analysis_lambda(payload: dict) -> None:
+    _invoke_and_wait(ANALYZE_LAMBDA_NAME, ANALYZE_LAMBDA_QUALIFER, payload)
 
-# Invoke an analysis Lambda asynchronously
+# Invoke a secrets analysis Lambda
 def invoke_secrets_analysis_lambda(payload: dict) -> None:
-    LAMBDA_CLIENT.invoke(
-        FunctionName    = SECRETS_ANALYZE_LAMBDA_NAME,
-        InvocationType  = 'Event',
-        Payload         = json.dumps(payload),
-        Qualifier       = SECRETS_ANALYZE_LAMBDA_QUALIFER
-    )
+    _invoke_and_wait(SECRETS_ANALYZE_LAMBDA_NAME, SECRETS_ANALYZE_LAMBDA_QUALIFER, payload)
 
-# Receive a message from the SQS service
-def receive_message_sqs(queue_url: str, wait_time_seconds: int) -> Optional[dict]:
+# Receive messages from the SQS service, in the record format of the SQS Lambda events
+def receive_message_sqs(queue_url: str, wait_time_seconds: int) -> List[dict]:
     messages = SQS_CLIENT.receive_message(
         QueueUrl = queue_url,
         MaxNumberOfMessages = BATCH_SIZE,
         WaitTimeSeconds = wait_time_seconds
     )
+    return [{'body': msg['Body'], 'receiptHandle': msg['ReceiptHandle']}
+            for msg in messages.get('Messages', [])]
 
-"""Convert a batch of SQS messages into an analysis Lambda payload.
+
+# Make received messages visible again, so they are redelivered right away
+def release_sqs_messages(queue_url: str, receipt_handles: List[str]) -> None:
+    for start in range(0, len(receipt_handles), BATCH_SIZE):
+        SQS_CLIENT.change_message_visibility_batch(
+            QueueUrl        = queue_url,
+            Entries         = [{'Id': str(index), 'ReceiptHandle': receipt, 'VisibilityTimeout': 0}
+                               for index, receipt in
+                               enumerate(receipt_handles[start:start + BATCH_SIZE])]
+        )
+
+
+# URL of the queue (lane) the SQS Lambda event came from
+def _event_queue_url(sqs_messages: dict) -> Optional[str]:
+    for msg in sqs_messages.get('Records', []):
+        queue_name = msg.get('eventSourceARN', '').split(':')[-1]
+        if BULK_SQS_QUEUE_URL and BULK_SQS_QUEUE_URL.endswith('/' + queue_name):
+            return BULK_SQS_QUEUE_URL
+    return SQS_QUEUE_URL
+
+
+"""Decode a batch of SQS messages into the S3 objects each of them carries.
 
 Args:
-    sqs_messages: [dict] Response from SQS.receive_message. Expected format:
-        {
-            'Records': [
-                {
-                    ...
-                    'body': '{"Records": [{"s3": {"object": {"key": "..."}}}, ...]}',
-                    'receiptHandle': '...'
-                },
-                ...
-            ]
-        }
-        There may be multiple SQS messages, each of which may contain multiple S3 keys.
-        Each message body is a JSON string, in the format of an S3 object added event.
+    sqs_messages: [dict] Response from SQS.receive_message (see _build_payload).
 
 Returns:
-    [dict] Non-empty payload for the analysis Lambda function in the following format:
+    [list<dict>] One entry per valid message, in order:
     {
-        'S3Objects': ['key1', 'key2', ...],
-        'SQSReceipts': ['receipt1', 'receipt2', ...]
-    }
-    [None] if the SQS message was empty or invalid."""
-def _build_payload(sqs_messages):
+        'MessageId': '...',  # None for messages which were not delivered by a Lambda event.
+        'ReceiptHandle': '...',
+        'Objects': [{'key': ..., 'size': ..., 'eTag': ...}, ...]
+    }"""
+def _decode_messages(sqs_messages) -> List[dict]:
     if 'Records' not in sqs_messages:
         LOGGER.info('No SQS messages found')
-        return
+        return []
 
-    # The payload consists of S3 object keys and SQS receipts (consumers will delete the message).
-    payload = {'S3Objects': [], 'SQSReceipts': []}
+    messages = []
     invalid_receipts = []  # List of invalid SQS message receipts to delete.
     for msg in sqs_messages['Records']:
         try:
-            payload['S3Objects'].extend(
-                record['s3']['object']['key'] for record in json.loads(msg['body'])['Records'])
-            payload['SQSReceipts'].append(msg['receiptHandle'])
-        except (KeyError, ValueError):
+            messages.append({'MessageId': msg.get('messageId'),
+                             'ReceiptHandle': msg['receiptHandle'],
+                             'Objects': key_messages.decode(msg['body'])})
+        except (KeyError, TypeError, ValueError):
             LOGGER.warning('Invalid SQS message body: %s', msg['body'])
             invalid_receipts.append(msg['receiptHandle'])
             continue
@@ -110,6 +134,63 @@ def _build_payload(sqs_messages):
         #              for index, receipt in enumerate(invalid_receipts)]
         # )
 
+    return messages
+
+
+# Start an empty analysis Lambda payload (see _build_payload)
+def _new_payload(queue_url: str) -> dict:
+    return {'S3Objects': [], 'S3ObjectSizes': [], 'S3ObjectETags': [],
+            'SQSReceipts': [], 'SQSKeyCounts': [], 'SQSQueueUrl': queue_url}
+
+
+# Append the S3 objects and the receipt of a decoded message to a payload
+def _add_to_payload(payload: dict, message: dict) -> None:
+    # SQSKeyCounts[i] is the number of consecutive S3Objects carried by the i-th receipt.
+    # S3ObjectSizes and S3ObjectETags line up with S3Objects (None where the message had no value).
+    objects = message['Objects']
+    payload['S3Objects'].extend(obj['key'] for obj in objects)
+    payload['S3ObjectSizes'].extend(obj.get('size') for obj in objects)
+    payload['S3ObjectETags'].extend(obj.get('eTag') for obj in objects)
+    payload['SQSReceipts'].append(message['ReceiptHandle'])
+    payload['SQSKeyCounts'].append(len(objects))
+
+
+"""Convert a batch of SQS messages into an analysis Lambda payload.
+
+Args:
+    queue_url: [string] URL of the queue the messages were received from.
+    sqs_messages: [dict] Response from SQS.receive_message. Expected format:
+        {
+            'Records': [
+                {
+                    ...
+                    'body': '{"Records": [{"s3": {"object": {"key": "...", "size": ...}}}, ...]}',
+                    'receiptHandle': '...'
+                },
+                ...
+            ]
+        }
+        There may be multiple SQS messages, each of which may contain multiple S3 keys.
+        Each message body is a JSON string, in the format of an S3 object added event, or in
+        the compact format of the batcher (optionally gzipped); see key_messages.
+
+Returns:
+    [dict] Non-empty payload for the analysis Lambda function in the following format:
+    {
+        'S3Objects': ['key1', 'key2', ...],
+        'S3ObjectSizes': [1024, 2048, ...],  # Size in bytes of each S3 object (or None).
+        'S3ObjectETags': ['etag1', 'etag2', ...],  # ETag of each S3 object (or None).
+        'SQSReceipts': ['receipt1', 'receipt2', ...],
+        'SQSKeyCounts': [2, ...],  # Number of S3Objects carried by each receipt, in order.
+        'SQSQueueUrl': '...'  # Queue the receipts belong to (where analyzers delete them).
+    }
+    [None] if the SQS message was empty or invalid."""
+def _build_payload(sqs_messages, queue_url=SQS_QUEUE_URL):
+    # The payload consists of S3 object keys and SQS receipts (consumers will delete the message).
+    payload = _new_payload(queue_url)
+    for message in _decode_messages(sqs_messages):
+        _add_to_payload(payload, message)
+
     # If there were no valid S3 objects, return None.
     if not payload['S3Objects']:
         return
@@ -117,22 +198,148 @@ def _build_payload(sqs_messages):
     return payload
 
 
-def dispatch_lambda_handler(event, lambda_context) -> int:
-    # Validate the SQS message and construct the payload.
-    payload = _build_payload(event)
-    LOGGER.info('Sending %d object(s) to an analyzer: %s',
-                len(payload['S3Objects']), json.dumps(payload['S3Objects']))
+class DispatchScheduler(object):
+    """Packs SQS messages into analyzer payloads and invokes the analyzers in parallel.
+
+    Messages are merged into a payload (see _build_payload) until it would exceed max_keys S3
+    objects, max_bytes of S3 object data or MAX_PAYLOAD_BYTES of JSON. A message is never split,
+    as the analyzers delete its receipt once all of its keys are done. Every payload is sent to
+    each of the analyzers, from a pool of max_dispatches threads, and at most max_dispatches
+    payloads are dispatched per run. Invocations are synchronous, so a dispatcher runs at most
+    max_dispatches analyzers at once and its messages stay on the queue until they are analyzed;
+    the number of dispatchers is capped by the event source mappings. Messages left over (past
+    that budget, or whose invocation failed) are returned by finish(), to be put back on their
+    queue.
+    """
+
+    def __init__(self, invokers: List, max_dispatches: int = MAX_DISPATCHES,
+                 max_keys: int = MAX_KEYS_PER_DISPATCH, max_bytes: int = MAX_BYTES_PER_DISPATCH):
+        self._invokers = invokers  # Callables invoking an analyzer with a payload.
+        self._max_dispatches = max_dispatches
+        self._max_keys = max_keys
+        self._max_bytes = max_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_dispatches)
+
+        self._payload = None  # The payload being filled, with its messages and size.
+        self._messages = []
+        self._payload_bytes = self._object_bytes = 0
+
+        self._in_flight = {}  # Future of an invocation => messages of its payload.
+        self._leftover = []  # Messages which were not dispatched.
+        self.dispatched = 0  # Number of payloads dispatched.
+
+    def has_room(self) -> bool:
+        """Returns True if more payloads can be dispatched in this run."""
+        return self.dispatched + (self._payload is not None) < self._max_dispatches
+
+    def _fits(self, message: dict, message_bytes: int) -> bool:
+        objects = message['Objects']
+        if self._max_keys and len(self._payload['S3Objects']) + len(objects) > self._max_keys:
+            return False
+        if self._max_bytes and self._object_bytes + sum(
+                obj.get('size') or 0 for obj in objects) > self._max_bytes:
+            return False
+        return self._payload_bytes + message_bytes <= MAX_PAYLOAD_BYTES
+
+    def add(self, message: dict, queue_url: str) -> None:
+        """Add a decoded message (see _decode_messages), dispatching the payload once it is full.
+
+        Args:
+            message: [dict] The decoded message.
+            queue_url: [string] URL of the queue the message was received from.
+        """
+        message_bytes = len(message['ReceiptHandle']) + 8 + sum(
+            key_messages.payload_bytes(obj) for obj in message['Objects'])
+        if self._payload is not None and (self._payload['SQSQueueUrl'] != queue_url or
+                                          not self._fits(message, message_bytes)):
+            self._dispatch()
+        if self._payload is None:
+            if self.dispatched >= self._max_dispatches:
+                self._leftover.append(message)
+                return
+            self._payload = _new_payload(queue_url)
+            self._payload_bytes = len(json.dumps(self._payload))
+
+        _add_to_payload(self._payload, message)
+        self._messages.append(message)
+        self._payload_bytes += message_bytes
+        self._object_bytes += sum(obj.get('size') or 0 for obj in message['Objects'])
+
+    def _dispatch(self) -> None:
+        payload, messages = self._payload, self._messages
+        self._payload, self._messages = None, []
+        self._payload_bytes = self._object_bytes = 0
+        if not payload['S3Objects']:
+            return
+
+        LOGGER.info('Sending %d object(s) (%d bytes) to the analyzers: %s',
+                    len(payload['S3Objects']),
+                    sum(size or 0 for size in payload['S3ObjectSizes']),
+                    json.dumps(payload['S3Objects']))
+        for invoke in self._invokers:
+            self._in_flight[self._executor.submit(invoke, payload)] = messages
+        self.dispatched += 1
+
+    def finish(self) -> List[dict]:
+        """Dispatch the last payload and wait for every invocation.
+
+        Returns:
+            [list<dict>] The messages which were not dispatched to every analyzer.
+        """
+        if self._payload is not None:
+            self._dispatch()
+
+        failed = {}
+        for future in concurrent.futures.as_completed(self._in_flight):
+            if future.exception() is not None:
+                LOGGER.error('Unable to invoke an analyzer: %s', future.exception())
+                for message in self._in_flight[future]:
+                    failed[id(message)] = message
+        self._executor.shutdown()
+        self._in_flight = {}
+        return self._leftover + list(failed.values())
+
 
-    # Asynchronously invoke an analyzer lambda.
-    invoke_analysis_lambda(payload)
+# Receive pending uploads from the real-time lane, while there is room to dispatch them
+def _drain_realtime_lane(scheduler: DispatchScheduler) -> None:
+    for _ in range(REALTIME_MAX_RECEIVES):
+        if not scheduler.has_room():
+            break
+        records = receive_message_sqs(SQS_QUEUE_URL, 0)
+        for message in _decode_messages({'Records': records}):
+            scheduler.add(message, SQS_QUEUE_URL)
+        if len(records) < BATCH_SIZE:
+            break  # The real-time lane is drained.
 
-    LOGGER.info('Sending %d object(s) to an analyzer: %s',
-        len(payload['S3Objects']), json.dumps(payload['S3Objects']))
 
-    # Asynchronously invoke an secrets analyzer lambda.
-    invoke_secrets_analysis_lambda(payload)
+def dispatch_lambda_handler(event, lambda_context) -> dict:
+    # Messages come from one of two lanes: new uploads (the real-time queue, fed by the S3
+    # notifications) and rescans (the bulk queue, fed by the batcher). A bulk batch waits for
+    # the real-time lane to be drained, so rescans never delay the verdicts on new uploads.
+    # The analyzers are invoked synchronously: the bulk backlog stays in its queue, behind the
+    # bulk event source mapping's concurrency cap, rather than ahead of new uploads.
+    # With the combined analyzer (no SECRETS_ANALYZE_LAMBDA_NAME), it runs the secrets scan too.
+    invokers = [invoke_analysis_lambda]
+    if SECRETS_ANALYZE_LAMBDA_NAME:
+        invokers.append(invoke_secrets_analysis_lambda)
+    scheduler = DispatchScheduler(invokers)
+    queue_url = _event_queue_url(event)
+    if queue_url == BULK_SQS_QUEUE_URL and queue_url != SQS_QUEUE_URL:
+        _drain_realtime_lane(scheduler)
 
-    # delete_sqs_messages(os.environ['SQS_QUEUE_URL'], payload['S3Objects'])
+    # Validate the SQS messages and pack them into payloads.
+    for message in _decode_messages(event):
+        scheduler.add(message, queue_url)
+    leftover = scheduler.finish()
+    LOGGER.info('Dispatched %d payload(s) to %d analyzer(s)', scheduler.dispatched, len(invokers))
 
-    LOGGER.info('Invoked %d total analyzers', 1)
-    return 1
+    # Messages of the event which were not dispatched are reported back to the event source
+    # mapping (which then leaves them on the queue); received ones are made visible again.
+    failures = [message['MessageId'] for message in leftover if message['MessageId']]
+    released = [message['ReceiptHandle'] for message in leftover if not message['MessageId']]
+    if released:
+        LOGGER.warning('Releasing %d real-time message(s)', len(released))
+        release_sqs_messages(SQS_QUEUE_URL, released)
+    if failures:
+        LOGGER.warning('Returning %d message(s) to the queue', len(failures))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
@@ -2,7 +2,10 @@
 import json
 import logging
 
-import boto3
+if __package__:
+    from lambda_functions.shared import aws_clients
+else:
+    import aws_clients
 
 LOGGER = logging.getLogger()
 SNS_PUBLISH_SUBJECT_MAX_SIZE = 99
@@ -10,7 +13,7 @@ SNS_PUBLISH_SUBJECT_MAX_SIZE = 99
 
 def download_from_s3(bucket_name, object_key, download_path):
     # Download an object from S3 into local /tmp storage and return the metadata.
-    response = boto3.client('s3').get_object(Bucket=bucket_name, Key=object_key)
+    response = aws_clients.client('s3').get_object(Bucket=bucket_name, Key=object_key)
     with open(download_path, 'wb') as file:
         file.write(response['Body'].read())
 
@@ -30,7 +33,7 @@ def publish_alert_to_sns(binary, topic_arn):
     # Publish a JSON SNS alert: a binary has matched one or more YARA rules.
     subject = 'BinaryAlert: {} matches a YARA rule'.format(
         binary.observed_path or binary.reported_md5 or binary.computed_md5)
-    boto3.client('sns').publish(
+    aws_clients.client('sns').publish(
         TopicArn=topic_arn,
         Subject=_elide_string_middle(subject, SNS_PUBLISH_SUBJECT_MAX_SIZE),
         Message=(json.dumps(binary.summary(), indent=4, sort_keys=True))
@@ -46,7 +49,7 @@ def delete_sqs_messages(queue_url, receipts):
         receipts: [list<string>] List of SQS receipt handles.
     """
     LOGGER.info('Deleting %d SQS receipt(s) from %s', len(receipts), queue_url)
-    boto3.client('sqs').delete_message_batch(
+    aws_clients.client('sqs').delete_message_batch(
         QueueUrl=queue_url,
         Entries=[
             {'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(receipts)]
@@ -100,7 +103,7 @@ def put_metric_data(num_yara_rules, binaries):
             'Unit': 'Milliseconds'
         }
     ]
-    boto3.client('cloudwatch').put_metric_data(Namespace='BinaryAlert', MetricData=metric_data)
+    aws_clients.client('cloudwatch').put_metric_data(Namespace='BinaryAlert', MetricData=metric_data)
 
 
 class DynamoMatchTable(object):
@@ -127,7 +130,7 @@ class DynamoMatchTable(object):
             table_name: [string] The name of the Dynamo table containing match information.
         """
         self._table_name = table_name
-        self._client = boto3.client('dynamodb')
+        self._client = aws_clients.client('dynamodb')
 
     def _most_recent_item(self, sha):
         """Query the table for the most recent entry with the given SHA.
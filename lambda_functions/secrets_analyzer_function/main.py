@@ -103,7 +103,8 @@ def secrets_analyze_lambda_handler(event_data, lambda_context):
                 LOGGER.info("%s doen't contain any matches", file)
         
 
-    aws_lib.delete_sqs_messages(os.environ['SQS_QUEUE_URL'], event_data['SQSReceipts'])
+    aws_lib.delete_sqs_messages(event_data.get('SQSQueueUrl') or os.environ['SQS_QUEUE_URL'],
+                                event_data['SQSReceipts'])
     
     # Publish to metrics
     try:
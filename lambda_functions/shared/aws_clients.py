@@ -0,0 +1,51 @@
+"""boto3 clients shared by everything running in a Lambda container.
+
+Building a client is slow (it loads the service model) and each client has its own connection
+pool, so clients are created once per service, region and pool size, then reused by every
+invocation of the warm container. boto3 clients are thread-safe once created.
+"""
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Botocore only opens pooled connections when they are needed, so a generous cap is cheap.
+DEFAULT_MAX_POOL_CONNECTIONS = int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', 50))
+# Adaptive retries add client-side rate limiting on top of exponential backoff for throttles.
+MAX_ATTEMPTS = int(os.environ.get('BOTO_MAX_ATTEMPTS', 5))
+
+_CLIENTS = {}
+# The default boto3 session is not thread-safe, so clients are built one at a time.
+_LOCK = threading.Lock()
+
+
+def client(service_name, region_name=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+           read_timeout=None):
+    """Return the shared client for an AWS service, creating it on first use.
+
+    Args:
+        service_name: [string] E.g. 's3' or 'dynamodb'.
+        region_name: [string] (optional) Defaults to the region of the Lambda function.
+        max_pool_connections: [int] (optional) Size of the client's HTTP connection pool; use at
+            least the number of threads which share the client.
+        read_timeout: [int] (optional) Seconds to wait for a response, e.g. longer than the
+            function timeout for synchronous Lambda invocations. Defaults to 60.
+
+    Returns:
+        A boto3 client configured with adaptive retries and TCP keep-alive.
+    """
+    key = (service_name, region_name, max_pool_connections, read_timeout)
+    with _LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = boto3.session.Session().client(
+                service_name,
+                region_name=region_name,
+                config=Config(
+                    max_pool_connections=max_pool_connections,
+                    retries={'max_attempts': MAX_ATTEMPTS, 'mode': 'adaptive'},
+                    tcp_keepalive=True,
+                    read_timeout=read_timeout or 60
+                )
+            )
+        return _CLIENTS[key]
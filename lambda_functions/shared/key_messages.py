@@ -0,0 +1,96 @@
+"""SQS message bodies carrying S3 object keys, in the legacy or the compact format.
+
+legacy:        The structure of an S3 object added event (the format of the bucket notifications):
+               {"Records": [{"s3": {"object": {"key": ..., "size": ..., "eTag": ...}}}, ...]}
+compact:       The keys without their common prefix, with sizes and ETags in parallel lists:
+               {"Prefix": ..., "Keys": [...], "Sizes": [...], "ETags": [...]}
+compact+gzip:  The compact body, gzipped and base64-encoded (which always starts with "H4sI").
+
+Objects are dicts with a 'key' and, if known, the 'size' and 'eTag' of the S3 object.
+"""
+import gzip
+import json
+import base64
+import os.path
+
+SQS_MAX_BYTES = 256 * 2 ** 10  # Limit for a single message and for a whole batch request.
+LEGACY, COMPACT, COMPACT_GZIP = 'legacy', 'compact', 'compact+gzip'
+MESSAGE_FORMATS = (LEGACY, COMPACT, COMPACT_GZIP)
+
+# Upper bound on the bytes of an empty body (compact keys, framing and the common prefix aside).
+BODY_OVERHEAD_BYTES = 64
+
+# The dispatcher expands messages into analyzer payloads with the full keys, sizes and ETags, and
+# never splits a message across payloads. Asynchronous invocations carry up to 256 KB, so the
+# objects of one message may add up to at most MESSAGE_PAYLOAD_MAX_BYTES of payload (leaving
+# room for the receipt handle and the rest of the payload), however small its body is.
+PAYLOAD_MAX_BYTES = 250 * 2 ** 10
+MESSAGE_PAYLOAD_MAX_BYTES = PAYLOAD_MAX_BYTES - 4 * 2 ** 10
+_GZIP_BASE64_MAGIC = 'H4sI'
+_SEPARATORS = (',', ':')
+
+
+def object_bytes(obj, message_format):
+    """Upper bound on the bytes an object adds to an uncompressed body."""
+    if message_format == LEGACY:
+        return len(json.dumps({'s3': {'object': obj}})) + 2
+    return (len(json.dumps(obj['key'])) + len(str(obj.get('size'))) +
+            len(json.dumps(obj.get('eTag'))) + 3)
+
+
+def payload_bytes(obj):
+    """Upper bound on the bytes an object adds to an analyzer payload of the dispatcher."""
+    return (len(json.dumps(obj['key'])) + len(str(obj.get('size'))) +
+            len(json.dumps(obj.get('eTag'))) + 6)
+
+
+def encode(objects, message_format):
+    """Serialize a list of objects into an SQS message body.
+
+    Returns:
+        [string] The message body.
+    """
+    if message_format == LEGACY:
+        return json.dumps({'Records': [{'s3': {'object': obj}} for obj in objects]})
+
+    keys = [obj['key'] for obj in objects]
+    prefix = os.path.commonprefix(keys)
+    body = {'Prefix': prefix, 'Keys': [key[len(prefix):] for key in keys]}
+    sizes = [obj.get('size') for obj in objects]
+    if any(size is not None for size in sizes):
+        body['Sizes'] = sizes
+    etags = [obj.get('eTag') for obj in objects]
+    if any(etags):
+        body['ETags'] = etags
+    body = json.dumps(body, separators=_SEPARATORS)
+
+    if message_format == COMPACT_GZIP:
+        return base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('ascii')
+    return body
+
+
+def decode(body):
+    """Parse a message body in any of the formats.
+
+    Returns:
+        [list<dict>] The objects, each with a 'key' and the 'size' and 'eTag' (or None).
+
+    Raises:
+        KeyError, ValueError: If the body is not a valid message in any format.
+    """
+    if body.startswith(_GZIP_BASE64_MAGIC):
+        body = gzip.decompress(base64.b64decode(body)).decode('utf-8')
+    data = json.loads(body)
+
+    if 'Records' in data:
+        objects = [record['s3']['object'] for record in data['Records']]
+        return [{'key': obj['key'], 'size': obj.get('size'), 'eTag': obj.get('eTag')}
+                for obj in objects]
+
+    keys = [data['Prefix'] + key for key in data['Keys']]
+    sizes = data.get('Sizes') or [None] * len(keys)
+    etags = data.get('ETags') or [None] * len(keys)
+    if not len(keys) == len(sizes) == len(etags):
+        raise ValueError('Keys, Sizes and ETags differ in length')
+    return [{'key': key, 'size': size, 'eTag': etag}
+            for key, size, etag in zip(keys, sizes, etags)]
@@ -0,0 +1,27 @@
+"""Fingerprint of everything a scan runs: the YARA rules plus the scanners combined with them.
+
+The analyzer keys its verdict cache on it and the batcher its incremental scan checkpoints, so
+changing either the rules or a combined scanner (e.g. the secrets detectors) starts over.
+"""
+import hashlib
+
+from typing import Iterable, Tuple
+
+
+def combine(rules_fingerprint: str, scanner_fingerprints: Iterable[Tuple[str, str]]) -> str:
+    """Combine the YARA rules fingerprint with the (name, fingerprint) of the extra scanners.
+
+    Args:
+        rules_fingerprint: [string] SHA256 of the compiled YARA rules.
+        scanner_fingerprints: [iterable] (scanner name, scanner fingerprint) pairs.
+
+    Returns:
+        [string] The rules fingerprint itself if there are no extra scanners, else a SHA256.
+    """
+    scanner_fingerprints = list(scanner_fingerprints)
+    if not scanner_fingerprints:
+        return rules_fingerprint
+    return hashlib.sha256(':'.join(
+        [rules_fingerprint] + ['{}={}'.format(name, fingerprint)
+                               for name, fingerprint in scanner_fingerprints]
+    ).encode('utf-8')).hexdigest()
@@ -0,0 +1,73 @@
+"""CloudWatch metrics written as Embedded Metric Format (EMF) log lines.
+
+CloudWatch Logs extracts the metrics from the JSON lines printed by the function, so publishing
+them costs no API call. Every value of a metric is kept (up to 100 per line), which lets
+CloudWatch compute percentiles rather than only the count/sum/min/max of a StatisticSet.
+"""
+import sys
+import json
+import time
+import collections
+import contextlib
+
+NAMESPACE = 'BinaryAlert'
+EMF_MAX_METRICS = 100  # Metrics per EMF directive.
+EMF_MAX_VALUES = 100  # Values per metric in a single log line.
+
+
+class MetricsLogger(object):
+    """Collects metric values during an invocation and prints them as EMF records on flush()."""
+
+    def __init__(self, namespace=NAMESPACE, dimensions=None):
+        """Initialize the logger.
+
+        Args:
+            namespace: [string] (optional) CloudWatch namespace of the metrics.
+            dimensions: [dict] (optional) Dimension name -> value attached to every metric.
+        """
+        self._namespace = namespace
+        self._dimensions = dimensions or {}
+        self._metrics = collections.OrderedDict()  # Metric name -> (unit, [values]).
+
+    def put_metric(self, name, value, unit='Count'):
+        """Record one value of a metric (call repeatedly to build a distribution)."""
+        self._metrics.setdefault(name, (unit, []))[1].append(value)
+        return self
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Record the time spent in the with-block as a value of the metric, in milliseconds."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.put_metric(name, (time.time() - start_time) * 1000, 'Milliseconds')
+
+    def _record(self, metrics):
+        # Build one EMF record, consuming up to EMF_MAX_VALUES values of each included metric.
+        names = list(metrics)[:EMF_MAX_METRICS]
+        record = dict(self._dimensions)
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self._namespace,
+                'Dimensions': [sorted(self._dimensions)],
+                'Metrics': [{'Name': name, 'Unit': metrics[name][0]} for name in names]
+            }]
+        }
+        for name in names:
+            unit, values = metrics[name]
+            record[name] = values[0] if len(values) == 1 else values[:EMF_MAX_VALUES]
+            if len(values) > EMF_MAX_VALUES:
+                metrics[name] = (unit, values[EMF_MAX_VALUES:])
+            else:
+                del metrics[name]
+        return record
+
+    def flush(self):
+        """Print the collected metrics as EMF log lines and start over."""
+        metrics, self._metrics = self._metrics, collections.OrderedDict()
+        while metrics:
+            # EMF records must be the whole log event, so bypass the logging prefix.
+            sys.stdout.write(json.dumps(self._record(metrics), separators=(',', ':')) + '\n')
+        sys.stdout.flush()
@@ -1,5 +1,6 @@
 import os
 import hcl
+import json
 import boto3
 import shutil
 import zipfile
@@ -7,8 +8,8 @@ import logging
 import argparse
 import subprocess
 
-from lambda_functions.analyzer_function.main import COMPILED_RULES_FILENAME
-from core.rules.compile_rules import compile_rules
+from lambda_functions.analyzer_function.main import COMPILED_RULES_FILENAME, EXTRA_SCANNERS
+from core.rules.compile_rules import compile_rules, RULES_METADATA_SUFFIX
 
 # LOGGER 
 LOGGER = logging.getLogger(__name__)
@@ -41,6 +42,15 @@ ANALYZE_LAMBDA_DEPENDENCIES =  os.path.join(ANALYZE_LAMBDA_DIR, 'yara_python_3.6
 BATCH_LAMBDA_SOURCE = os.path.join(PROJ_DIR, 'lambda_functions', 'batcher_function', 'main.py')
 BATCH_LAMBDA_PACKAGE = os.path.join(TERRAFORM_DIR, 'lambda_batcher.zip')
 
+# Modules shared by the Lambda functions, added at the root of each deployment package
+SHARED_LAMBDA_DIR = os.path.join(PROJ_DIR, 'lambda_functions', 'shared')
+SHARED_LAMBDA_SOURCES = [
+    os.path.join(SHARED_LAMBDA_DIR, 'aws_clients.py'),
+    os.path.join(SHARED_LAMBDA_DIR, 'key_messages.py'),
+    os.path.join(SHARED_LAMBDA_DIR, 'scan_fingerprint.py'),
+    os.path.join(SHARED_LAMBDA_DIR, 'telemetry.py')
+]
+
 # Dispatch Lambda function source and zip package
 DISPATCH_LAMBDA_SOURCE = os.path.join(PROJ_DIR, 'lambda_functions', 'dispatcher_function', 'main.py')
 DISPATCH_LAMBDA_PACKAGE = os.path.join(TERRAFORM_DIR, 'lambda_dispatcher.zip')
@@ -80,11 +90,34 @@ def test() -> None:
     # Run all uni tests and exit 1 if tests failed  
     return 
 
+def add_shared_modules_(pkg):
+    # Add the shared Lambda modules to an open deployment package
+    for source in SHARED_LAMBDA_SOURCES:
+        pkg.write(source, os.path.basename(source))
+
+def save_scanner_fingerprints_():
+    # Add the fingerprints of the extra scanners to the rules metadata, so the batcher checkpoints
+    # incremental scans per combination of YARA rules and scanners, like the verdict cache
+    rules_metadata = os.path.join(
+        ANALYZE_LAMBDA_DIR, COMPILED_RULES_FILENAME + RULES_METADATA_SUFFIX)
+    with open(rules_metadata) as metadata_file:
+        metadata = json.load(metadata_file)
+    metadata['ScannerFingerprints'] = {
+        name: scanner[0]().fingerprint for name, scanner in EXTRA_SCANNERS.items()}
+    with open(rules_metadata, 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+
 def build_batcher_():
     # Build the batcher Lambda deployment package
     print('Creating batcher deploy package...')
     with zipfile.ZipFile(BATCH_LAMBDA_PACKAGE, 'w') as pkg:
         pkg.write(BATCH_LAMBDA_SOURCE, os.path.basename(BATCH_LAMBDA_SOURCE))
+        add_shared_modules_(pkg)
+        # The rules and scanner fingerprints scope the checkpoints of incremental scans.
+        rules_metadata = os.path.join(
+            ANALYZE_LAMBDA_DIR, COMPILED_RULES_FILENAME + RULES_METADATA_SUFFIX)
+        if os.path.isfile(rules_metadata):
+            pkg.write(rules_metadata, os.path.basename(rules_metadata))
 
 
 def build_dispatcher_():
@@ -92,10 +125,12 @@ def build_dispatcher_():
     print('Creating dispatcher deploy package...')
     with zipfile.ZipFile(DISPATCH_LAMBDA_PACKAGE, 'w') as pkg:
         pkg.write(DISPATCH_LAMBDA_SOURCE, os.path.basename(DISPATCH_LAMBDA_SOURCE))
+        add_shared_modules_(pkg)
 
 def build_yara_server():
     # Clone the YARA-rules repo and compile the YARA rules
     compile_rules(os.path.join(ANALYZE_LAMBDA_DIR, COMPILED_RULES_FILENAME))
+    save_scanner_fingerprints_()
 
     # here we can call the manager and init an instance of central yara project which
     # should serve and update the s3 bucket with the latest yara rules as a server
@@ -113,12 +148,15 @@ def build_analyser_():
 
     # Zip up the package
     shutil.make_archive(ANALYZE_LAMBDA_PACKAGE, 'zip', ANALYZE_LAMBDA_DIR)
+    with zipfile.ZipFile(ANALYZE_LAMBDA_PACKAGE + '.zip', 'a') as pkg:
+        add_shared_modules_(pkg)
 
 def build_secrets_analyser_():
     # Build the SECRETS analyzer Lambda deployment package
     print('Creating secrets analyzer deploy package...')
     with zipfile.ZipFile(SECRETS_ANALYZE_LAMBDA_PACKAGE, 'w') as pkg:
         pkg.write(SECRETS_ANALYZE_LAMBDA_DIR, os.path.basename(SECRETS_ANALYZE_LAMBDA_DIR))
+        add_shared_modules_(pkg)
 
 def build() -> None:
     # Build the Lambda deployment packages
@@ -6,7 +6,7 @@ resource "aws_cloudwatch_metric_alarm" "batch_enqueue_errors" {
 
   alarm_description = <<EOF
 ${module.s3canner_batcher.function_name} failed to enqueue one or more S3 keys into the SQS queue
-${aws_sqs_queue.s3_object_queue.arn}.
+${aws_sqs_queue.s3_object_bulk_queue.arn}.
   - Check the batcher CloudWatch logs.
   - SQS may be down.
   - Once the problem has been resolved, re-execute the batcher (`manage.py analyze_all`) to analyze
@@ -55,3 +55,44 @@ resource "aws_dynamodb_table" "s3canner_secrets_matches" {
     Name = "S3canner"
   }
 }
+
+// DynamoDB table recording up to when the bucket was enqueued, for incremental rescans.
+resource "aws_dynamodb_table" "s3canner_scan_checkpoints" {
+  name           = "${var.name_prefix}_s3canner_scan_checkpoints"
+  hash_key       = "CheckpointId"
+  read_capacity  = 1
+  write_capacity = 1
+
+  attribute {
+    name = "CheckpointId"
+    type = "S"
+  }
+
+  tags = {
+    Name = "S3canner"
+  }
+}
+
+// DynamoDB table caching clean verdicts, so unchanged objects are not rescanned with the same rules.
+resource "aws_dynamodb_table" "s3canner_verdict_cache" {
+  name         = "${var.name_prefix}_s3canner_verdict_cache"
+  hash_key     = "CacheKey"
+  // Every clean object is written here (unlike the match tables, which see very few writes),
+  // so the table scales with the scan rate instead of sharing dynamo_write_capacity.
+  billing_mode = "PAY_PER_REQUEST"
+
+  attribute {
+    name = "CacheKey"
+    type = "S"
+  }
+
+  // Entries expire on their own once they are no longer useful.
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
+  }
+
+  tags = {
+    Name = "S3canner"
+  }
+}
@@ -10,11 +10,19 @@ module "s3canner_batcher" {
   filename        = "lambda_batcher.zip"
 
   environment_variables = {
-    BATCH_LAMBDA_NAME      = "${var.name_prefix}_s3canner_batcher"
-    BATCH_LAMBDA_QUALIFIER = "Production"
-    OBJECTS_PER_MESSAGE    = "${var.lambda_batch_objects_per_message}"
-    S3_BUCKET_NAME         = "${aws_s3_bucket.s3canner_binaries.id}"
-    SQS_QUEUE_URL          = "${aws_sqs_queue.s3_object_queue.id}"
+    BATCH_LAMBDA_NAME            = "${var.name_prefix}_s3canner_batcher"
+    BATCH_LAMBDA_QUALIFIER       = "Production"
+    OBJECTS_PER_MESSAGE          = "${var.lambda_batch_objects_per_message}"
+    BYTES_PER_MESSAGE            = "${var.lambda_batch_bytes_per_message}"
+    PARTITION_DELIMITER          = "${var.lambda_batch_partition_delimiter}"
+    PARTITION_BOUNDARIES         = "${var.lambda_batch_partition_boundaries}"
+    CHECKPOINT_DYNAMO_TABLE_NAME = "${aws_dynamodb_table.s3canner_scan_checkpoints.name}"
+    SQS_MESSAGE_FORMAT           = "${var.lambda_batch_message_format}"
+    ENQUEUE_MAX_RATE             = "${var.lambda_batch_max_enqueue_rate}"
+    S3_BUCKET_NAME               = "${aws_s3_bucket.s3canner_binaries.id}"
+    SQS_QUEUE_URL                = "${aws_sqs_queue.s3_object_bulk_queue.id}"
+    // Must match the analyzer's: the checkpoints are scoped to the rules and these scanners.
+    COMBINED_SCANNERS            = var.lambda_analyze_combined ? "secrets" : ""
   }
 
   log_retention_days = var.lambda_log_retention_days
@@ -38,16 +46,21 @@ module "s3canner_dispatcher" {
   base_policy_arn = aws_iam_policy.base_policy.arn
   handler         = "main.dispatch_lambda_handler"
   memory_size_mb  = var.lambda_dispatch_memory_mb
-  timeout_sec     = var.lambda_dispatch_timeout_sec
+  // The dispatcher waits for the analyzers it invokes.
+  timeout_sec     = var.lambda_analyze_timeout_sec + var.lambda_dispatch_timeout_sec
   filename        = "lambda_dispatcher.zip"
 
   environment_variables = {
     ANALYZE_LAMBDA_NAME              = "${module.s3canner_analyzer.function_name}"
     ANALYZE_LAMBDA_QUALIFIER         = "${module.s3canner_analyzer.alias_name}"
-    SECRETS_ANALYZE_LAMBDA_NAME      = "${module.s3canner_secrets_analyzer.function_name}"
+    // Empty with the combined analyzer: the secrets analyzer is not invoked separately.
+    SECRETS_ANALYZE_LAMBDA_NAME      = var.lambda_analyze_combined ? "" : "${module.s3canner_secrets_analyzer.function_name}"
     SECRETS_ANALYZE_LAMBDA_QUALIFIER = "${module.s3canner_secrets_analyzer.alias_name}"
     MAX_DISPATCHES                   = "${var.lambda_dispatch_limit}"
+    MAX_KEYS_PER_DISPATCH            = "${var.lambda_dispatch_max_keys}"
+    ANALYZE_TIMEOUT_SECONDS          = "${var.lambda_analyze_timeout_sec}"
     SQS_QUEUE_URL                    = "${aws_sqs_queue.s3_object_queue.id}"
+    BULK_SQS_QUEUE_URL               = "${aws_sqs_queue.s3_object_bulk_queue.id}"
   }
 
   log_retention_days = var.lambda_log_retention_days
@@ -61,6 +74,14 @@ resource "aws_lambda_event_source_mapping" "dispatcher_source_mapping" {
   event_source_arn = aws_sqs_queue.s3_object_queue.arn
   function_name    = module.s3canner_dispatcher.function_name
   batch_size       = 10
+
+  // Messages the dispatcher could not hand to the analyzers are left on the queue.
+  function_response_types = ["ReportBatchItemFailures"]
+
+  // Dispatchers wait for their analyzers, so this caps the analyzers working on new uploads.
+  scaling_config {
+    maximum_concurrency = var.lambda_dispatch_realtime_concurrency
+  }
 }
 
 resource "aws_lambda_permission" "dispacher_sqs_permission" {
@@ -72,6 +93,30 @@ resource "aws_lambda_permission" "dispacher_sqs_permission" {
   source_arn = aws_sqs_queue.s3_object_queue.arn
 }
 
+// Map the Lambda function to the bulk SQS queue, with limited concurrency so rescans leave room
+// for the real-time lane. The rest of the bulk backlog waits in the bulk queue.
+resource "aws_lambda_event_source_mapping" "dispatcher_bulk_source_mapping" {
+  event_source_arn = aws_sqs_queue.s3_object_bulk_queue.arn
+  function_name    = module.s3canner_dispatcher.function_name
+  batch_size       = 10
+
+  // Messages the dispatcher could not hand to the analyzers are left on the queue.
+  function_response_types = ["ReportBatchItemFailures"]
+
+  scaling_config {
+    maximum_concurrency = var.lambda_dispatch_bulk_concurrency
+  }
+}
+
+resource "aws_lambda_permission" "dispacher_bulk_sqs_permission" {
+  statement_id  = "AllowBulkSQS"
+  action        = "lambda:InvokeFunction"
+  function_name = module.s3canner_dispatcher.function_name
+  principal     = "sqs.amazonaws.com"
+
+  source_arn = aws_sqs_queue.s3_object_bulk_queue.arn
+}
+
 # // Allow dispatcher to be invoked via a CloudWatch rule.3
 # resource "aws_lambda_permission" "allow_cloudwatch_to_invoke_dispatch" {
 #   statement_id  = "AllowExecutionFromCloudWatch_${module.s3canner_dispatcher.function_name}"
@@ -122,16 +167,22 @@ module "s3canner_analyzer" {
   function_name   = "${var.name_prefix}_s3canner_analyzer"
   description     = "Analyze a obj with a set of YARA rules"
   base_policy_arn = aws_iam_policy.base_policy.arn
-  handler         = "main.analyze_lambda_handler"
+  handler         = var.lambda_analyze_combined ? "main.combined_analyze_lambda_handler" : "main.analyze_lambda_handler"
   memory_size_mb  = var.lambda_analyze_memory_mb
   timeout_sec     = var.lambda_analyze_timeout_sec
   filename        = "lambda_analyzer.zip"
 
   environment_variables = {
-    S3_BUCKET_NAME                 = "${aws_s3_bucket.s3canner_binaries.id}"
-    SQS_QUEUE_URL                  = "${aws_sqs_queue.s3_object_queue.id}"
-    YARA_MATCHES_DYNAMO_TABLE_NAME = "${aws_dynamodb_table.s3canner_yara_matches.name}"
-    YARA_ALERTS_SNS_TOPIC_ARN      = "${aws_sns_topic.yara_match_alerts.arn}"
+    S3_BUCKET_NAME                  = "${aws_s3_bucket.s3canner_binaries.id}"
+    SQS_QUEUE_URL                   = "${aws_sqs_queue.s3_object_queue.id}"
+    YARA_MATCHES_DYNAMO_TABLE_NAME  = "${aws_dynamodb_table.s3canner_yara_matches.name}"
+    YARA_ALERTS_SNS_TOPIC_ARN       = "${aws_sns_topic.yara_match_alerts.arn}"
+    VERDICT_CACHE_DYNAMO_TABLE_NAME = "${aws_dynamodb_table.s3canner_verdict_cache.name}"
+
+    // Used by the combined analyzer, which also runs the secrets scan.
+    SECRETS_MATCHES_DYNAMO_TABLE_NAME = "${aws_dynamodb_table.s3canner_secrets_matches.name}"
+    SECRETS_ALERTS_SNS_TOPIC_ARN      = "${aws_sns_topic.secrets_match_alerts.arn}"
+    COMBINED_SCANNERS                 = var.lambda_analyze_combined ? "secrets" : ""
   }
 
   log_retention_days = var.lambda_log_retention_days
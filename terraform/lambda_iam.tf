@@ -39,8 +39,25 @@ data "aws_iam_policy_document" "s3canner_batcher_policy" {
   statement {
     sid       = "SendMessageToSQS"
     effect    = "Allow"
-    actions   = ["sqs:SendMessage*"]
-    resources = ["${aws_sqs_queue.s3_object_queue.arn}"]
+    actions   = ["sqs:SendMessage*", "sqs:GetQueueAttributes"]
+    resources = ["${aws_sqs_queue.s3_object_bulk_queue.arn}"]
+  }
+
+  statement {
+    sid       = "ReadAndWriteScanCheckpoints"
+    effect    = "Allow"
+    actions   = ["dynamodb:GetItem", "dynamodb:PutItem"]
+    resources = ["${aws_dynamodb_table.s3canner_scan_checkpoints.arn}"]
+  }
+
+  dynamic "statement" {
+    for_each = var.s3_inventory_bucket_name == "" ? [] : [var.s3_inventory_bucket_name]
+    content {
+      sid       = "ReadS3InventoryReports"
+      effect    = "Allow"
+      actions   = ["s3:GetObject"]
+      resources = ["arn:aws:s3:::${statement.value}/*"]
+    }
   }
 }
 
@@ -63,12 +80,16 @@ data "aws_iam_policy_document" "s3canner_dispatcher_policy" {
     effect = "Allow"
 
     actions = [
+      "sqs:ChangeMessageVisibility",
       "sqs:DeleteMessage",
       "sqs:ReceiveMessage",
       "sqs:GetQueueAttributes",
     ]
 
-    resources = ["${aws_sqs_queue.s3_object_queue.arn}"]
+    resources = [
+      "${aws_sqs_queue.s3_object_queue.arn}",
+      "${aws_sqs_queue.s3_object_bulk_queue.arn}",
+    ]
   }
 }
 
@@ -84,12 +105,29 @@ data "aws_iam_policy_document" "s3canner_analyzer_policy" {
     effect = "Allow"
 
     actions = [
+      "dynamodb:BatchWriteItem",
       "dynamodb:PutItem",
       "dynamodb:Query",
       "dynamodb:UpdateItem",
     ]
 
-    resources = ["${aws_dynamodb_table.s3canner_yara_matches.arn}"]
+    // The secrets matches are saved by the combined analyzer.
+    resources = [
+      "${aws_dynamodb_table.s3canner_yara_matches.arn}",
+      "${aws_dynamodb_table.s3canner_secrets_matches.arn}",
+    ]
+  }
+
+  statement {
+    sid    = "ReadAndWriteVerdictCache"
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:BatchWriteItem",
+    ]
+
+    resources = ["${aws_dynamodb_table.s3canner_verdict_cache.arn}"]
   }
 
   statement {
@@ -103,14 +141,22 @@ data "aws_iam_policy_document" "s3canner_analyzer_policy" {
     sid       = "PublishAlertsToSNS"
     effect    = "Allow"
     actions   = ["sns:Publish"]
-    resources = ["${aws_sns_topic.yara_match_alerts.arn}"]
+    resources = ["${aws_sns_topic.yara_match_alerts.arn}", "${aws_sns_topic.secrets_match_alerts.arn}"]
   }
 
   statement {
     sid       = "DeleteSQSMessages"
     effect    = "Allow"
     actions   = ["sqs:DeleteMessage"]
-    resources = ["${aws_sqs_queue.s3_object_queue.arn}"]
+    resources = ["${aws_sqs_queue.s3_object_queue.arn}", "${aws_sqs_queue.s3_object_bulk_queue.arn}"]
+  }
+
+  // Keys left unfinished near the timeout are re-enqueued.
+  statement {
+    sid       = "RequeueSQSMessages"
+    effect    = "Allow"
+    actions   = ["sqs:SendMessage"]
+    resources = ["${aws_sqs_queue.s3_object_queue.arn}", "${aws_sqs_queue.s3_object_bulk_queue.arn}"]
   }
 }
 
@@ -152,7 +198,7 @@ data "aws_iam_policy_document" "s3canner_secrets_analyzer_policy" {
     sid       = "DeleteSQSMessages"
     effect    = "Allow"
     actions   = ["sqs:DeleteMessage"]
-    resources = ["${aws_sqs_queue.s3_object_queue.arn}"]
+    resources = ["${aws_sqs_queue.s3_object_queue.arn}", "${aws_sqs_queue.s3_object_bulk_queue.arn}"]
   }
 }
 
@@ -32,8 +32,20 @@ resource "aws_sqs_queue" "s3_object_queue" {
   name = "${var.name_prefix}_s3canner_s3_object_queue"
 
   // When a message is received, it will be hidden from the queue for this long.
-  // Set to just a few seconds after the lambda analyzer would timeout.
-  visibility_timeout_seconds = format("%d", var.lambda_analyze_timeout_sec + 2)
+  // Set to just a few seconds after the dispatcher (which waits for the analyzer) would timeout.
+  visibility_timeout_seconds = format("%d", var.lambda_analyze_timeout_sec + var.lambda_dispatch_timeout_sec + 2)
+
+  message_retention_seconds = format("%d", var.sqs_retention_minutes * 60)
+
+  kms_master_key_id = aws_kms_key.s3_object_queue_key.arn
+}
+
+// Queue of S3 objects to be re-analyzed by the batcher (bulk lane). The dispatcher drains the
+// s3_object_queue (real-time lane, new uploads) first, so rescans do not delay new verdicts.
+resource "aws_sqs_queue" "s3_object_bulk_queue" {
+  name = "${var.name_prefix}_s3canner_s3_object_bulk_queue"
+
+  visibility_timeout_seconds = format("%d", var.lambda_analyze_timeout_sec + var.lambda_dispatch_timeout_sec + 2)
 
   message_retention_seconds = format("%d", var.sqs_retention_minutes * 60)
 
@@ -15,14 +15,32 @@ variable "tagged_name" {
 
 variable "lambda_batch_objects_per_message" {
 }
+variable "lambda_batch_bytes_per_message" {
+}
+variable "lambda_batch_max_enqueue_rate" {
+}
+variable "lambda_batch_message_format" {
+}
+variable "lambda_batch_partition_delimiter" {
+}
+variable "lambda_batch_partition_boundaries" {
+}
 variable "lambda_batch_memory_mb" {
 }
+variable "s3_inventory_bucket_name" {
+}
 
 
 variable "lambda_dispatch_frequency_minutes" {
 }
 variable "lambda_dispatch_limit" {
 }
+variable "lambda_dispatch_realtime_concurrency" {
+}
+variable "lambda_dispatch_bulk_concurrency" {
+}
+variable "lambda_dispatch_max_keys" {
+}
 variable "lambda_dispatch_memory_mb" {
 }
 variable "lambda_dispatch_timeout_sec" {
@@ -35,6 +53,8 @@ variable "lambda_analyze_memory_mb" {
 }
 variable "lambda_analyze_timeout_sec" {
 }
+variable "lambda_analyze_combined" {
+}
 
 
 variable "dynamo_read_capacity" {
@@ -0,0 +1,158 @@
+import types
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('yara')
+
+from lambda_functions.analyzer_function import main as analyzer
+from lambda_functions.shared import key_messages
+
+
+class _FakeSQS(object):
+    # Records the objects of each message sent; entries with a key in `failing` are rejected.
+
+    def __init__(self, failing=()):
+        self.sent = []
+        self._failing = failing
+
+    def send_message_batch(self, QueueUrl, Entries):
+        failed = []
+        for entry in Entries:
+            objects = key_messages.decode(entry['MessageBody'])
+            if any(obj['key'] in self._failing for obj in objects):
+                failed.append({'Id': entry['Id'], 'Message': 'throttled'})
+            else:
+                self.sent.append(objects)
+        return {'Failed': failed}
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    # Fake SQS client of aws_lib; returns (client, deleted receipts).
+    client, deleted = _FakeSQS(), []
+    monkeypatch.setattr(analyzer.aws_lib.aws_clients, 'client', lambda service, **kwargs: client)
+    monkeypatch.setattr(analyzer.aws_lib, 'delete_sqs_messages',
+                        lambda queue_url, receipts: deleted.extend(receipts))
+    return client, deleted
+
+
+def _event(keys_per_message):
+    keys = [key for keys in keys_per_message for key in keys]
+    return {'S3Objects': keys, 'S3ObjectSizes': [len(key) for key in keys],
+            'S3ObjectETags': ['etag-' + key for key in keys],
+            'SQSReceipts': ['r{}'.format(index) for index in range(len(keys_per_message))],
+            'SQSKeyCounts': [len(keys) for keys in keys_per_message]}
+
+
+def test_tracker_deletes_done_and_reenqueues_rest(sqs):
+    client, deleted = sqs
+    tracker = analyzer.SQSMessageTracker('queue', _event([['a'], ['b', 'cc', 'd']]))
+    tracker.key_done('a')
+    tracker.key_done('b')
+    assert deleted == ['r0']
+
+    # The unfinished keys keep their sizes and ETags, and their message is deleted once they
+    # are back in the queue.
+    tracker.finish()
+    assert client.sent == [[{'key': 'cc', 'size': 2, 'eTag': 'etag-cc'},
+                            {'key': 'd', 'size': 1, 'eTag': 'etag-d'}]]
+    assert deleted == ['r0', 'r1']
+
+
+def test_tracker_keeps_message_when_reenqueue_fails(sqs):
+    client, deleted = sqs
+    client._failing = {'b'}
+    tracker = analyzer.SQSMessageTracker('queue', _event([['a'], ['b']]))
+    tracker.finish()
+
+    # Only the message whose keys were re-enqueued is deleted; the other is redelivered.
+    assert client.sent == [[{'key': 'a', 'size': 1, 'eTag': 'etag-a'}]]
+    assert deleted == ['r0']
+
+
+class _ScannedPrefetcher(object):
+    # Hands out the binaries as scanned without matches.
+
+    def __init__(self, binaries, **kwargs):
+        self._binaries = binaries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        for binary in self._binaries:
+            binary.downloaded = binary.scanned = True
+            yield binary
+
+
+class _FailingPrefetcher(object):
+    # Hands out the first binary as a YARA match, then fails like a vanished object would.
+
+    def __init__(self, binaries, **kwargs):
+        self._binaries = binaries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        binary = self._binaries[0]
+        binary.downloaded = binary.scanned = True
+        binary.yara_matches = [types.SimpleNamespace(
+            namespace='rules.yara', rule='evil', strings=[], meta={}, tags=[])]
+        yield binary
+        raise RuntimeError('NoSuchKey')
+
+
+@pytest.fixture
+def handler_env(monkeypatch):
+    # Run the handler without YARA rules or AWS; returns the keys saved as matches.
+    for name in ('S3_BUCKET_NAME', 'SQS_QUEUE_URL', 'YARA_MATCHES_DYNAMO_TABLE_NAME',
+                 'YARA_ALERTS_SNS_TOPIC_ARN'):
+        monkeypatch.setenv(name, name.lower())
+    monkeypatch.delenv('VERDICT_CACHE_DYNAMO_TABLE_NAME', raising=False)
+    monkeypatch.setattr(analyzer, 'SCAN_WORKERS', 1)
+    monkeypatch.setattr(analyzer, '_get_analyzer',
+                        lambda: types.SimpleNamespace(num_rules=1, fingerprint='rules'))
+    saved = []
+    monkeypatch.setattr(analyzer, 'save_matches_and_alert_batch',
+                        lambda binaries, *args: saved.extend(b.object_key for b in binaries))
+    return saved
+
+
+def _context(remaining_ms):
+    remaining_ms = iter(remaining_ms)
+    return types.SimpleNamespace(function_version='1',
+                                 get_remaining_time_in_millis=lambda: next(remaining_ms))
+
+
+def test_deadline_reenqueues_remaining_keys(handler_env, sqs, monkeypatch):
+    client, deleted = sqs
+    monkeypatch.setattr(analyzer, 'S3Prefetcher', _ScannedPrefetcher)
+
+    # Out of time after the first key: the rest is handed off with its sizes and ETags.
+    result = analyzer.analyze_lambda_handler(_event([['a', 'bb'], ['ccc']]),
+                                             _context([300000, 0]))
+    assert list(result) == ['S3:s3_bucket_name:a']
+    assert client.sent == [[{'key': 'bb', 'size': 2, 'eTag': 'etag-bb'}],
+                           [{'key': 'ccc', 'size': 3, 'eTag': 'etag-ccc'}]]
+    assert deleted == ['r0', 'r1']
+
+
+def test_matches_saved_when_scanning_fails(handler_env, sqs, monkeypatch):
+    _, deleted = sqs
+    monkeypatch.setattr(analyzer, 'S3Prefetcher', _FailingPrefetcher)
+
+    event = {'S3Objects': ['a', 'b'], 'SQSReceipts': ['r1', 'r2'], 'SQSKeyCounts': [1, 1]}
+    with pytest.raises(RuntimeError):
+        analyzer.analyze_lambda_handler(event, _context([300000] * 2))
+
+    # The match found before the failure is saved and its message deleted; 'b' is redelivered.
+    assert handler_env == ['a']
+    assert deleted == ['r1']
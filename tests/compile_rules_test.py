@@ -0,0 +1,97 @@
+import re
+import types
+
+import pytest
+
+pytest.importorskip('yara')
+
+from core.rules import compile_rules
+
+
+@pytest.fixture
+def partition(tmp_path, monkeypatch):
+    # Partition a rule file; YARA itself is replaced by a name scan of the source.
+    def compile_stub(filepath, externals):
+        with open(filepath) as rule_file:
+            source = compile_rules._strip_comments(rule_file.read())
+        return [types.SimpleNamespace(identifier=name)
+                for name in re.findall(r'\brule\s+(\w+)', source)]
+    monkeypatch.setattr(compile_rules, 'yara', types.SimpleNamespace(compile=compile_stub))
+
+    def _partition(source):
+        rule_file = tmp_path / 'rules.yara'
+        rule_file.write_text(source)
+        return compile_rules._partition_rules(str(rule_file))
+    return _partition
+
+
+def _classes(grouped):
+    return {file_class: [re.search(r'rule\s+(\w+)', text).group(1) for text in texts]
+            for file_class, texts in grouped.items()}
+
+
+def test_magic_anchors(partition):
+    grouped, imports = partition('''
+        rule pe_rule { strings: $a = "x" condition: uint16(0) == 0x5A4D and $a }
+        rule elf_rule { condition: (uint32(0) == 0x464c457f) and filesize < 1MB }
+        rule mixed { condition: uint16(0) == 0x5a4d or uint32(0) == 0x464c457f }
+        rule loose { strings: $a = "uint16(0) == 0x5a4d" condition: $a }
+    ''')
+    assert imports == []
+    assert _classes(grouped) == {'pe': ['pe_rule'], 'elf': ['elf_rule'],
+                                 'generic': ['mixed', 'loose']}
+
+
+def test_rules_using_modules(partition):
+    grouped, imports = partition('''
+        import "pe"
+        import "math"
+        rule signed { condition: pe.number_of_signatures > 0 and math.entropy(0, 10) > 7 }
+        rule exports { condition: pe.exports("ServiceMain") }
+        rule entropy { condition: math.entropy(0, filesize) > 7.5 }
+    ''')
+    assert imports == ['import "pe"', 'import "math"']
+    assert _classes(grouped) == {'pe': ['signed', 'exports'], 'generic': ['entropy']}
+
+
+def test_rule_referencing_another_rule(partition):
+    # Both the referenced rule and the referencing one stay generic.
+    grouped, _ = partition('''
+        private rule is_pe { condition: uint16(0) == 0x5a4d }
+        rule packed { strings: $a = "UPX0" condition: is_pe and $a }
+        rule other { condition: uint32(0) == 0x464c457f }
+    ''')
+    assert _classes(grouped) == {'generic': ['is_pe', 'packed'], 'elf': ['other']}
+
+
+def test_global_rule_keeps_file_whole(partition):
+    assert partition('''
+        global rule small { condition: filesize < 10MB }
+        rule pe_rule { condition: uint16(0) == 0x5a4d }
+    ''') is None
+
+
+@pytest.mark.parametrize('source', [
+    'include "other.yara"\nrule a { condition: uint16(0) == 0x5a4d }',
+    'rule a { condition: uint16(0) == 0x5a4d',  # Unbalanced braces.
+    'rule a { strings: $a = "x" }',  # No condition.
+    'rule a { condition: uint16(0) == 0x5a4d } rule b { condition: any of (a*) }',
+])
+def test_unparseable_falls_back_to_generic(partition, source):
+    assert partition(source) is None
+
+
+def test_yara_disagreement_falls_back_to_generic(partition, monkeypatch):
+    # A rule the splitter did not see (e.g. odd formatting) keeps the whole file generic.
+    monkeypatch.setattr(compile_rules, 'yara', types.SimpleNamespace(
+        compile=lambda filepath, externals: [types.SimpleNamespace(identifier=name)
+                                             for name in ('a', 'hidden')]))
+    assert partition('rule a { condition: uint16(0) == 0x5a4d }') is None
+
+
+def test_comments_ignored(partition):
+    grouped, _ = partition('''
+        // rule commented_out { condition: true }
+        rule pe_rule { /* uint32(0) == 0x464c457f or */ condition: uint16(0) == 0x5a4d }
+    ''')
+    assert _classes(grouped) == {'pe': ['pe_rule']}
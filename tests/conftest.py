@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The Lambda modules are imported from the repository root, as in the deployment packages.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Clients are created when the Lambda modules are imported (no request is sent).
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('MAX_DISPATCHES', '4')
+
+# Manual scripts which talk to a deployed stack, not tests.
+collect_ignore = ['batcher_function_test.py']
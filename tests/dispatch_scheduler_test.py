@@ -0,0 +1,143 @@
+import io
+import json
+import threading
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.batcher_function import main as batcher
+from lambda_functions.dispatcher_function import main as dispatcher
+from lambda_functions.shared import key_messages
+
+INVOKE_MAX_BYTES = 256 * 2 ** 10  # Payload limit of an asynchronous Lambda invocation.
+
+
+class _Invoker(object):
+    # Records the JSON payloads it is called with (from the scheduler's threads).
+    def __init__(self):
+        self.payloads = []
+        self._lock = threading.Lock()
+
+    def __call__(self, payload):
+        with self._lock:
+            self.payloads.append(json.dumps(payload))
+
+
+class _FakeSQS(object):
+    def __init__(self):
+        self.bodies = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.bodies.extend(entry['MessageBody'] for entry in Entries)
+        return {}
+
+
+def _records(bodies):
+    return {'Records': [{'messageId': str(index), 'receiptHandle': 'receipt-{:0200d}'.format(index),
+                         'body': body} for index, body in enumerate(bodies)]}
+
+
+@pytest.mark.parametrize('message_format', [
+    key_messages.LEGACY, key_messages.COMPACT, key_messages.COMPACT_GZIP])
+def test_batched_messages_fit_one_invocation(monkeypatch, message_format):
+    # Long keys which compress well: the decoded payload is much larger than the SQS message.
+    sqs = _FakeSQS()
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', sqs)
+    sqs_batcher = batcher.SQSBatcher('queue', 100000, message_format=message_format)
+    keys = ['samples/{}/{:06d}'.format('x' * 900, index) for index in range(3000)]
+    for key in keys:
+        sqs_batcher.add_key(key, 1024, '0123456789abcdef0123456789abcdef')
+    sqs_batcher.flash()
+
+    invoker = _Invoker()
+    scheduler = dispatcher.DispatchScheduler([invoker], max_dispatches=len(sqs.bodies),
+                                             max_keys=0, max_bytes=0)
+    for message in dispatcher._decode_messages(_records(sqs.bodies)):
+        scheduler.add(message, 'queue')
+    assert scheduler.finish() == []
+
+    assert max(len(payload) for payload in invoker.payloads) <= INVOKE_MAX_BYTES
+    dispatched = [key for payload in invoker.payloads for key in json.loads(payload)['S3Objects']]
+    assert sorted(dispatched) == sorted(keys)
+
+
+def test_messages_are_merged_but_never_split():
+    invoker = _Invoker()
+    scheduler = dispatcher.DispatchScheduler([invoker], max_dispatches=10, max_keys=5, max_bytes=0)
+    bodies = [key_messages.encode([{'key': '{}-{}'.format(message, index)} for index in range(3)],
+                                  key_messages.COMPACT) for message in range(4)]
+    for message in dispatcher._decode_messages(_records(bodies)):
+        scheduler.add(message, 'queue')
+    assert scheduler.finish() == []
+
+    payloads = [json.loads(payload) for payload in invoker.payloads]
+    assert [payload['SQSKeyCounts'] for payload in payloads] == [[3]] * 4
+
+
+def test_messages_past_the_dispatch_budget_are_left_over():
+    invoker = _Invoker()
+    scheduler = dispatcher.DispatchScheduler([invoker], max_dispatches=2, max_keys=3, max_bytes=0)
+    bodies = [key_messages.encode([{'key': str(message)}] * 3, key_messages.COMPACT)
+              for message in range(4)]
+    for message in dispatcher._decode_messages(_records(bodies)):
+        scheduler.add(message, 'queue')
+
+    leftover = scheduler.finish()
+    assert len(invoker.payloads) == 2
+    assert [message['MessageId'] for message in leftover] == ['2', '3']
+
+
+class _FakeLambda(object):
+    # Synchronous invocations: fails the payloads whose first key starts with 'fail'.
+    def __init__(self):
+        self.invocation_types = []
+
+    def invoke(self, FunctionName, InvocationType, Payload, Qualifier):
+        self.invocation_types.append(InvocationType)
+        failed = json.loads(Payload)['S3Objects'][0].startswith('fail')
+        response = {'StatusCode': 200, 'Payload': io.BytesIO(b'{}')}
+        if failed:
+            response['FunctionError'] = 'Unhandled'
+        return response
+
+
+@pytest.mark.parametrize('first_key, failures', [
+    ('ok', []), ('fail', [{'itemIdentifier': str(index)} for index in range(3)])])
+def test_failed_analyzers_leave_their_messages_on_the_queue(monkeypatch, first_key, failures):
+    monkeypatch.setattr(dispatcher, 'LAMBDA_CLIENT', _FakeLambda())
+    monkeypatch.setattr(dispatcher, 'SECRETS_ANALYZE_LAMBDA_NAME', '')
+    event = _records([key_messages.encode([{'key': '{}-{}'.format(first_key, index)}],
+                                          key_messages.COMPACT) for index in range(3)])
+    for record in event['Records']:
+        record['eventSourceARN'] = 'arn:aws:sqs:eu-central-1:0:queue'
+
+    # The three messages are merged into one payload, which waits for the analyzer.
+    assert dispatcher.dispatch_lambda_handler(event, None) == {'batchItemFailures': failures}
+    assert dispatcher.LAMBDA_CLIENT.invocation_types == ['RequestResponse']
+
+
+def test_bulk_dispatchers_drain_the_realtime_lane_first(monkeypatch):
+    fake_lambda = _FakeLambda()
+    monkeypatch.setattr(dispatcher, 'LAMBDA_CLIENT', fake_lambda)
+    monkeypatch.setattr(dispatcher, 'SECRETS_ANALYZE_LAMBDA_NAME', '')
+    monkeypatch.setattr(dispatcher, 'SQS_QUEUE_URL', 'https://sqs/0/realtime')
+    monkeypatch.setattr(dispatcher, 'BULK_SQS_QUEUE_URL', 'https://sqs/0/bulk')
+    pending = [key_messages.encode([{'key': 'new-upload'}], key_messages.LEGACY)]
+
+    def receive(queue_url, wait_time_seconds):
+        assert queue_url.endswith('realtime')
+        received = [{'body': body, 'receiptHandle': 'realtime-receipt'} for body in pending]
+        del pending[:]
+        return received
+    monkeypatch.setattr(dispatcher, 'receive_message_sqs', receive)
+
+    payloads = []
+    monkeypatch.setattr(fake_lambda, 'invoke', lambda **kwargs: payloads.append(
+        json.loads(kwargs['Payload'])) or {'StatusCode': 200})
+    event = _records([key_messages.encode([{'key': 'rescan'}], key_messages.COMPACT)])
+    event['Records'][0]['eventSourceARN'] = 'arn:aws:sqs:eu-central-1:0:bulk'
+
+    assert dispatcher.dispatch_lambda_handler(event, None) == {'batchItemFailures': []}
+    assert [(payload['SQSQueueUrl'], payload['S3Objects']) for payload in payloads] == [
+        ('https://sqs/0/realtime', ['new-upload']), ('https://sqs/0/bulk', ['rescan'])]
@@ -0,0 +1,98 @@
+import types
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.analyzer_function import aws_lib
+
+
+class _FakeDynamo(object):
+    # In-memory match table: items keyed by (SHA256, LambdaVersion)
+
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+
+    def _key(self, key):
+        return key['SHA256']['S'], int(key['LambdaVersion']['N'])
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, Limit, **kwargs):
+        self.calls.append('query')
+        sha = ExpressionAttributeValues[':sha']['S']
+        above = int(ExpressionAttributeValues.get(':version', {'N': '-1'})['N'])
+        versions = sorted((version for item_sha, version in self.items
+                           if item_sha == sha and version > above), reverse=True)
+        return {'Items': [self.items[(sha, version)] for version in versions[:Limit]]}
+
+    def update_item(self, Key, ExpressionAttributeValues, ReturnValues='NONE', **kwargs):
+        self.calls.append('update_item')
+        key = self._key(Key)
+        old = self.items.get(key)
+        item = dict(old or Key)
+        item['S3Objects'] = {'SS': sorted(set(item.get('S3Objects', {}).get('SS', [])) |
+                                          set(ExpressionAttributeValues[':s3_string_set']['SS']))}
+        if ':rules' in ExpressionAttributeValues:
+            item['MatchedRules'] = ExpressionAttributeValues[':rules']
+        self.items[key] = item
+        return {'Attributes': old} if old and ReturnValues == 'ALL_OLD' else {}
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append('batch_write_item')
+        for requests in RequestItems.values():
+            for request in requests:
+                item = request['PutRequest']['Item']
+                self.items[self._key(item)] = item
+        return {}
+
+
+def _table():
+    table = aws_lib.DynamoMatchTable('matches')
+    table._client = _FakeDynamo()
+    return table
+
+
+def _binary(sha='ab' * 32, key='a.exe'):
+    return types.SimpleNamespace(
+        computed_sha=sha, computed_md5='cd' * 16, matched_rule_ids=['rule'],
+        s3_identifier='S3:bucket:' + key, reported_md5='', observed_path='')
+
+
+def test_upsert_queries_only_new_entries():
+    table = _table()
+    assert table.upsert_matches(_binary(key='a.exe'), 2)
+    assert table._client.calls == ['update_item', 'query']
+
+    # This version already matched the SHA: one round trip.
+    table._client.calls = []
+    assert table.upsert_matches(_binary(key='b.exe'), 2)
+    assert table._client.calls == ['update_item']
+    assert table._client.items[('ab' * 32, 2)]['S3Objects']['SS'] == [
+        'S3:bucket:a.exe', 'S3:bucket:b.exe']
+
+
+def test_upsert_no_alert_behind_newer_version():
+    table = _table()
+    table.upsert_matches(_binary(), 3)
+    assert not table.upsert_matches(_binary(), 2)
+
+
+def test_batch_and_upsert_alert_alike():
+    # Repeated SHAs within the batch, a known SHA, an older and a newer Lambda version.
+    history = [(_binary('11' * 32, 'old.exe'), 5)]
+    batch = [_binary('22' * 32, 'a.exe'), _binary('22' * 32, 'b.exe'),
+             _binary('11' * 32, 'c.exe'), _binary('22' * 32, 'a.exe')]
+
+    alerts = {}
+    for mode in ('batch', 'upsert'):
+        table = _table()
+        for binary, version in history:
+            table.upsert_matches(binary, version)
+        if mode == 'batch':
+            alerts[mode] = table.save_matches_batch(batch, 4) + table.save_matches_batch(batch, 6)
+        else:
+            alerts[mode] = [table.upsert_matches(binary, version)
+                            for version in (4, 6) for binary in batch]
+
+    # Only the binary already matched by a newer version (5) is not alerted on.
+    assert alerts['batch'] == alerts['upsert'] == [True, True, False, True] + [True] * 4
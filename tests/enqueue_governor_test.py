@@ -0,0 +1,144 @@
+import types
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.batcher_function import main as batcher
+
+
+class _FakeClock(object):
+    # time.time() and time.sleep() without waiting
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class _FakeQueue(object):
+    # get_queue_attributes() reporting the backlog set by the test
+    def __init__(self, backlog=0):
+        self.backlog = backlog
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {'Attributes': {'ApproximateNumberOfMessages': str(self.backlog),
+                               'ApproximateNumberOfMessagesNotVisible': '0',
+                               'MessageRetentionPeriod': '345600'}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _FakeClock()
+    monkeypatch.setattr(batcher, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    fake = _FakeQueue()
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', fake)
+    return fake
+
+
+def test_rate_ramps_up_while_queue_is_short(clock, queue):
+    governor = batcher.EnqueueGovernor('queue', max_rate=8, max_backlog=100, poll_seconds=10)
+    for _ in range(4):
+        assert governor.acquire(10, deadline=clock.now + 60)
+        clock.now += 10
+    assert governor.rate == 8
+
+
+def test_rate_follows_drain_rate_when_half_full(clock, queue):
+    governor = batcher.EnqueueGovernor('queue', max_rate=100, max_backlog=100, poll_seconds=10,
+                                       state={'Rate': 50, 'DrainRate': 2.0})
+    queue.backlog = 60
+    assert governor.acquire(1, deadline=clock.now + 60)
+    assert governor.rate == 2.0
+
+
+def test_drain_rate_estimated_from_backlog(clock, queue):
+    governor = batcher.EnqueueGovernor('queue', max_rate=100, max_backlog=1000, poll_seconds=10)
+    queue.backlog, first_poll = 100, clock.now
+    governor.acquire(1, deadline=clock.now + 60)
+
+    # 1 message sent since, yet the backlog dropped by 39: 40 messages were drained.
+    clock.now += 10
+    queue.backlog = 61
+    governor.acquire(1, deadline=clock.now + 60)
+    # Averaged with the initial estimate (0).
+    assert governor.drain_rate == pytest.approx(40 / (clock.now - first_poll) / 2)
+
+
+def test_saturated_queue_pauses_until_deadline(clock, queue):
+    governor = batcher.EnqueueGovernor('queue', max_rate=100, max_backlog=100, poll_seconds=10)
+    queue.backlog = 100
+    assert not governor.acquire(1, deadline=clock.now + 5)
+    assert governor.rate == 0.0
+    assert governor.state() == {'Rate': 0.0, 'DrainRate': 0.0}
+
+
+class _SaturatingGovernor(object):
+    # Allows the first batch only.
+    def __init__(self, *args, **kwargs):
+        self.batches = 0
+
+    def acquire(self, num_messages, deadline):
+        self.batches += 1
+        return self.batches == 1
+
+    def consume(self, num_messages):
+        pass
+
+    def state(self):
+        return {}
+
+
+class _FakeBucket(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.requests = []
+
+    def list_objects_v2(self, Bucket, StartAfter='', **kwargs):
+        self.requests.append(StartAfter)
+        return {'IsTruncated': False, 'Contents': [
+            {'Key': key, 'Size': 1, 'ETag': '"etag"'} for key in self.keys if key > StartAfter]}
+
+
+class _FakeSQS(object):
+    def __init__(self):
+        self.keys = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.keys.extend(entry['Id'] for entry in Entries)
+        return {}
+
+
+def test_saturation_stops_within_a_page(monkeypatch):
+    for name, value in (('S3_BUCKET_NAME', 'bucket'), ('SQS_QUEUE_URL', 'queue'),
+                        ('OBJECTS_PER_MESSAGE', '1'), ('BATCH_LAMBDA_NAME', 'batcher'),
+                        ('BATCH_LAMBDA_QUALIFIER', 'Production')):
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('CHECKPOINT_DYNAMO_TABLE_NAME', raising=False)
+    monkeypatch.delenv('PARTITION_DELIMITER', raising=False)
+    monkeypatch.delenv('PARTITION_BOUNDARIES', raising=False)
+    monkeypatch.setattr(batcher, 'ENQUEUE_MAX_RATE', 10)
+    monkeypatch.setattr(batcher, 'EnqueueGovernor', _SaturatingGovernor)
+    bucket, sqs, invoked = _FakeBucket(['{:02}'.format(i) for i in range(25)]), _FakeSQS(), []
+    monkeypatch.setattr(batcher, 'S3_CLIENT', bucket)
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', sqs)
+    monkeypatch.setattr(batcher, '_invoke_batcher', invoked.append)
+    context = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 300000)
+
+    # The second batch is sent (its keys were listed) but saturates the queue: no more keys.
+    assert batcher.batch_lambda_handler({}, context) == 20
+    assert len(sqs.keys) == 20
+    assert invoked == [{'S3ContinuationToken': None, 'S3StartAfter': '19', 'EnqueueGovernor': {}}]
+
+    # The next batcher picks up right after the last key enqueued.
+    monkeypatch.setattr(batcher, 'ENQUEUE_MAX_RATE', 0)
+    assert batcher.batch_lambda_handler(invoked[0], context) == 5
+    assert bucket.requests[-1] == '19'
@@ -0,0 +1,109 @@
+import csv
+import gzip
+import json
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.batcher_function import main as batcher
+
+SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag, IsLatest, IsDeleteMarker'
+
+
+def _write_inventory(root, data_files):
+    # Write a CSV inventory manifest and its gzipped data files; returns the manifest path.
+    files = []
+    for index, rows in enumerate(data_files):
+        key = 'data/{}.csv.gz'.format(index)
+        (root / 'data').mkdir(exist_ok=True)
+        with gzip.open(str(root / key), 'wt', newline='') as data_file:
+            csv.writer(data_file).writerows(rows)
+        files.append({'key': key})
+
+    manifest = root / 'manifest.json'
+    manifest.write_text(json.dumps({
+        'fileFormat': 'CSV', 'fileSchema': SCHEMA, 'files': files,
+        'destinationBucket': 'arn:aws:s3:::inventory', 'creationTimestamp': '1700000000000'
+    }))
+    return str(manifest)
+
+
+def _row(key, is_latest='true', is_delete_marker='false'):
+    return ['bucket', key, '10', '2024-01-01T00:00:00.000Z', 'etag', is_latest, is_delete_marker]
+
+
+def _read_all(enumerator):
+    keys = []
+    while not enumerator.finished:
+        keys.extend(obj['Key'] for obj in enumerator.next_page())
+    return keys
+
+
+def test_resume_matches_a_single_pass(tmp_path, monkeypatch):
+    monkeypatch.setattr(batcher, 'INVENTORY_PAGE_SIZE', 3)
+    manifest = _write_inventory(tmp_path, [
+        [_row('a/{}'.format(i)) for i in range(5)],
+        [_row('b/{}'.format(i)) for i in range(4)],
+    ])
+    expected = _read_all(batcher.S3InventoryEnumerator(manifest))
+    assert len(expected) == 9
+
+    # Each batcher reads one page, then hands its position to the next one.
+    keys, payload = [], {'S3InventoryManifest': manifest}
+    while True:
+        position = payload.get('S3InventoryPosition', {})
+        enumerator = batcher.S3InventoryEnumerator(
+            payload['S3InventoryManifest'], position.get('File', 0), position.get('Row', 0))
+        if enumerator.finished:
+            break
+        keys.extend(obj['Key'] for obj in enumerator.next_page())
+        payload = enumerator.resume_payload()
+    assert keys == expected
+
+
+def test_resume_skips_rows_of_other_versions(tmp_path, monkeypatch):
+    monkeypatch.setattr(batcher, 'INVENTORY_PAGE_SIZE', 2)
+    manifest = _write_inventory(tmp_path, [[
+        _row('a%2Fb+0'), _row('old', is_latest='false'), _row('deleted', is_delete_marker='true'),
+        _row('a%2Fb+1'), _row('a%2Fb+2'),
+    ]])
+    enumerator = batcher.S3InventoryEnumerator(manifest)
+    assert [obj['Key'] for obj in enumerator.next_page()] == ['a/b 0', 'a/b 1']
+
+    position = enumerator.resume_payload()['S3InventoryPosition']
+    assert position == {'File': 0, 'Row': 4}
+    assert _read_all(batcher.S3InventoryEnumerator(manifest, position['File'],
+                                                   position['Row'])) == ['a/b 2']
+
+
+def test_resume_past_the_last_file_is_finished(tmp_path):
+    manifest = _write_inventory(tmp_path, [[_row('a')]])
+    assert batcher.S3InventoryEnumerator(manifest, file_index=1).finished
+
+
+def test_resume_from_part_way_through_a_page(tmp_path, monkeypatch):
+    # A saturated queue stops the batcher within a page spanning two data files.
+    monkeypatch.setattr(batcher, 'INVENTORY_PAGE_SIZE', 4)
+    manifest = _write_inventory(tmp_path, [
+        [_row('a/0'), _row('old', is_latest='false'), _row('a/1')],
+        [_row('b/0'), _row('b/1'), _row('b/2')],
+    ])
+    enumerator = batcher.S3InventoryEnumerator(manifest)
+    assert [obj['Key'] for obj in enumerator.next_page()] == ['a/0', 'a/1', 'b/0', 'b/1']
+    enumerator.resume_from(3)
+
+    position = enumerator.resume_payload()['S3InventoryPosition']
+    assert position == {'File': 1, 'Row': 1}
+    assert _read_all(batcher.S3InventoryEnumerator(manifest, position['File'],
+                                                   position['Row'])) == ['b/1', 'b/2']
+
+
+def test_only_csv_reports_are_supported(tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({
+        'fileFormat': 'Parquet', 'files': [{'key': 'data/0.parquet'}],
+        'destinationBucket': 'arn:aws:s3:::inventory'
+    }))
+    with pytest.raises(ValueError, match='only CSV'):
+        batcher.S3InventoryEnumerator(str(manifest))
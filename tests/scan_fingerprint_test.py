@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.batcher_function import main as batcher
+from lambda_functions.shared import scan_fingerprint
+
+
+def _write_metadata(tmp_path, monkeypatch, metadata):
+    metadata_file = tmp_path / 'rules.meta.json'
+    metadata_file.write_text(json.dumps(metadata))
+    monkeypatch.setattr(batcher, 'RULES_METADATA_FILE', str(metadata_file))
+
+
+def test_checkpoint_scoped_to_combined_scanners(tmp_path, monkeypatch):
+    # The batcher checkpoints on the same fingerprint as the analyzer's verdict cache.
+    monkeypatch.setattr(batcher, 'COMBINED_SCANNERS', ['secrets'])
+    _write_metadata(tmp_path, monkeypatch,
+                    {'Fingerprint': 'rules', 'ScannerFingerprints': {'secrets': 'old'}})
+    before = batcher._scan_fingerprint()
+    assert before == scan_fingerprint.combine('rules', [('secrets', 'old')])
+
+    # New secrets detectors with the same YARA rules start a full rescan.
+    _write_metadata(tmp_path, monkeypatch,
+                    {'Fingerprint': 'rules', 'ScannerFingerprints': {'secrets': 'new'}})
+    assert batcher._scan_fingerprint() not in (before, 'rules')
+
+
+def test_yara_only_and_missing_scanner(tmp_path, monkeypatch):
+    _write_metadata(tmp_path, monkeypatch, {'Fingerprint': 'rules'})
+    monkeypatch.setattr(batcher, 'COMBINED_SCANNERS', [])
+    assert batcher._scan_fingerprint() == 'rules'
+
+    # Without the scanner's fingerprint there is nothing safe to checkpoint on.
+    monkeypatch.setattr(batcher, 'COMBINED_SCANNERS', ['secrets'])
+    assert batcher._scan_fingerprint() is None
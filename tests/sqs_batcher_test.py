@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.batcher_function import main as batcher
+
+
+class _FakeSQS(object):
+    # Fails entries per attempt as scripted: [{entry index: sender fault?}, ...]
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.requests.append([entry['Id'] for entry in Entries])
+        failures = self.script.pop(0) if self.script else {}
+        return {'Failed': [
+            {'Id': entry['Id'], 'SenderFault': failures[entry['Id']], 'Message': 'failed'}
+            for entry in Entries if entry['Id'] in failures]}
+
+
+def _entries(count):
+    return [{'Id': str(index), 'MessageBody': 'body'} for index in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def _no_backoff(monkeypatch):
+    monkeypatch.setattr(batcher.time, 'sleep', lambda seconds: None)
+
+
+def test_sender_faults_are_kept_when_retries_succeed(monkeypatch):
+    sqs = _FakeSQS([{'0': True, '1': False}])
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', sqs)
+
+    assert batcher.SQSBatcher('queue', 10)._send_entries(_entries(3)) == 1
+    assert sqs.requests == [['0', '1', '2'], ['1']]
+
+
+def test_sender_faults_of_every_attempt_add_up(monkeypatch):
+    sqs = _FakeSQS([{'0': True, '1': False, '2': False}, {'2': True}])
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', sqs)
+
+    assert batcher.SQSBatcher('queue', 10)._send_entries(_entries(3)) == 2
+
+
+def test_server_side_failures_count_once_retries_run_out(monkeypatch):
+    sqs = _FakeSQS([{'0': True, '1': False}] + [{'1': False}] * batcher.SQS_SEND_MAX_ATTEMPTS)
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', sqs)
+
+    assert batcher.SQSBatcher('queue', 10)._send_entries(_entries(2)) == 2
+    assert len(sqs.requests) == batcher.SQS_SEND_MAX_ATTEMPTS
+
+
+def test_failures_reach_the_batcher(monkeypatch):
+    monkeypatch.setattr(batcher, 'SQS_CLIENT', _FakeSQS([{'0': True, '1': False}]))
+    sqs_batcher = batcher.SQSBatcher('queue', 1)
+    for key in ('a', 'b', 'c'):
+        sqs_batcher.add_key(key)
+    sqs_batcher.flash()
+    assert sqs_batcher.failures == 1
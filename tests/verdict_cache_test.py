@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip('boto3')
+
+from lambda_functions.analyzer_function import verdict_cache
+
+
+def test_miss_then_hit():
+    cache = verdict_cache.SQLiteVerdictCache(':memory:', 'rules-v1')
+    key = verdict_cache.sha_key('ab' * 32, 'samples/a.exe')
+    assert not cache.is_clean(key)
+
+    cache.mark_clean([key])
+    assert cache.is_clean(key)
+
+
+def test_scoped_to_rules_fingerprint(tmp_path):
+    db_path = str(tmp_path / 'verdicts.db')
+    key = verdict_cache.sha_key('ab' * 32)
+    verdict_cache.SQLiteVerdictCache(db_path, 'rules-v1').mark_clean([key])
+
+    assert verdict_cache.SQLiteVerdictCache(db_path, 'rules-v1').is_clean(key)
+    assert not verdict_cache.SQLiteVerdictCache(db_path, 'rules-v2').is_clean(key)
+
+
+def test_sha_key_scoped_to_observed_path():
+    # The YARA externals (filename, extension, ...) come from the observed path.
+    cache = verdict_cache.SQLiteVerdictCache(':memory:', 'rules-v1')
+    cache.mark_clean([verdict_cache.sha_key('ab' * 32, 'samples/a.exe')])
+
+    assert cache.is_clean(verdict_cache.sha_key('ab' * 32, 'samples/a.exe'))
+    assert not cache.is_clean(verdict_cache.sha_key('ab' * 32, 'samples/a.gif'))
+    assert not cache.is_clean(verdict_cache.sha_key('ab' * 32))
+
+
+def test_etag_key_scoped_to_object():
+    cache = verdict_cache.SQLiteVerdictCache(':memory:', 'rules-v1')
+    cache.mark_clean([verdict_cache.etag_key('bucket', 'a/b', '"0123abcd"', 10)])
+
+    assert cache.is_clean(verdict_cache.etag_key('bucket', 'a/b', '0123abcd', 10))
+    assert not cache.is_clean(verdict_cache.etag_key('bucket', 'a/c', '0123abcd', 10))
+    assert not cache.is_clean(verdict_cache.etag_key('other', 'a/b', '0123abcd', 10))
+    assert not cache.is_clean(verdict_cache.etag_key('bucket', 'a/b', '0123abcd', 11))
+
+
+def test_expired_entries_miss():
+    cache = verdict_cache.SQLiteVerdictCache(':memory:', 'rules-v1', ttl_days=0)
+    key = verdict_cache.sha_key('ab' * 32)
+    cache.mark_clean([key])
+    assert not cache.is_clean(key)